@@ -26,6 +26,7 @@ from apitools.base.py.exceptions import *
 from apitools.base.py.extra_types import *
 from apitools.base.py.http_wrapper import *
 from apitools.base.py.list_pager import *
+from apitools.base.py.operation_waiter import *
 from apitools.base.py.transfer import *
 from apitools.base.py.util import *
 
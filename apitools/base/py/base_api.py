@@ -21,6 +21,7 @@ import contextlib
 import datetime
 import logging
 import pprint
+import time
 
 
 import six
@@ -277,6 +278,12 @@ class BaseApiClient(object):
         # Since we can't change the init arguments without regenerating clients,
         # offer this hook to affect FinalizeTransferUrl behavior.
         self.overwrite_transfer_urls_with_client_base = False
+        # Likewise, an UploadStrategyPolicy shared by the uploads made with
+        # this client that don't have their own policy.
+        self.upload_strategy_policy = None
+        # If set, a batch.AutoBatcher that sends the calls made with this
+        # client, other than media uploads and downloads, in batches.
+        self.auto_batcher = None
 
         # TODO(craigcitro): Finish deprecating these fields.
         _ = model
@@ -692,6 +699,8 @@ class BaseApiService(object):
         # It's important that upload and download go before we fill in the
         # relative path, so that they can replace it.
         if upload is not None:
+            if upload.strategy_policy is None:
+                upload.strategy_policy = self.__client.upload_strategy_policy
             upload.ConfigureRequest(upload_config, http_request, url_builder)
         if download is not None:
             download.ConfigureRequest(http_request, url_builder)
@@ -729,6 +738,9 @@ class BaseApiService(object):
         if upload is not None:
             http_response = upload.InitializeUpload(
                 http_request, client=self.client)
+        elif self.__client.auto_batcher is not None:
+            http_response = self.__client.auto_batcher.Submit(
+                http_request, batch_url=self.__client.url + 'batch').result()
         if http_response is None:
             http = self.__client.http
             if upload and upload.bytes_http:
@@ -741,8 +753,27 @@ class BaseApiService(object):
                 opts['check_response_func'] = self.__client.check_response_func
             if self.__client.retry_func:
                 opts['retry_func'] = self.__client.retry_func
-            http_response = http_wrapper.MakeRequest(
-                http, http_request, **opts)
+            if upload is not None and upload.bandwidth_limiter is not None:
+                # A simple upload is charged in full before it is sent.
+                upload.bandwidth_limiter.Consume(
+                    int(http_request.headers.get('content-length', 0)))
+            start_time = time.time()
+            # pylint: disable=protected-access
+            try:
+                http_response = http_wrapper.MakeRequest(
+                    http, http_request, **opts)
+            except Exception:
+                if upload is not None:
+                    upload._RecordSimpleUpload(
+                        http_request, time.time() - start_time, False)
+                raise
+            finally:
+                if upload is not None:
+                    upload._ReleaseMemoryMap()
+            if upload is not None:
+                upload._RecordSimpleUpload(
+                    http_request, time.time() - start_time,
+                    http_response.status_code < 400)
 
         return self.ProcessHttpResponse(method_config, http_response, request)
 
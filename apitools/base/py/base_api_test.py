@@ -14,9 +14,11 @@
 # limitations under the License.
 
 import base64
+from concurrent import futures
 import datetime
 import sys
 import contextlib
+import tempfile
 import unittest
 
 import six
@@ -29,6 +31,7 @@ from apitools.base.py import base_api
 from apitools.base.py import encoding
 from apitools.base.py import exceptions
 from apitools.base.py import http_wrapper
+from apitools.base.py import transfer
 
 
 @contextlib.contextmanager
@@ -225,6 +228,134 @@ class BaseApiTest(unittest.TestCase):
         self.assertEqual(method_config, http_error.method_config)
         self.assertEqual(request, http_error.request)
 
+    def _RunSimpleUpload(self, request_field):
+        class FakeBandwidthLimiter(object):
+
+            def __init__(self):
+                self.consumed = 0
+
+            def Consume(self, num_bytes):
+                self.consumed += num_bytes
+
+        sent = []
+
+        def fakeMakeRequest(unused_http, http_request, **unused_kwargs):
+            sent.append(http_request)
+            return http_wrapper.Response(
+                info={'status': '200'}, content='{}',
+                request_url='http://www.google.com')
+        method_config = base_api.ApiMethodInfo(
+            request_type_name='SimpleMessage',
+            response_type_name='SimpleMessage',
+            http_method='POST', request_field=request_field)
+        upload_config = base_api.ApiUploadInfo(
+            accept=['*/*'], max_size=None, resumable_path=None,
+            simple_multipart=True, simple_path='/upload')
+        upload = transfer.Upload(
+            six.BytesIO(b'data' * 100), 'text/plain', total_size=400,
+            bandwidth_limiter=FakeBandwidthLimiter())
+        service = FakeService(client=self.__GetFakeClient())
+        with mock(base_api.http_wrapper, 'MakeRequest', fakeMakeRequest):
+            service._RunMethod(method_config, SimpleMessage(field='abc'),
+                               upload=upload, upload_config=upload_config)
+        http_request, = sent
+        return http_request, upload.bandwidth_limiter.consumed
+
+    def testSimpleUploadChargesBandwidthLimiter(self):
+        http_request, consumed = self._RunSimpleUpload(request_field='')
+        self.assertEqual('media', urllib_parse.parse_qs(
+            urllib_parse.urlsplit(http_request.url).query)['uploadType'][0])
+        self.assertEqual(400, consumed)
+
+    def testMultipartUploadChargesBandwidthLimiter(self):
+        http_request, consumed = self._RunSimpleUpload(
+            request_field=base_api.REQUEST_IS_BODY)
+        self.assertEqual('multipart', urllib_parse.parse_qs(
+            urllib_parse.urlsplit(http_request.url).query)['uploadType'][0])
+        self.assertEqual(int(http_request.headers['content-length']),
+                         consumed)
+        self.assertGreater(consumed, 400)
+
+    def testSimpleUploadReleasesMemoryMap(self):
+        bodies = []
+
+        def fakeMakeRequest(unused_http, http_request, **unused_kwargs):
+            bodies.append(http_request.body)
+            return http_wrapper.Response(
+                info={'status': '200'}, content='{}',
+                request_url='http://www.google.com')
+        method_config = base_api.ApiMethodInfo(
+            request_type_name='SimpleMessage',
+            response_type_name='SimpleMessage',
+            http_method='POST')
+        upload_config = base_api.ApiUploadInfo(
+            accept=['*/*'], max_size=None, resumable_path=None,
+            simple_multipart=True, simple_path='/upload')
+        service = FakeService(client=self.__GetFakeClient())
+        with tempfile.TemporaryFile() as upload_file:
+            upload_file.write(b'data' * 100)
+            upload_file.seek(0)
+            upload = transfer.Upload(
+                upload_file, 'text/plain', total_size=400, use_mmap=True)
+            with mock(base_api.http_wrapper, 'MakeRequest', fakeMakeRequest):
+                service._RunMethod(method_config, SimpleMessage(),
+                                   upload=upload, upload_config=upload_config)
+        body, = bodies
+        self.assertIsInstance(body, memoryview)
+        self.assertRaises(ValueError, body.tobytes)
+
+    def testSimpleUploadFailureRecorded(self):
+        def fakeMakeRequest(*unused_args, **unused_kwargs):
+            raise exceptions.CommunicationError('connection reset')
+        method_config = base_api.ApiMethodInfo(
+            request_type_name='SimpleMessage',
+            response_type_name='SimpleMessage',
+            http_method='POST')
+        upload_config = base_api.ApiUploadInfo(
+            accept=['*/*'], max_size=None, resumable_path=None,
+            simple_multipart=True, simple_path='/upload')
+        policy = transfer.AdaptiveUploadStrategyPolicy()
+        upload = transfer.Upload(
+            six.BytesIO(b'data'), 'text/plain', total_size=4,
+            strategy_policy=policy)
+        service = FakeService(client=self.__GetFakeClient())
+        with mock(base_api.http_wrapper, 'MakeRequest', fakeMakeRequest):
+            with self.assertRaises(exceptions.CommunicationError):
+                service._RunMethod(method_config, SimpleMessage(),
+                                   upload=upload, upload_config=upload_config)
+        self.assertGreater(policy.failure_rate, 0)
+
+    def testAutoBatcher(self):
+        submitted = []
+
+        class FakeAutoBatcher(object):
+
+            def Submit(self, http_request, batch_url=None):
+                submitted.append((http_request, batch_url))
+                future = futures.Future()
+                future.set_result(http_wrapper.Response(
+                    info={'status': http_client.NOT_FOUND},
+                    content='{"field": "abc"}',
+                    request_url='http://www.google.com'))
+                return future
+
+        def fakeMakeRequest(*unused_args, **unused_kwargs):
+            self.fail('Request was not batched')
+        method_config = base_api.ApiMethodInfo(
+            request_type_name='SimpleMessage',
+            response_type_name='SimpleMessage')
+        client = self.__GetFakeClient()
+        client.auto_batcher = FakeAutoBatcher()
+        service = FakeService(client=client)
+        request = SimpleMessage()
+        with mock(base_api.http_wrapper, 'MakeRequest', fakeMakeRequest):
+            with self.assertRaises(exceptions.HttpNotFoundError) as err:
+                service._RunMethod(method_config, request)
+        self.assertEqual(1, len(submitted))
+        self.assertEqual(client.url + 'batch', submitted[0][1])
+        self.assertEqual(method_config, err.exception.method_config)
+        self.assertEqual(request, err.exception.request)
+
     def testQueryEncoding(self):
         method_config = base_api.ApiMethodInfo(
             request_type_name='MessageWithTime', query_params=['timestamp'])
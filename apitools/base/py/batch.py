@@ -17,24 +17,36 @@
 """Library for handling batch HTTP requests for apitools."""
 
 import collections
-import email.generator as generator
-import email.mime.multipart as mime_multipart
-import email.mime.nonmultipart as mime_nonmultipart
-import email.parser as email_parser
+import email.header as email_header
+import functools
+import heapq
 import itertools
+from multiprocessing import pool as multiprocessing_pool
+import random
+import re
+import threading
 import time
 import uuid
 
 import six
 from six.moves import http_client
 from six.moves import urllib_parse
-from six.moves import range  # pylint: disable=redefined-builtin
 
 from apitools.base.py import exceptions
 from apitools.base.py import http_wrapper
 
+try:
+    from concurrent import futures
+except ImportError:
+    # Python 2 without the futures backport; AutoBatcher is unavailable.
+    futures = None
+
 __all__ = [
+    'AdaptiveBatchSizingPolicy',
+    'AutoBatcher',
     'BatchApiRequest',
+    'BatchSizingPolicy',
+    'FixedBatchSizingPolicy',
 ]
 
 
@@ -56,6 +68,420 @@ class RequestResponseAndHandler(collections.namedtuple(
     """
 
 
+# Printable ASCII other than ':', as accepted by the email package.
+_HEADER_NAME_RE = re.compile(r'[\041-\071\073-\176]+\Z')
+
+# Header values that can be written out without any encoding.
+_PLAIN_HEADER_VALUE_RE = re.compile(r'[\t\040-\176]*\Z')
+
+
+def _FormatHeader(name, value):
+    """Format a header line, encoding the value as the email package does.
+
+    Values that are printable ASCII are written as-is; anything else is
+    RFC 2047 encoded, without line wrapping.
+
+    Args:
+      name: The header name.
+      value: The header value.
+
+    Returns:
+      The header line, including its trailing newline.
+    """
+    if not _PLAIN_HEADER_VALUE_RE.match(value):
+        value = email_header.Header(value, header_name=name).encode(
+            maxlinelen=0)
+    return '%s: %s\n' % (name, value)
+
+
+class _CredentialsRefresher(object):
+
+    """Refreshes credentials shared by concurrent batches.
+
+    Each batch notes the generation of the credentials before it is sent.
+    When several batches fail authorization with the same credentials,
+    only the first of them refreshes; the rest see that the generation
+    has moved on and retry with the new token.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.__lock = threading.Lock()
+        self.__generation = 0
+
+    @property
+    def generation(self):
+        return self.__generation
+
+    def Refresh(self, http, generation):
+        """Refresh the credentials, unless done since generation."""
+        with self.__lock:
+            if generation == self.__generation:
+                self.credentials.refresh(http)
+                self.__generation += 1
+
+
+def _EstimateSize(http_request):
+    """Estimate the bytes http_request adds to a batch request."""
+    # The part headers, request line, and Host and MIME headers take a
+    # little under 200 bytes.
+    size = 200 + len(http_request.url) + len(http_request.body or '')
+    for key, value in http_request.headers.items():
+        size += len('%s: %s\n' % (key, value))
+    return size
+
+
+class BatchSizingPolicy(object):
+
+    """Decides how many requests to send in each batch.
+
+    BatchApiRequest.Execute packs requests into a batch, in order, until
+    either limit from Limits would be exceeded; a batch always holds at
+    least one request. It reports each batch it sends back through the
+    Record methods, so a policy shared by many calls to Execute can learn
+    from them.
+    """
+
+    def Limits(self):
+        """Return the (max requests, max bytes) for the next batch.
+
+        Returns:
+          A tuple of the most requests and the most estimated serialized
+          bytes to put in a batch; either may be None for no limit.
+        """
+        raise NotImplementedError()
+
+    def RecordBatch(self, num_requests, num_bytes, elapsed_seconds,
+                    num_failed):
+        """Record a batch that was sent.
+
+        Args:
+          num_requests: Number of requests in the batch.
+          num_bytes: Estimated size of the batch.
+          elapsed_seconds: Time taken by the batch request.
+          num_failed: Number of requests in the batch that need a retry.
+        """
+
+    def RecordTooLarge(self, num_requests, num_bytes):
+        """Record a batch that the server rejected as too large."""
+
+
+class FixedBatchSizingPolicy(BatchSizingPolicy):
+
+    """Uses fixed limits on the requests and bytes in a batch.
+
+    This is the default policy, with no limits.
+    """
+
+    def __init__(self, max_requests=None, max_bytes=None):
+        self.__max_requests = max_requests
+        self.__max_bytes = max_bytes
+
+    def Limits(self):
+        return self.__max_requests, self.__max_bytes
+
+
+class AdaptiveBatchSizingPolicy(BatchSizingPolicy):
+
+    """Sets the batch size from the latency and failures of recent batches.
+
+    The number of requests per batch follows additive increase,
+    multiplicative decrease: it grows by increase_requests after every
+    full batch that finished within target_latency with few failures, and
+    is halved after a batch that was slower, or in which more than
+    max_failure_rate of the requests need a retry. The byte budget starts
+    at max_bytes and is halved, along with the request limit, whenever
+    the server rejects a batch as too large. This class is thread-safe.
+    """
+
+    def __init__(self, initial_requests=50, min_requests=1,
+                 max_requests=1000, max_bytes=8 << 20, increase_requests=10,
+                 target_latency=10.0, max_failure_rate=0.1):
+        self.__min_requests = min_requests
+        self.__max_requests = max_requests
+        self.__increase_requests = increase_requests
+        self.__target_latency = target_latency
+        self.__max_failure_rate = max_failure_rate
+        self.__lock = threading.Lock()
+        self.__request_limit = max(min_requests,
+                                   min(initial_requests, max_requests))
+        self.__byte_limit = max_bytes
+
+    @property
+    def request_limit(self):
+        """Current maximum number of requests per batch."""
+        return self.__request_limit
+
+    @property
+    def byte_limit(self):
+        """Current maximum estimated bytes per batch."""
+        return self.__byte_limit
+
+    def Limits(self):
+        with self.__lock:
+            return self.__request_limit, self.__byte_limit
+
+    def __Decrease(self, num_requests):
+        self.__request_limit = max(
+            self.__min_requests,
+            min(self.__request_limit, num_requests) // 2)
+
+    def RecordBatch(self, num_requests, num_bytes, elapsed_seconds,
+                    num_failed):
+        with self.__lock:
+            if (elapsed_seconds > self.__target_latency or
+                    num_failed > self.__max_failure_rate * num_requests):
+                self.__Decrease(num_requests)
+            elif num_requests >= self.__request_limit:
+                self.__request_limit = min(
+                    self.__max_requests,
+                    self.__request_limit + self.__increase_requests)
+
+    def RecordTooLarge(self, num_requests, num_bytes):
+        with self.__lock:
+            self.__Decrease(num_requests)
+            self.__byte_limit = min(self.__byte_limit, num_bytes // 2)
+
+
+class _RetrySchedule(object):
+
+    """Decides which requests of a BatchApiRequest to send next.
+
+    Requests are first sent in the order they were added. A request that
+    needs retrying waits out its own backoff, or the Retry-After of its
+    response, and is then sent ahead of any requests not sent yet.
+    """
+
+    def __init__(self, requests, max_retries, sleep_between_polls,
+                 max_retry_wait):
+        self.__unsent = collections.deque(requests)
+        # Heap of (due time, sequence number, request).
+        self.__retries = []
+        self.__sequence = itertools.count()
+        self.__attempts = {}
+        self.__max_retries = max_retries
+        self.__sleep_between_polls = sleep_between_polls
+        self.__max_retry_wait = max_retry_wait
+
+    @property
+    def has_unsent(self):
+        return bool(self.__unsent)
+
+    def NextBatch(self, max_requests=None, max_bytes=None):
+        """Return requests that are due to be sent, within the limits."""
+        now = time.time()
+        batch = []
+        batch_bytes = 0
+        while max_requests is None or len(batch) < max_requests:
+            if self.__retries and self.__retries[0][0] <= now:
+                request = self.__retries[0][2]
+            elif self.__unsent:
+                request = self.__unsent[0]
+            else:
+                break
+            size = _EstimateSize(request.http_request)
+            if (batch and max_bytes is not None and
+                    batch_bytes + size > max_bytes):
+                break
+            if self.__retries and self.__retries[0][2] is request:
+                heapq.heappop(self.__retries)
+            else:
+                self.__unsent.popleft()
+            batch.append(request)
+            batch_bytes += size
+        return batch
+
+    def TimeUntilDue(self):
+        """Seconds until the next retry is due, or None if there is none."""
+        if not self.__retries:
+            return None
+        return max(0, self.__retries[0][0] - time.time())
+
+    def RecordAttempt(self, requests):
+        """Schedule retries for requests that were sent but didn't finish."""
+        now = time.time()
+        for request in requests:
+            attempts = self.__attempts.get(request, 0) + 1
+            self.__attempts[request] = attempts
+            if request.terminal_state or attempts >= self.__max_retries:
+                continue
+            heapq.heappush(self.__retries, (
+                now + self.__RetryWait(request, attempts),
+                next(self.__sequence), request))
+
+    def __RetryWait(self, request, attempts):
+        if request.retry_after is not None:
+            return request.retry_after
+        wait = self.__sleep_between_polls * 2 ** (attempts - 1)
+        wait += random.uniform(-wait / 4.0, wait / 4.0)
+        return min(wait, self.__max_retry_wait)
+
+
+def _NewHttp(credentials):
+    """Return a new http, authorized with credentials if there are any."""
+    http = http_wrapper.GetHttp()
+    if credentials is not None:
+        http = credentials.authorize(http)
+    return http
+
+
+def _MakeBoundary():
+    """Return a new random multipart boundary."""
+    return '=' * 15 + uuid.uuid4().hex + '=='
+
+
+def _Literal(text, like):
+    """Return the str text as the same type (str or bytes) as like."""
+    if isinstance(like, bytes) and not isinstance(text, bytes):
+        return text.encode('ascii')
+    return text
+
+
+def _GetBoundary(content_type):
+    """Return the boundary parameter of a multipart Content-Type, or None."""
+    media_type, _, params = content_type.partition(';')
+    if media_type.strip().lower().split('/')[0] != 'multipart':
+        return None
+    for param in params.split(';'):
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'boundary':
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            return value or None
+    return None
+
+
+def _FindLineEnd(data, start):
+    """Return (end of line content, start of next line) for a line."""
+    end = data.find(_Literal('\n', data), start)
+    if end == -1:
+        return len(data), len(data)
+    if end > start and data[end - 1:end] == _Literal('\r', data):
+        return end - 1, end + 1
+    return end, end + 1
+
+
+def _StripLineEnding(data):
+    """Remove a single trailing line ending from data."""
+    if data.endswith(_Literal('\r\n', data)):
+        return data[:-2]
+    if data.endswith(_Literal('\n', data)):
+        return data[:-1]
+    return data
+
+
+def _FindBoundary(data, delimiter, start):
+    """Find the next boundary line at or after start.
+
+    A boundary line is the delimiter at the start of a line, optionally
+    followed by '--' (for the closing boundary) and spaces or tabs.
+
+    Args:
+      data: The multipart body, as str or bytes.
+      delimiter: '--' followed by the boundary, of the same type as data.
+      start: Position to start looking from; must be the start of a line.
+
+    Returns:
+      A tuple (position of the boundary line, start of the line after it,
+      whether it is the closing boundary), or None if there is none.
+    """
+    dashes = _Literal('--', data)
+    whitespace = _Literal(' \t', data)
+    position = start
+    while True:
+        position = data.find(delimiter, position)
+        if position == -1:
+            return None
+        if position == 0 or data[position - 1:position] == _Literal(
+                '\n', data):
+            line_end, next_line = _FindLineEnd(data, position)
+            rest = data[position + len(delimiter):line_end]
+            is_close = rest.startswith(dashes)
+            if is_close:
+                rest = rest[2:]
+            if not rest.strip(whitespace):
+                return position, next_line, is_close
+        position += len(delimiter)
+
+
+def _SplitMultipart(data, boundary):
+    """Split a multipart body into the raw contents of its parts.
+
+    This follows the email package's handling of the body: the preamble
+    and epilogue are dropped, and the line ending before each boundary
+    belongs to the boundary rather than to the part.
+
+    Args:
+      data: The multipart body, as str or bytes.
+      boundary: The boundary from the Content-Type, as str.
+
+    Returns:
+      A list of the parts, of the same type as data.
+
+    Raises:
+      BatchError if there is no opening boundary.
+    """
+    delimiter = _Literal('--' + boundary, data)
+    found = _FindBoundary(data, delimiter, 0)
+    if found is None or found[2]:
+        raise exceptions.BatchError(
+            'Response not in multipart/mixed format.')
+    parts = []
+    _, part_start, is_close = found
+    while not is_close:
+        found = _FindBoundary(data, delimiter, part_start)
+        if found is None:
+            # No closing boundary; the last part runs to the end.
+            parts.append(_StripLineEnding(data[part_start:]))
+            break
+        position, next_line, is_close = found
+        parts.append(_StripLineEnding(data[part_start:position]))
+        part_start = next_line
+    return parts
+
+
+def _ParseHeaders(data):
+    """Parse the headers at the start of data, as the email package does.
+
+    Header values keep the line breaks of folded lines, and parsing stops
+    at the first blank line or the first line that isn't a header.
+
+    Args:
+      data: A message, as str.
+
+    Returns:
+      A list of (name, value) header pairs and the rest of data.
+    """
+    headers = []
+    continues_header = False
+    position = 0
+    while position < len(data):
+        line_end, next_line = _FindLineEnd(data, position)
+        if line_end == position:
+            # The blank line separating the headers from the body.
+            position = next_line
+            break
+        if data[position] in ' \t':
+            # A folded line continues the previous header; with no previous
+            # header, it is dropped.
+            if continues_header:
+                name, value = headers[-1]
+                headers[-1] = (name, value + data[position:next_line])
+        else:
+            name, colon, value = data[position:next_line].partition(':')
+            if not colon or (name and not _HEADER_NAME_RE.match(name)):
+                break
+            # Lines with an empty header name are dropped, along with
+            # any lines folded onto them.
+            continues_header = bool(name)
+            if name:
+                headers.append((name, value.lstrip(' \t')))
+        position = next_line
+    return [(name, value.rstrip('\r\n')) for name, value in headers], (
+        data[position:])
+
+
 class BatchApiRequest(object):
     """Batches multiple api requests into a single request."""
 
@@ -110,6 +536,10 @@ class BatchApiRequest(object):
         def exception(self):
             return self.__exception
 
+        @property
+        def http_response(self):
+            return self.__http_response
+
         @property
         def authorization_failed(self):
             return (self.__http_response and (
@@ -122,6 +552,19 @@ class BatchApiRequest(object):
             response_code = self.__http_response.status_code
             return response_code not in self.__retryable_codes
 
+        @property
+        def retry_after(self):
+            """Seconds the server asked to wait before a retry, or None."""
+            if self.__http_response is None:
+                return None
+            for name, value in self.__http_response.info.items():
+                if name.lower() == 'retry-after':
+                    try:
+                        return max(0, int(value))
+                    except ValueError:
+                        return None
+            return None
+
         def HandleResponse(self, http_response, exception):
             """Handles incoming http response to the request in http_request.
 
@@ -185,13 +628,20 @@ class BatchApiRequest(object):
         self.api_requests.append(api_request)
 
     def Execute(self, http, sleep_between_polls=5, max_retries=5,
-                max_batch_size=None, batch_request_callback=None):
+                max_batch_size=None, batch_request_callback=None,
+                max_concurrent_batches=None, http_factory=None,
+                max_retry_wait=60, sizing_policy=None):
         """Execute all of the requests in the batch.
 
+        Requests that fail with a retryable code are retried on their own
+        schedule: each waits for the Retry-After of its response or, if
+        there is none, for an exponential backoff with jitter, and is then
+        batched together with any other requests that are due.
+
         Args:
           http: httplib2.Http object for use in the request.
-          sleep_between_polls: Integer number of seconds to sleep between
-              polls.
+          sleep_between_polls: Number of seconds to wait before the first
+              retry of a request; the wait doubles with each further retry.
           max_retries: Max retries. Any requests that have not succeeded by
               this number of retries simply report the last response or
               exception, whatever it happened to be.
@@ -199,46 +649,151 @@ class BatchApiRequest(object):
               of given size.
           batch_request_callback: function of (http_response, exception) passed
               to BatchHttpRequest which will be run on any given results.
+          max_concurrent_batches: int, if specified up to this many batches
+              are sent at once, each on its own http object. Results and
+              calls to batch_request_callback are in the same order as when
+              batches are sent one at a time, and the callback is always
+              run in the calling thread.
+          http_factory: (callable, optional) Returns a new http object for
+              each thread sending concurrent batches. Defaults to a fresh
+              http authorized with the credentials of http, if any.
+          max_retry_wait: Upper bound in seconds for the backoff between
+              retries of a request.
+          sizing_policy: (BatchSizingPolicy, optional) Decides how many
+              requests to put in each batch, instead of max_batch_size.
+              A batch that the server rejects as too large is split in
+              half and sent again.
 
         Returns:
           List of ApiCalls.
+
+        Raises:
+          InvalidUserInputError: if max_concurrent_batches is not positive.
         """
+        if max_concurrent_batches is not None and max_concurrent_batches < 1:
+            raise exceptions.InvalidUserInputError(
+                'max_concurrent_batches must be positive')
         requests = [request for request in self.api_requests
                     if not request.terminal_state]
-        batch_size = max_batch_size or len(requests)
-
-        for attempt in range(max_retries):
-            if attempt:
-                time.sleep(sleep_between_polls)
-
-            for i in range(0, len(requests), batch_size):
-                # Create a batch_http_request object and populate it with
-                # incomplete requests.
-                batch_http_request = BatchHttpRequest(
-                    batch_url=self.batch_url,
-                    callback=batch_request_callback,
-                    response_encoding=self.response_encoding
-                )
-                for request in itertools.islice(requests,
-                                                i, i + batch_size):
-                    batch_http_request.Add(
-                        request.http_request, request.HandleResponse)
-                batch_http_request.Execute(http)
-
-                if hasattr(http.request, 'credentials'):
-                    if any(request.authorization_failed
-                           for request in itertools.islice(requests,
-                                                           i, i + batch_size)):
-                        http.request.credentials.refresh(http)
-
-            # Collect retryable requests.
-            requests = [request for request in self.api_requests if not
-                        request.terminal_state]
-            if not requests:
-                break
+        if sizing_policy is None:
+            sizing_policy = FixedBatchSizingPolicy(max_batch_size)
+        schedule = _RetrySchedule(
+            requests if max_retries > 0 else [], max_retries,
+            sleep_between_polls, max_retry_wait)
+        refresher = _CredentialsRefresher(getattr(
+            getattr(http, 'request', None), 'credentials', None))
+
+        max_in_flight = 1
+        thread_pool = None
+
+        # Batches in the order they were sent, with a function returning
+        # their results.
+        in_flight = collections.deque()
+        try:
+            while True:
+                while len(in_flight) < max_in_flight:
+                    batch = schedule.NextBatch(*sizing_policy.Limits())
+                    if not batch:
+                        break
+                    if ((max_concurrent_batches or 1) > 1 and
+                            thread_pool is None and schedule.has_unsent):
+                        # There is more than one batch to send.
+                        max_in_flight = max_concurrent_batches
+                        thread_pool = multiprocessing_pool.ThreadPool(
+                            max_concurrent_batches)
+                        send_batch = self.__ConcurrentBatchSender(
+                            http_factory, refresher, sizing_policy)
+                    if thread_pool is None:
+                        get_results = functools.partial(
+                            self.__SendBatch, http, batch, refresher,
+                            sizing_policy)
+                    else:
+                        get_results = thread_pool.apply_async(
+                            send_batch, (batch,)).get
+                    in_flight.append((batch, get_results))
+
+                if in_flight:
+                    batch, get_results = in_flight.popleft()
+                    results = get_results()
+                    if batch_request_callback is not None:
+                        for response, exception in results:
+                            batch_request_callback(response, exception)
+                    schedule.RecordAttempt(batch)
+                    continue
+
+                wait = schedule.TimeUntilDue()
+                if wait is None:
+                    break
+                time.sleep(wait)
+        finally:
+            if thread_pool is not None:
+                thread_pool.terminate()
+                thread_pool.join()
 
         return self.api_requests
 
+    def __ConcurrentBatchSender(self, http_factory, refresher,
+                                sizing_policy):
+        """Returns a function sending a batch with a per-thread http."""
+        thread_state = threading.local()
+
+        def SendBatch(batch):
+            if not hasattr(thread_state, 'http'):
+                if http_factory is not None:
+                    thread_state.http = http_factory()
+                else:
+                    thread_state.http = _NewHttp(refresher.credentials)
+            return self.__SendBatch(thread_state.http, batch, refresher,
+                                    sizing_policy)
+
+        return SendBatch
+
+    def __SendBatch(self, http, requests, refresher, sizing_policy):
+        """Send requests as one BatchHttpRequest.
+
+        If the server rejects the batch as too large, it is split in half
+        and each half is sent on its own.
+
+        Returns:
+          The (response, exception) pairs for batch_request_callback, in
+          the order of requests.
+        """
+        generation = refresher.generation
+        num_bytes = sum(_EstimateSize(request.http_request)
+                        for request in requests)
+        results = []
+        # Create a batch_http_request object and populate it with
+        # incomplete requests.
+        batch_http_request = BatchHttpRequest(
+            batch_url=self.batch_url,
+            callback=lambda *result: results.append(result),
+            response_encoding=self.response_encoding
+        )
+        for request in requests:
+            batch_http_request.Add(
+                request.http_request, request.HandleResponse)
+        start_time = time.time()
+        try:
+            batch_http_request.Execute(http)
+        except exceptions.HttpError as e:
+            if (e.status_code != http_client.REQUEST_ENTITY_TOO_LARGE or
+                    len(requests) < 2):
+                raise
+            sizing_policy.RecordTooLarge(len(requests), num_bytes)
+            middle = len(requests) // 2
+            return (self.__SendBatch(http, requests[:middle], refresher,
+                                     sizing_policy) +
+                    self.__SendBatch(http, requests[middle:], refresher,
+                                     sizing_policy))
+        sizing_policy.RecordBatch(
+            len(requests), num_bytes, time.time() - start_time,
+            sum(1 for request in requests if not request.terminal_state))
+
+        if refresher.credentials is not None:
+            if any(request.authorization_failed for request in requests):
+                refresher.Refresh(http, generation)
+        return results
+
 
 class BatchHttpRequest(object):
 
@@ -276,6 +831,9 @@ class BatchHttpRequest(object):
         # Unique ID on which to base the Content-ID headers.
         self.__base_id = uuid.uuid4()
 
+        # Boundary separating the parts of the batch request.
+        self.__boundary = _MakeBoundary()
+
     def _ConvertIdToHeader(self, request_id):
         """Convert an id to a Content-ID header value.
 
@@ -317,13 +875,14 @@ class BatchHttpRequest(object):
         return urllib_parse.unquote(request_id)
 
     def _SerializeRequest(self, request):
-        """Convert a http_wrapper.Request object into a string.
+        """Convert a http_wrapper.Request object into bytes.
 
         Args:
           request: A http_wrapper.Request to serialize.
 
         Returns:
-          The request as a string in application/http format.
+          The request as bytes in application/http format. A bytes body is
+          included unchanged, and a text body is encoded as UTF-8.
         """
         # Construct status line
         parsed = urllib_parse.urlsplit(request.url)
@@ -331,36 +890,31 @@ class BatchHttpRequest(object):
             ('', '', parsed.path, parsed.query, ''))
         if not isinstance(request_line, six.text_type):
             request_line = request_line.decode('utf-8')
-        status_line = u' '.join((
-            request.http_method,
-            request_line,
-            u'HTTP/1.1\n'
-        ))
-        major, minor = request.headers.get(
-            'content-type', 'application/json').split('/')
-        msg = mime_nonmultipart.MIMENonMultipart(major, minor)
-
-        # MIMENonMultipart adds its own Content-Type header.
+        content_type = request.headers.get('content-type', 'application/json')
+        # The content type must be of the form major/minor.
+        major, minor = content_type.split('/')
+
+        lines = [
+            u' '.join((request.http_method, request_line, u'HTTP/1.1\n')),
+            _FormatHeader('Content-Type', '%s/%s' % (major, minor)),
+            'MIME-Version: 1.0\n',
+        ]
         # Keep all of the other headers in `request.headers`.
         for key, value in request.headers.items():
             if key == 'content-type':
                 continue
-            msg[key] = value
-
-        msg['Host'] = parsed.netloc
-        msg.set_unixfrom(None)
+            lines.append(_FormatHeader(key, value))
+        lines.append(_FormatHeader('Host', parsed.netloc))
+        lines.append('\n')
+        lines = [line.encode('utf-8') for line in lines]
 
         if request.body is not None:
-            msg.set_payload(request.body)
+            body = request.body
+            if not isinstance(body, six.binary_type):
+                body = body.encode('utf-8')
+            lines.append(body)
 
-        # Serialize the mime message.
-        str_io = six.StringIO()
-        # maxheaderlen=0 means don't line wrap headers.
-        gen = generator.Generator(str_io, maxheaderlen=0)
-        gen.flatten(msg, unixfrom=False)
-        body = str_io.getvalue()
-
-        return status_line + body
+        return b''.join(lines)
 
     def _DeserializeResponse(self, payload):
         """Convert string into Response and content.
@@ -376,16 +930,16 @@ class BatchHttpRequest(object):
         _, status, _ = status_line.split(' ', 2)
 
         # Parse the rest of the response.
-        parser = email_parser.Parser()
-        msg = parser.parsestr(payload)
-
-        # Get the headers.
-        info = dict(msg)
+        headers, content = _ParseHeaders(payload)
+
+        # Get the headers. As with email.message.Message, a repeated header
+        # takes the first of its values.
+        first_values = {}
+        for name, value in headers:
+            first_values.setdefault(name.lower(), value)
+        info = dict((name, first_values[name.lower()]) for name, _ in headers)
         info['status'] = status
 
-        # Create Response from the parsed headers.
-        content = msg.get_payload()
-
         return http_wrapper.Response(info, content, self.__batch_url)
 
     def _NewId(self):
@@ -426,48 +980,58 @@ class BatchHttpRequest(object):
           httplib2.HttpLib2Error if a transport error has occured.
           apiclient.errors.BatchError if the response is the wrong format.
         """
-        message = mime_multipart.MIMEMultipart('mixed')
-        # Message should not write out its own headers.
-        setattr(message, '_write_headers', lambda self: None)
-
         # Add all the individual requests.
+        parts = []
         for key in self.__request_response_handlers:
-            msg = mime_nonmultipart.MIMENonMultipart('application', 'http')
-            msg['Content-Transfer-Encoding'] = 'binary'
-            msg['Content-ID'] = self._ConvertIdToHeader(key)
-
-            body = self._SerializeRequest(
-                self.__request_response_handlers[key].request)
-            msg.set_payload(body)
-            message.attach(msg)
+            headers = ''.join((
+                'Content-Type: application/http\n',
+                'MIME-Version: 1.0\n',
+                'Content-Transfer-Encoding: binary\n',
+                _FormatHeader('Content-ID', self._ConvertIdToHeader(key)),
+                '\n',
+            ))
+            parts.append(headers.encode('utf-8') + self._SerializeRequest(
+                self.__request_response_handlers[key].request))
+
+        # The boundary must not appear in any of the parts.
+        while any(b'--' + self.__boundary.encode('ascii') in part
+                  for part in parts):
+            self.__boundary = _MakeBoundary()
+        delimiter = b'--' + self.__boundary.encode('ascii')
+        body = b''.join((
+            delimiter, b'\n',
+            (b'\n' + delimiter + b'\n').join(parts),
+            b'\n', delimiter, b'--\n'))
 
         request = http_wrapper.Request(self.__batch_url, 'POST')
-        request.body = message.as_string()
+        request.body = body
         request.headers['content-type'] = (
-            'multipart/mixed; boundary="%s"') % message.get_boundary()
+            'multipart/mixed; boundary="%s"') % self.__boundary
 
         response = http_wrapper.MakeRequest(http, request)
 
         if response.status_code >= 300:
             raise exceptions.HttpError.FromResponse(response)
 
-        # Prepend with a content-type header so Parser can handle it.
-        header = 'content-type: %s\r\n\r\n' % response.info['content-type']
-
-        content = response.content
-        if isinstance(content, bytes) and self.__response_encoding:
-            content = response.content.decode(self.__response_encoding)
-
-        parser = email_parser.Parser()
-        mime_response = parser.parsestr(header + content)
-
-        if not mime_response.is_multipart():
+        boundary = _GetBoundary(response.info['content-type'])
+        if boundary is None:
             raise exceptions.BatchError(
                 'Response not in multipart/mixed format.')
 
-        for part in mime_response.get_payload():
-            request_id = self._ConvertHeaderToId(part['Content-ID'])
-            response = self._DeserializeResponse(part.get_payload())
+        # Split the raw content, and only decode each part once found.
+        content = response.content
+        encoding = self.__response_encoding or 'utf-8'
+        for part in _SplitMultipart(content, boundary):
+            if isinstance(part, bytes):
+                part = part.decode(encoding)
+            headers, payload = _ParseHeaders(part)
+            content_id = None
+            for name, value in headers:
+                if name.lower() == 'content-id':
+                    content_id = value
+                    break
+            request_id = self._ConvertHeaderToId(content_id)
+            response = self._DeserializeResponse(payload)
 
             # Disable protected access because namedtuple._replace(...)
             # is not actually meant to be protected.
@@ -504,3 +1068,217 @@ class BatchHttpRequest(object):
                 callback(response, exception)
             if self.__callback is not None:
                 self.__callback(response, exception)
+
+
+class _RawResponseService(object):
+
+    """Stands in for a service, leaving responses unprocessed."""
+
+    def ProcessHttpResponse(self, unused_method_config, http_response):
+        return http_response
+
+
+class AutoBatcher(object):
+
+    """Collects individual API calls from any thread and batches them.
+
+    Once set as the auto_batcher of a client, calls to its methods that
+    don't upload or download media are queued here instead of being sent
+    right away. The queue is sent as one batch request once it holds
+    max_batch_size calls, or max_delay seconds after the first of them
+    was queued, whichever comes first. Each caller blocks until its own
+    response is back, so call sites don't change:
+
+      client.auto_batcher = batch.AutoBatcher(http)
+      # Calls from many threads are now sent together.
+      client.objects.Get(request)
+
+    Batches are sent one at a time from a background thread, using http
+    only from that thread. Parts that fail with a retryable code are
+    retried within later batches.
+    """
+
+    def __init__(self, http, batch_url=None, max_batch_size=100,
+                 max_delay=0.05, retryable_codes=None, response_encoding=None,
+                 max_retries=5, sleep_between_polls=1, max_retry_wait=60,
+                 sizing_policy=None):
+        """Initialize an AutoBatcher.
+
+        Args:
+          http: httplib2.Http object for the batch requests.
+          batch_url: URL to send batch requests to. Defaults to the batch
+              endpoint of the client each call is made with.
+          max_batch_size: The most calls to send in one batch.
+          max_delay: Seconds to wait for more calls before sending a batch.
+          retryable_codes: A list of integer HTTP codes that can be retried.
+              Defaults to 429 and the 5xx codes that are usually transient.
+          response_encoding: The encoding type of response content.
+          max_retries: Max number of times to send each call.
+          sleep_between_polls: Seconds to wait before the first retry of a
+              call.
+          max_retry_wait: Upper bound in seconds for the wait between
+              retries of a call.
+          sizing_policy: (BatchSizingPolicy, optional) Splits the calls
+              collected for a batch further, for instance by size.
+
+        Raises:
+          InvalidUserInputError: if max_batch_size is not positive.
+          NotYetImplementedError: if concurrent.futures is not available.
+        """
+        if futures is None:
+            raise exceptions.NotYetImplementedError(
+                'AutoBatcher requires concurrent.futures')
+        if max_batch_size < 1:
+            raise exceptions.InvalidUserInputError(
+                'max_batch_size must be positive')
+        self.__http = http
+        self.__batch_url = batch_url
+        self.__max_batch_size = max_batch_size
+        self.__max_delay = max_delay
+        if retryable_codes is None:
+            retryable_codes = [429, http_client.INTERNAL_SERVER_ERROR,
+                               http_client.BAD_GATEWAY,
+                               http_client.SERVICE_UNAVAILABLE,
+                               http_client.GATEWAY_TIMEOUT]
+        self.__retryable_codes = retryable_codes
+        self.__response_encoding = response_encoding
+        self.__max_retries = max_retries
+        self.__sleep_between_polls = sleep_between_polls
+        self.__max_retry_wait = max_retry_wait
+        self.__sizing_policy = sizing_policy
+
+        self.__condition = threading.Condition()
+        # List of (http_request, future) pairs waiting to be sent.
+        self.__pending = []
+        # Time by which the pending calls are sent.
+        self.__deadline = None
+        self.__closed = False
+        self.__thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Submit(self, http_request, batch_url=None):
+        """Queue a request for the next batch.
+
+        Only requests with the same batch URL are sent in one batch.
+
+        Args:
+          http_request: An http_wrapper.Request object.
+          batch_url: URL of the batch endpoint for this request, used if
+              the AutoBatcher has no batch_url of its own.
+
+        Returns:
+          A concurrent.futures.Future for the http_wrapper.Response. Use
+          asyncio.wrap_future to await it from a coroutine.
+
+        Raises:
+          InvalidUserInputError: if the AutoBatcher is closed.
+        """
+        future = futures.Future()
+        with self.__condition:
+            if self.__closed:
+                raise exceptions.InvalidUserInputError(
+                    'Cannot submit requests to a closed AutoBatcher')
+            if not self.__pending:
+                self.__deadline = time.time() + self.__max_delay
+            self.__pending.append(
+                (http_request, future, self.__batch_url or batch_url))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__FlushLoop)
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify_all()
+        return future
+
+    def Flush(self):
+        """Send the queued requests now, and wait for their responses."""
+        with self.__condition:
+            pending = [future for _, future, _ in self.__pending]
+            self.__deadline = time.time()
+            self.__condition.notify_all()
+        futures.wait(pending)
+
+    def Close(self):
+        """Send the queued requests and stop accepting new ones."""
+        with self.__condition:
+            self.__closed = True
+            thread = self.__thread
+            self.__condition.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def __NextBatch(self):
+        """Wait for a batch to be due and take it, or None when closed."""
+        with self.__condition:
+            while True:
+                if self.__pending and (
+                        self.__closed or
+                        len(self.__pending) >= self.__max_batch_size or
+                        time.time() >= self.__deadline):
+                    break
+                if self.__closed:
+                    return None
+                timeout = None
+                if self.__pending:
+                    timeout = self.__deadline - time.time()
+                self.__condition.wait(timeout)
+            # Take the oldest calls sharing the batch URL of the first.
+            batch_url = self.__pending[0][2]
+            batch = []
+            rest = []
+            for http_request, future, url in self.__pending:
+                if (url == batch_url and
+                        len(batch) < self.__max_batch_size):
+                    batch.append((http_request, future))
+                else:
+                    rest.append((http_request, future, url))
+            self.__pending = rest
+            return batch_url, batch
+
+    def __FlushLoop(self):
+        while True:
+            next_batch = self.__NextBatch()
+            if next_batch is None:
+                return
+            self.__SendBatch(*next_batch)
+
+    def __SendBatch(self, batch_url, batch):
+        """Send a batch, and resolve the future of each of its requests."""
+        batch_api_request = BatchApiRequest(
+            batch_url=batch_url,
+            retryable_codes=self.__retryable_codes,
+            response_encoding=self.__response_encoding)
+        calls = []
+        for http_request, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            api_call = BatchApiRequest.ApiCall(
+                http_request, batch_api_request.retryable_codes,
+                _RawResponseService(), None)
+            batch_api_request.api_requests.append(api_call)
+            calls.append((api_call, future))
+        if not calls:
+            return
+
+        try:
+            batch_api_request.Execute(
+                self.__http, sleep_between_polls=self.__sleep_between_polls,
+                max_retries=self.__max_retries,
+                max_retry_wait=self.__max_retry_wait,
+                sizing_policy=self.__sizing_policy)
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future in calls:
+                future.set_exception(e)
+            return
+
+        for api_call, future in calls:
+            if api_call.http_response is None:
+                future.set_exception(exceptions.BatchError(
+                    'No response for request to %s' %
+                    api_call.http_request.url))
+            else:
+                future.set_result(api_call.http_response)
@@ -15,7 +15,13 @@
 
 """Tests for apitools.base.py.batch."""
 
+import email.parser as email_parser
+import random
+import re
+import string
 import textwrap
+import threading
+import time
 import unittest
 
 import mock
@@ -333,6 +339,295 @@ class BatchTest(unittest.TestCase):
             self.assertEqual('content', response.content)
             self.assertEqual(desired_url, response.request_url)
 
+    def _RespondToBatch(self, request, status=200, retry_after=None):
+        """Build a batch response echoing the path of each sub-request.
+
+        Args:
+          request: The batch request.
+          status: The status of every part, or a dict from path to status
+              for parts that aren't 200 OK.
+          retry_after: A dict from path to the Retry-After of that part.
+
+        Returns:
+          The batch response.
+        """
+        boundary = batch._GetBoundary(request.headers['content-type'])
+        parts = []
+        for part in batch._SplitMultipart(
+                request.body.decode('utf-8'), boundary):
+            headers, payload = batch._ParseHeaders(part)
+            content_id = dict((name.lower(), value)
+                              for name, value in headers)['content-id']
+            path = payload.split(' ')[1]
+            part_status = status
+            if isinstance(status, dict):
+                part_status = status.get(path, 200)
+            part_headers = ''
+            if retry_after and path in retry_after:
+                part_headers = 'Retry-After: %d\n' % retry_after[path]
+            parts.append(
+                'content-id: %s\n\nHTTP/1.1 %d X\n%s\n%s' % (
+                    content_id, part_status, part_headers, path))
+        return http_wrapper.Response(
+            info={
+                'status': '200',
+                'content-type': 'multipart/mixed; boundary="b"',
+            },
+            content='--b\n%s\n--b--' % '\n--b\n'.join(parts),
+            request_url=None)
+
+    def _AddPathRequests(self, batch_api_request, number_of_requests):
+        for i in range(number_of_requests):
+            batch_api_request.Add(FakeService(), 'unused', None, {
+                'desired_request': http_wrapper.Request(
+                    'https://www.example.com/%d' % i, 'GET', {}, None)})
+
+    def testConcurrentBatches(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com')
+        self._AddPathRequests(batch_api_request, 10)
+        lock = threading.Lock()
+        in_flight = [0]
+        max_in_flight = [0]
+        caller = threading.current_thread()
+        callback_threads = set()
+        callback_paths = []
+        https = []
+
+        def MakeRequest(http, request, **unused_kwds):
+            with lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            # Earlier batches finish last.
+            first_path = int(
+                request.body.decode('utf-8').split(' /', 1)[1].split(' ')[0])
+            time.sleep(0.01 * (10 - first_path))
+            with lock:
+                in_flight[0] -= 1
+            self.assertIn(http, https)
+            return self._RespondToBatch(request)
+
+        def HttpFactory():
+            http = FakeHttp()
+            https.append(http)
+            return http
+
+        def Callback(response, unused_exception):
+            callback_threads.add(threading.current_thread())
+            callback_paths.append(response.content)
+
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               side_effect=MakeRequest) as mock_request:
+            api_request_responses = batch_api_request.Execute(
+                FakeHttp(), max_batch_size=2,
+                batch_request_callback=Callback, max_concurrent_batches=3,
+                http_factory=HttpFactory)
+
+        self.assertEqual(5, mock_request.call_count)
+        self.assertEqual(3, max_in_flight[0])
+        self.assertEqual(3, len(https))
+        self.assertEqual(['/%d' % i for i in range(10)],
+                         [api_request.response.content
+                          for api_request in api_request_responses])
+        self.assertEqual(['/%d' % i for i in range(10)], callback_paths)
+        self.assertEqual(set([caller]), callback_threads)
+
+    def testConcurrentBatchesRefreshCredentialsOnce(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com')
+        self._AddPathRequests(batch_api_request, 8)
+        credentials = FakeCredentials()
+        sent = threading.Condition()
+        num_sent = [0]
+
+        def MakeRequest(unused_http, request, **unused_kwds):
+            with sent:
+                num_sent[0] += 1
+                first_round = num_sent[0] <= 4
+                sent.notify_all()
+                # Hold the first round until all of its batches are sent,
+                # so they all fail with the same credentials.
+                while first_round and num_sent[0] < 4:
+                    sent.wait(1)
+            return self._RespondToBatch(
+                request, status=401 if first_round else 200)
+
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               side_effect=MakeRequest) as mock_request:
+            api_request_responses = batch_api_request.Execute(
+                FakeHttp(credentials=credentials), sleep_between_polls=0,
+                max_batch_size=2, max_concurrent_batches=4,
+                http_factory=FakeHttp)
+
+        self.assertEqual(8, mock_request.call_count)
+        self.assertEqual(1, credentials.num_refreshes)
+        self.assertFalse(any(api_request.is_error
+                             for api_request in api_request_responses))
+
+    def _ExecuteWithFakeClock(self, batch_api_request, responses, **kwds):
+        """Execute, answering with responses and recording the sleeps.
+
+        Args:
+          batch_api_request: The BatchApiRequest to execute.
+          responses: A list of (status, retry_after) arguments for
+              _RespondToBatch, one per batch request.
+          **kwds: Passed on to Execute.
+
+        Returns:
+          The paths sent in each batch, and the (start time, duration) of
+          each sleep.
+        """
+        clock = [1000.0]
+        sleeps = []
+        batches = []
+        responses = list(responses)
+
+        def Sleep(seconds):
+            sleeps.append((clock[0], seconds))
+            clock[0] += seconds
+
+        def MakeRequest(unused_http, request, **unused_kwds):
+            batches.append(re.findall(
+                r'^GET (\S+) ', request.body.decode('utf-8'),
+                flags=re.MULTILINE))
+            status, retry_after = responses.pop(0)
+            return self._RespondToBatch(request, status, retry_after)
+
+        with mock.patch.object(batch, 'time') as mock_time, \
+                mock.patch.object(batch.random, 'uniform', return_value=0), \
+                mock.patch.object(http_wrapper, 'MakeRequest',
+                                  side_effect=MakeRequest):
+            mock_time.time.side_effect = lambda: clock[0]
+            mock_time.sleep.side_effect = Sleep
+            batch_api_request.Execute(FakeHttp(), **kwds)
+        return batches, sleeps
+
+    def testRetryHonorsRetryAfter(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com', retryable_codes=[503])
+        self._AddPathRequests(batch_api_request, 2)
+
+        batches, sleeps = self._ExecuteWithFakeClock(
+            batch_api_request, [({'/0': 503}, {'/0': 7}), (200, None)])
+
+        self.assertEqual([['/0', '/1'], ['/0']], batches)
+        self.assertEqual([(1000.0, 7)], sleeps)
+        self.assertEqual(['/0', '/1'], [
+            api_request.response.content
+            for api_request in batch_api_request.api_requests])
+
+    def testRetryBacksOffExponentially(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com', retryable_codes=[500])
+        self._AddPathRequests(batch_api_request, 1)
+
+        batches, sleeps = self._ExecuteWithFakeClock(
+            batch_api_request, [(500, None)] * 5, sleep_between_polls=2,
+            max_retries=5, max_retry_wait=10)
+
+        self.assertEqual([['/0']] * 5, batches)
+        self.assertEqual([2, 4, 8, 10], [wait for _, wait in sleeps])
+        self.assertTrue(batch_api_request.api_requests[0].is_error)
+
+    def testDueRetriesJoinUnsentRequests(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com', retryable_codes=[503])
+        self._AddPathRequests(batch_api_request, 5)
+
+        batches, sleeps = self._ExecuteWithFakeClock(
+            batch_api_request, [
+                ({'/0': 503, '/1': 503}, {'/0': 0, '/1': 30}),
+                (200, None),
+                (200, None),
+                (200, None),
+            ], max_batch_size=2)
+
+        # /0 is due again right away, and /1 only once nothing else is left.
+        self.assertEqual(
+            [['/0', '/1'], ['/0', '/2'], ['/3', '/4'], ['/1']], batches)
+        self.assertEqual([(1000.0, 30)], sleeps)
+        self.assertFalse(any(
+            api_request.is_error
+            for api_request in batch_api_request.api_requests))
+
+    def testBatchesPackedByBytes(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com')
+        for i, body_size in enumerate([400, 400, 900, 100, 100]):
+            batch_api_request.Add(FakeService(), 'unused', None, {
+                'desired_request': http_wrapper.Request(
+                    'https://www.example.com/%d' % i, 'GET', {},
+                    'x' * body_size)})
+        batches = []
+
+        def MakeRequest(unused_http, request, **unused_kwds):
+            batches.append(re.findall(
+                r'^GET (\S+) ', request.body.decode('utf-8'),
+                flags=re.MULTILINE))
+            return self._RespondToBatch(request)
+
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               side_effect=MakeRequest):
+            batch_api_request.Execute(
+                FakeHttp(), sizing_policy=batch.FixedBatchSizingPolicy(
+                    max_requests=2, max_bytes=1400))
+
+        # The third request alone is over budget, and is sent on its own.
+        self.assertEqual([['/0', '/1'], ['/2'], ['/3', '/4']], batches)
+
+    def testSplitsBatchRejectedAsTooLarge(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com')
+        self._AddPathRequests(batch_api_request, 5)
+        sizing_policy = batch.AdaptiveBatchSizingPolicy(initial_requests=5)
+        batches = []
+        callback_paths = []
+
+        def MakeRequest(unused_http, request, **unused_kwds):
+            paths = re.findall(r'^GET (\S+) ', request.body.decode('utf-8'),
+                               flags=re.MULTILINE)
+            batches.append(paths)
+            if len(paths) > 2:
+                return http_wrapper.Response(
+                    {'status': '413'}, 'Too large', request.url)
+            return self._RespondToBatch(request)
+
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               side_effect=MakeRequest):
+            api_request_responses = batch_api_request.Execute(
+                FakeHttp(), sizing_policy=sizing_policy,
+                batch_request_callback=lambda response, _: (
+                    callback_paths.append(response.content)))
+
+        self.assertEqual([['/0', '/1', '/2', '/3', '/4'],
+                          ['/0', '/1'],
+                          ['/2', '/3', '/4'],
+                          ['/2'],
+                          ['/3', '/4']], batches)
+        self.assertEqual(['/%d' % i for i in range(5)], callback_paths)
+        self.assertEqual(['/%d' % i for i in range(5)],
+                         [api_request.response.content
+                          for api_request in api_request_responses])
+        self.assertLess(sizing_policy.byte_limit, 8 << 20)
+
+    def testSingleRequestTooLarge(self):
+        batch_api_request = batch.BatchApiRequest(
+            batch_url='https://www.example.com')
+        self._AddPathRequests(batch_api_request, 1)
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as mock_request:
+            mock_request.return_value = http_wrapper.Response(
+                {'status': '413'}, 'Too large', 'https://www.example.com')
+            self.assertRaises(
+                exceptions.HttpError, batch_api_request.Execute, FakeHttp(),
+                sizing_policy=batch.AdaptiveBatchSizingPolicy())
+
+    def testInvalidMaxConcurrentBatches(self):
+        batch_api_request = batch.BatchApiRequest()
+        self.assertRaises(
+            exceptions.InvalidUserInputError, batch_api_request.Execute,
+            FakeHttp(), max_concurrent_batches=0)
+
     def testNoAttempts(self):
         desired_url = 'https://www.example.com'
         batch_api_request = batch.BatchApiRequest(batch_url=desired_url)
@@ -393,11 +688,29 @@ class BatchTest(unittest.TestCase):
             'Host: ',
             '',
             'Hello World',
-        ])
+        ]).encode('utf-8')
         batch_request = batch.BatchHttpRequest('https://www.example.com')
         self.assertEqual(expected_serialized_request,
                          batch_request._SerializeRequest(request))
 
+    def testSerializeRequestBytesBody(self):
+        body = u'caf\xe9'.encode('utf-8')
+        request = http_wrapper.Request(body=body, headers={
+            'content-type': 'protocol/version',
+        })
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        serialized = batch_request._SerializeRequest(request)
+        self.assertTrue(serialized.endswith(b'\n\n' + body))
+
+    def testSerializeRequestBinaryBody(self):
+        body = b'\xff\xfe\x00\x80'
+        request = http_wrapper.Request(body=body, headers={
+            'content-type': 'application/octet-stream',
+        })
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        serialized = batch_request._SerializeRequest(request)
+        self.assertTrue(serialized.endswith(b'\n\n' + body))
+
     def testSerializeRequestPreservesHeaders(self):
         # Now confirm that if an additional, arbitrary header is added
         # that it is successfully serialized to the request. Merely
@@ -409,7 +722,7 @@ class BatchTest(unittest.TestCase):
         })
         batch_request = batch.BatchHttpRequest('https://www.example.com')
         self.assertTrue(
-            'key: value\n' in batch_request._SerializeRequest(request))
+            b'key: value\n' in batch_request._SerializeRequest(request))
 
     def testSerializeRequestNoBody(self):
         request = http_wrapper.Request(body=None, headers={
@@ -422,7 +735,7 @@ class BatchTest(unittest.TestCase):
             'Host: ',
             '',
             '',
-        ])
+        ]).encode('utf-8')
         batch_request = batch.BatchHttpRequest('https://www.example.com')
         self.assertEqual(expected_serialized_request,
                          batch_request._SerializeRequest(request))
@@ -440,11 +753,100 @@ class BatchTest(unittest.TestCase):
             'Host: ',
             '',
             'Hello World',
-        ])
+        ]).encode('utf-8')
         batch_request = batch.BatchHttpRequest('https://www.example.com')
         self.assertEqual(expected_serialized_request,
                          batch_request._SerializeRequest(request))
 
+    def testSerializeRequestEncodesNonAsciiHeaders(self):
+        request = http_wrapper.Request(body='Hello World', headers={
+            'content-type': 'protocol/version',
+            'key': u'caf\xe9',
+        })
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        self.assertIn(b'key: =?utf-8?b?Y2Fmw6k=?=\n',
+                      batch_request._SerializeRequest(request))
+
+    def _CaptureBatchRequest(self, batch_request):
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as mock_request:
+            mock_request.return_value = http_wrapper.Response(
+                {'status': '300'}, None, None)
+            self.assertRaises(
+                exceptions.HttpError, batch_request._Execute, None)
+            return mock_request.call_args[0][1]
+
+    def testInternalExecuteSerializesParts(self):
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        batch_request._BatchHttpRequest__base_id = 'base'
+        batch_request.Add(http_wrapper.Request(
+            'https://www.example.com/a?b=c', 'POST',
+            {'content-type': 'application/json'}, '{"x": 1}'))
+        batch_request.Add(http_wrapper.Request(
+            'https://www.example.com/d', 'GET', {}, None))
+
+        request = self._CaptureBatchRequest(batch_request)
+
+        boundary = batch._GetBoundary(request.headers['content-type'])
+        self.assertEqual('\n'.join([
+            '--' + boundary,
+            'Content-Type: application/http',
+            'MIME-Version: 1.0',
+            'Content-Transfer-Encoding: binary',
+            'Content-ID: <base+0>',
+            '',
+            'POST /a?b=c HTTP/1.1',
+            'Content-Type: application/json',
+            'MIME-Version: 1.0',
+            'content-length: 8',
+            'Host: www.example.com',
+            '',
+            '{"x": 1}',
+            '--' + boundary,
+            'Content-Type: application/http',
+            'MIME-Version: 1.0',
+            'Content-Transfer-Encoding: binary',
+            'Content-ID: <base+1>',
+            '',
+            'GET /d HTTP/1.1',
+            'Content-Type: application/json',
+            'MIME-Version: 1.0',
+            'Host: www.example.com',
+            '',
+            '',
+            '--%s--' % boundary,
+            '',
+        ]).encode('utf-8'), request.body)
+        self.assertEqual(str(len(request.body)),
+                         request.headers['content-length'])
+
+    def testInternalExecuteKeepsBinaryBody(self):
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        body = b'\xff\xfe\x00\x80'
+        batch_request.Add(http_wrapper.Request(
+            'https://www.example.com/a', 'POST',
+            {'content-type': 'application/octet-stream'}, body))
+
+        request = self._CaptureBatchRequest(batch_request)
+
+        boundary = batch._GetBoundary(request.headers['content-type'])
+        parts = batch._SplitMultipart(request.body, boundary)
+        self.assertEqual(1, len(parts))
+        self.assertTrue(parts[0].endswith(b'\n\n' + body))
+
+    def testInternalExecuteAvoidsBoundaryInParts(self):
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        boundary = batch_request._BatchHttpRequest__boundary
+        batch_request.Add(http_wrapper.Request(
+            'https://www.example.com', 'POST', {}, '--' + boundary))
+
+        request = self._CaptureBatchRequest(batch_request)
+
+        new_boundary = batch._GetBoundary(request.headers['content-type'])
+        self.assertNotEqual(boundary, new_boundary)
+        self.assertEqual(1, len(batch._SplitMultipart(
+            request.body, new_boundary)))
+
     def testDeserializeRequest(self):
         serialized_payload = '\n'.join([
             'GET  HTTP/1.1',
@@ -658,3 +1060,290 @@ class BatchTest(unittest.TestCase):
 
             # Global callback was called once per handler.
             self.assertEqual(len(test_requests), global_callback.call_count)
+
+
+def _RandomText(rand, max_length=20):
+    return ''.join(rand.choice(string.ascii_letters + string.digits + ' :-')
+                   for _ in range(rand.randint(0, max_length)))
+
+
+def _RandomBatchResponse(rand):
+    """Generate a multipart batch response with assorted irregularities."""
+    boundary = ''.join(rand.choice(string.ascii_letters + "0123456789=_-'")
+                       for _ in range(rand.randint(1, 12)))
+
+    def Newline():
+        return rand.choice(['\n', '\r\n'])
+
+    lines = []
+    if rand.random() < 0.3:
+        lines.append(_RandomText(rand) + Newline())
+    for i in range(rand.randint(0, 5)):
+        lines.append('--' + boundary + rand.choice(['', ' ', '\t ']) +
+                     Newline())
+        for _ in range(rand.randint(0, 3)):
+            lines.append('%s:%s%s%s' % (
+                rand.choice(['Content-Type', 'content-id', 'Content-ID',
+                             'X-Thing', '']),
+                rand.choice(['', ' ', '  ']),
+                rand.choice(['text/plain', '<id+%d>' % i,
+                             _RandomText(rand)]),
+                Newline()))
+            if rand.random() < 0.2:
+                lines.append(rand.choice([' ', '\t']) +
+                             _RandomText(rand) + Newline())
+        if rand.random() < 0.9:
+            lines.append(Newline())
+        lines.append('HTTP/1.1 %d OK%s' % (rand.choice([200, 404]),
+                                           Newline()))
+        for _ in range(rand.randint(0, 3)):
+            lines.append('%s: %s%s' % (rand.choice(['Content-Type', 'ETag']),
+                                       _RandomText(rand), Newline()))
+        if rand.random() < 0.8:
+            lines.append(Newline())
+        for _ in range(rand.randint(0, 4)):
+            lines.append(rand.choice([
+                _RandomText(rand), '--' + boundary + 'x', '--',
+                'x--' + boundary, '']) + Newline())
+    if rand.random() < 0.9:
+        lines.append('--' + boundary + '--' + rand.choice(['', ' ']) +
+                     rand.choice(['', Newline()]))
+        if rand.random() < 0.3:
+            lines.append(_RandomText(rand))
+    content_type = 'multipart/mixed; boundary=' + rand.choice(
+        ['"%s"' % boundary, boundary])
+    return content_type, ''.join(lines)
+
+
+class AdaptiveBatchSizingPolicyTest(unittest.TestCase):
+
+    def testGrowsAfterFullFastBatches(self):
+        policy = batch.AdaptiveBatchSizingPolicy(
+            initial_requests=10, max_requests=25, increase_requests=10)
+        policy.RecordBatch(5, 1000, 0.5, 0)
+        self.assertEqual(10, policy.request_limit)
+        policy.RecordBatch(10, 1000, 0.5, 0)
+        self.assertEqual(20, policy.request_limit)
+        policy.RecordBatch(20, 1000, 0.5, 0)
+        self.assertEqual((25, 8 << 20), policy.Limits())
+
+    def testShrinksAfterSlowBatches(self):
+        policy = batch.AdaptiveBatchSizingPolicy(
+            initial_requests=40, target_latency=5)
+        policy.RecordBatch(40, 1000, 6, 0)
+        self.assertEqual(20, policy.request_limit)
+
+    def testShrinksAfterFailures(self):
+        policy = batch.AdaptiveBatchSizingPolicy(
+            initial_requests=40, max_failure_rate=0.1)
+        policy.RecordBatch(40, 1000, 1, 4)
+        self.assertEqual(50, policy.request_limit)
+        policy.RecordBatch(50, 1000, 1, 6)
+        self.assertEqual(25, policy.request_limit)
+
+    def testTooLarge(self):
+        policy = batch.AdaptiveBatchSizingPolicy(
+            initial_requests=40, min_requests=2, max_bytes=1 << 20)
+        policy.RecordTooLarge(30, 100000)
+        self.assertEqual((15, 50000), policy.Limits())
+        for _ in range(5):
+            policy.RecordTooLarge(30, 100000)
+        self.assertEqual((2, 50000), policy.Limits())
+
+
+class BatchResponseParserTest(unittest.TestCase):
+
+    def _ParseWithEmail(self, content_type, content):
+        """Parse a batch response the way BatchHttpRequest used to."""
+        parser = email_parser.Parser()
+        mime_response = parser.parsestr(
+            'content-type: %s\r\n\r\n' % content_type + content)
+        if not mime_response.is_multipart():
+            return None
+        parts = []
+        for part in mime_response.get_payload():
+            payload = part.get_payload()
+            response = None
+            if '\n' in payload:
+                _, rest = payload.split('\n', 1)
+                msg = parser.parsestr(rest)
+                response = (dict(msg), msg.get_payload())
+            parts.append((part['Content-ID'], payload, response))
+        return parts
+
+    def _Parse(self, content_type, content):
+        boundary = batch._GetBoundary(content_type)
+        if boundary is None:
+            return None
+        try:
+            raw_parts = batch._SplitMultipart(content, boundary)
+        except exceptions.BatchError:
+            return None
+        batch_request = batch.BatchHttpRequest('https://www.example.com')
+        parts = []
+        for raw_part in raw_parts:
+            headers, payload = batch._ParseHeaders(raw_part)
+            content_id = next((value for name, value in headers
+                               if name.lower() == 'content-id'), None)
+            response = None
+            if '\n' in payload:
+                http_response = batch_request._DeserializeResponse(payload)
+                info = dict(http_response.info)
+                del info['status']
+                response = (info, http_response.content)
+            parts.append((content_id, payload, response))
+        return parts
+
+    def testFuzzParityWithEmailParser(self):
+        rand = random.Random(1234)
+        for _ in range(1000):
+            content_type, content = _RandomBatchResponse(rand)
+            self.assertEqual(
+                self._ParseWithEmail(content_type, content),
+                self._Parse(content_type, content),
+                msg='Mismatch for %r' % content)
+
+    def testGetBoundary(self):
+        self.assertEqual(
+            'abc', batch._GetBoundary('multipart/mixed; boundary="abc"'))
+        self.assertEqual(
+            'a=b',
+            batch._GetBoundary('Multipart/Mixed;charset=x;BOUNDARY=a=b'))
+        self.assertIsNone(batch._GetBoundary('multipart/mixed'))
+        self.assertIsNone(batch._GetBoundary('text/plain; boundary=abc'))
+
+    def testSplitBytes(self):
+        content = b'preamble\r\n--b\r\nA: 1\r\n\r\nx\r\n--b--\r\n'
+        self.assertEqual([b'A: 1\r\n\r\nx'],
+                         batch._SplitMultipart(content, 'b'))
+
+    def testMissingOpeningBoundary(self):
+        for content in ('', 'no boundary', '--b--\n--b\n\nx\n--b--'):
+            with self.assertRaises(exceptions.BatchError):
+                batch._SplitMultipart(content, 'b')
+
+
+class AutoBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.batch_urls = []
+        self.batches_lock = threading.Lock()
+        patcher = mock.patch.object(http_wrapper, 'MakeRequest',
+                                    side_effect=self._MakeRequest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _MakeRequest(self, unused_http, request, **unused_kwds):
+        """Answer each part with its path, or 404 for paths with 'missing'."""
+        boundary = batch._GetBoundary(request.headers['content-type'])
+        paths = []
+        parts = []
+        for part in batch._SplitMultipart(
+                request.body.decode('utf-8'), boundary):
+            headers, payload = batch._ParseHeaders(part)
+            content_id = dict((name.lower(), value)
+                              for name, value in headers)['content-id']
+            path = payload.split(' ')[1]
+            paths.append(path)
+            status = 404 if 'missing' in path else 200
+            parts.append('content-id: %s\n\nHTTP/1.1 %d X\n\n%s' % (
+                content_id, status, path))
+        with self.batches_lock:
+            self.batches.append(paths)
+            self.batch_urls.append(request.url)
+        return http_wrapper.Response(
+            info={
+                'status': '200',
+                'content-type': 'multipart/mixed; boundary="b"',
+            },
+            content='--b\n%s\n--b--' % '\n--b\n'.join(parts),
+            request_url=None)
+
+    def _Request(self, path):
+        return http_wrapper.Request('https://www.example.com' + path, 'GET')
+
+    def testBatchesCallsFromManyThreads(self):
+        results = {}
+
+        def Call(i):
+            results[i] = auto_batcher.Submit(
+                self._Request('/%d' % i)).result().content
+
+        with batch.AutoBatcher(FakeHttp(), max_delay=0.5,
+                               max_batch_size=10) as auto_batcher:
+            threads = [threading.Thread(target=Call, args=(i,))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual(set('/%d' % i for i in range(10)),
+                         set(self.batches[0]))
+        self.assertEqual(dict((i, '/%d' % i) for i in range(10)), results)
+
+    def testSendsFullBatchesWithoutWaiting(self):
+        auto_batcher = batch.AutoBatcher(
+            FakeHttp(), max_delay=60, max_batch_size=2)
+        calls = [auto_batcher.Submit(self._Request('/%d' % i))
+                 for i in range(4)]
+        self.assertEqual(['/0', '/1', '/2', '/3'],
+                         [call.result(10).content for call in calls])
+        self.assertEqual([['/0', '/1'], ['/2', '/3']], self.batches)
+        auto_batcher.Close()
+
+    def testUsesBatchUrlOfEachCall(self):
+        auto_batcher = batch.AutoBatcher(FakeHttp(), max_delay=60)
+        calls = [
+            auto_batcher.Submit(self._Request('/a0'),
+                                batch_url='https://a.example.com/batch'),
+            auto_batcher.Submit(self._Request('/b0'),
+                                batch_url='https://b.example.com/batch'),
+            auto_batcher.Submit(self._Request('/a1'),
+                                batch_url='https://a.example.com/batch'),
+        ]
+        auto_batcher.Close()
+        self.assertEqual(['/a0', '/b0', '/a1'],
+                         [call.result(0).content for call in calls])
+        self.assertEqual([['/a0', '/a1'], ['/b0']], self.batches)
+        self.assertEqual(['https://a.example.com/batch',
+                          'https://b.example.com/batch'], self.batch_urls)
+
+    def testBatchUrlOverridesBatchUrlOfCalls(self):
+        auto_batcher = batch.AutoBatcher(
+            FakeHttp(), batch_url='https://www.example.com/batch',
+            max_delay=60)
+        auto_batcher.Submit(self._Request('/a'),
+                            batch_url='https://a.example.com/batch')
+        auto_batcher.Submit(self._Request('/b'))
+        auto_batcher.Close()
+        self.assertEqual([['/a', '/b']], self.batches)
+        self.assertEqual(['https://www.example.com/batch'], self.batch_urls)
+
+    def testFlushAndClose(self):
+        auto_batcher = batch.AutoBatcher(FakeHttp(), max_delay=60)
+        first = auto_batcher.Submit(self._Request('/first'))
+        auto_batcher.Flush()
+        self.assertTrue(first.done())
+        second = auto_batcher.Submit(self._Request('/second'))
+        auto_batcher.Close()
+        self.assertEqual('/second', second.result(0).content)
+        self.assertEqual([['/first'], ['/second']], self.batches)
+        self.assertRaises(exceptions.InvalidUserInputError,
+                          auto_batcher.Submit, self._Request('/third'))
+
+    def testErrorResponsesAreReturned(self):
+        with batch.AutoBatcher(FakeHttp(), max_delay=0) as auto_batcher:
+            response = auto_batcher.Submit(
+                self._Request('/missing')).result(10)
+        self.assertEqual(404, response.status_code)
+
+    def testTransportErrorFailsEveryCall(self):
+        http_wrapper.MakeRequest.side_effect = ValueError('broken')
+        with batch.AutoBatcher(FakeHttp(), max_delay=60) as auto_batcher:
+            calls = [auto_batcher.Submit(self._Request('/%d' % i))
+                     for i in range(3)]
+        for call in calls:
+            self.assertIsInstance(call.exception(0), ValueError)
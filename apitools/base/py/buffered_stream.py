@@ -27,14 +27,40 @@ class BufferedStream(object):
 
     """Buffers a stream, reading ahead to determine if we're at the end."""
 
-    def __init__(self, stream, start, size):
+    def __init__(self, stream, start, size, buffer=None):
+        """Read up to size bytes from stream.
+
+        Args:
+          stream: The stream to buffer.
+          start: Position of stream when this buffer was created.
+          size: Number of bytes to read ahead.
+          buffer: (bytearray, optional) A reusable buffer of at least
+              size bytes. If provided and stream supports readinto, data
+              is read directly into it and read() returns memoryview
+              slices of it instead of copies. The buffer must not be
+              reused while this object is still being read.
+        """
         self.__stream = stream
         self.__start_pos = start
         self.__buffer_pos = 0
-        self.__buffered_data = self.__stream.read(size)
+        if buffer is not None and hasattr(stream, 'readinto'):
+            self.__buffered_data = self.__ReadInto(buffer, size)
+        else:
+            self.__buffered_data = self.__stream.read(size)
         self.__stream_at_end = len(self.__buffered_data) < size
         self.__end_pos = self.__start_pos + len(self.__buffered_data)
 
+    def __ReadInto(self, buffer, size):
+        """Fill buffer with up to size bytes, returning a view of them."""
+        view = memoryview(buffer)[:size]
+        filled = 0
+        while filled < size:
+            num_read = self.__stream.readinto(view[filled:])
+            if not num_read:
+                break
+            filled += num_read
+        return view[:filled]
+
     def __str__(self):
         return ('Buffered stream %s from position %s-%s with %s '
                 'bytes remaining' % (self.__stream, self.__start_pos,
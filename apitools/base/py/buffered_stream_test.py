@@ -65,3 +65,20 @@ class BufferedStreamTest(unittest.TestCase):
             bs.read()
         with self.assertRaises(exceptions.NotYetImplementedError):
             bs.read(size=-1)
+
+    def testReusableBuffer(self):
+        stream = six.BytesIO(self.value.encode('ascii'))
+        buf = bytearray(20)
+        bs = buffered_stream.BufferedStream(stream, 0, 20, buffer=buf)
+        self.assertEqual(20, bs.stream_end_position)
+        self.assertFalse(bs.stream_exhausted)
+        data = bs.read(20)
+        self.assertIsInstance(data, memoryview)
+        self.assertIs(buf, data.obj)
+        self.assertEqual(self.value[:20].encode('ascii'), data.tobytes())
+
+        bs = buffered_stream.BufferedStream(stream, 20, 40, buffer=buf * 2)
+        self.assertEqual(len(self.value), bs.stream_end_position)
+        self.assertTrue(bs.stream_exhausted)
+        self.assertEqual(self.value[20:].encode('ascii'),
+                         bs.read(40).tobytes())
@@ -17,18 +17,30 @@
 """Compression support for apitools."""
 
 from collections import deque
+from multiprocessing import pool as multiprocessing_pool
+import os
+import struct
+import tempfile
+import threading
+import zlib
 
 from apitools.base.py import gzip
 
 __all__ = [
     'CompressStream',
+    'SampleCompressionRatio',
 ]
 
+# Size of the deflate window; each parallel block is primed with this much
+# of the input that precedes it.
+_DICTIONARY_SIZE = 32768
+
 
 # pylint: disable=invalid-name
 # Note: Apitools only uses the default chunksize when compressing.
 def CompressStream(in_stream, length=None, compresslevel=2,
-                   chunksize=16777216):
+                   chunksize=16777216, max_workers=None, blocksize=1048576,
+                   max_memory=None):
 
     """Compresses an input stream into a file-like buffer.
 
@@ -60,15 +72,26 @@ def CompressStream(in_stream, length=None, compresslevel=2,
         chunksize: Optional, defaults to 16MiB. The chunk size used when
             reading data from the input stream to write into the output
             buffer.
+        max_workers: Optional. If greater than 1, each chunk is split into
+            blocks of blocksize bytes which are deflated concurrently on
+            this many threads. The output is still a single gzip member.
+        blocksize: Optional, defaults to 1MiB. The size of the blocks
+            compressed independently when max_workers is set.
+        max_memory: Optional. If set, compressed bytes beyond this many are
+            spilled from memory to a temporary file.
 
     Returns:
         A file-like output buffer of compressed bytes, the number of bytes read
         from the input stream, and a flag denoting if the input stream was
         exhausted.
     """
+    if max_workers is not None and max_workers > 1:
+        return _ParallelCompressStream(in_stream, length, compresslevel,
+                                       chunksize, max_workers, blocksize,
+                                       max_memory)
     in_read = 0
     in_exhausted = False
-    out_stream = StreamingBuffer()
+    out_stream = StreamingBuffer(max_memory=max_memory)
     with gzip.GzipFile(mode='wb',
                        fileobj=out_stream,
                        compresslevel=compresslevel) as compress_stream:
@@ -85,6 +108,150 @@ def CompressStream(in_stream, length=None, compresslevel=2,
     return out_stream, in_read, in_exhausted
 
 
+def _DeflateBlock(args):
+    """Deflates one block, primed with the input that precedes it.
+
+    The block is ended with a sync flush rather than a final block, so that
+    the outputs of consecutive blocks can be concatenated into one raw
+    deflate stream.
+    """
+    block, dictionary, compresslevel = args
+    if dictionary:
+        compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _GzipHeader(compresslevel):
+    """Returns a gzip member header with no file name or mtime."""
+    if compresslevel == 9:
+        extra_flags = 2
+    elif compresslevel == 1:
+        extra_flags = 4
+    else:
+        extra_flags = 0
+    # Magic, deflate method, no flags, zero mtime, extra flags, unknown OS.
+    return struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, extra_flags, 255)
+
+
+# Thread pools shared by all parallel compressions, by number of workers.
+# Pools are kept for the life of the process, since starting threads for
+# every body costs more than compressing a small one.
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def _GetThreadPool(max_workers):
+    """Returns the shared thread pool with max_workers threads."""
+    with _thread_pools_lock:
+        pid, thread_pool = _thread_pools.get(max_workers, (None, None))
+        # The threads of a pool don't survive a fork.
+        if pid != os.getpid():
+            thread_pool = multiprocessing_pool.ThreadPool(max_workers)
+            _thread_pools[max_workers] = (os.getpid(), thread_pool)
+        return thread_pool
+
+
+def _ParallelCompressStream(in_stream, length, compresslevel, chunksize,
+                            max_workers, blocksize, max_memory):
+    """Compresses an input stream using a pool of threads.
+
+    This follows the approach of pigz: every block is deflated on its own,
+    using the last 32KiB of the preceding input as a preset dictionary, and
+    the raw deflate outputs are concatenated in order inside one gzip member.
+    zlib releases the GIL while compressing, so threads are sufficient. The
+    CRC of the input is computed in this thread while the blocks compress.
+
+    See CompressStream for a description of the arguments and return value.
+    """
+    in_read = 0
+    in_exhausted = False
+    crc = zlib.crc32(b'')
+    dictionary = b''
+    out_stream = StreamingBuffer(max_memory=max_memory)
+    out_stream.write(_GzipHeader(compresslevel))
+    # Read until we've written at least length bytes to the output stream.
+    while not length or out_stream.length < length:
+        data = in_stream.read(chunksize)
+        data_length = len(data)
+        view = memoryview(data)
+        jobs = []
+        for start in range(0, data_length, blocksize):
+            block = view[start:start + blocksize]
+            jobs.append((block, dictionary, compresslevel))
+            if len(block) >= _DICTIONARY_SIZE:
+                dictionary = block[-_DICTIONARY_SIZE:].tobytes()
+            else:
+                dictionary = (dictionary +
+                              block.tobytes())[-_DICTIONARY_SIZE:]
+        if len(jobs) > 1:
+            result = _GetThreadPool(max_workers).map_async(
+                _DeflateBlock, jobs)
+            crc = zlib.crc32(data, crc)
+            compressed_blocks = result.get()
+        else:
+            # Not worth handing a single block to another thread.
+            compressed_blocks = [_DeflateBlock(job) for job in jobs]
+            crc = zlib.crc32(data, crc)
+        in_read += data_length
+        for compressed in compressed_blocks:
+            out_stream.write(compressed)
+        # If we read less than requested, the stream is exhausted.
+        if data_length < chunksize:
+            in_exhausted = True
+            break
+    # Close the deflate stream with an empty final block, then append the
+    # gzip trailer.
+    out_stream.write(zlib.compressobj(
+        compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+    out_stream.write(struct.pack('<II', crc & 0xffffffff,
+                                 in_read & 0xffffffff))
+    return out_stream, in_read, in_exhausted
+
+
+def SampleCompressionRatio(in_stream, sample_size=1048576, compresslevel=2):
+    """Estimates how well a stream compresses from its next bytes.
+
+    Up to sample_size bytes are read from the current position of in_stream
+    and deflated; the stream is then seeked back to where it started.
+
+    Args:
+        in_stream: A seekable input stream.
+        sample_size: Optional, defaults to 1MiB. The number of bytes to
+            sample.
+        compresslevel: Optional, defaults to 2. The compression level used
+            for the sample.
+
+    Returns:
+        The size of the compressed sample divided by the size of the sample,
+        or None if the stream can't be sampled (it is not seekable or there
+        are no bytes left to read).
+    """
+    # Make sure the stream can be rewound before reading from it, so that
+    # no bytes are lost if it can't.
+    try:
+        seekable = getattr(in_stream, 'seekable', None)
+        if seekable is not None and not seekable():
+            return None
+        start = in_stream.tell()
+        if seekable is None:
+            in_stream.seek(start)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    sample = in_stream.read(sample_size)
+    in_stream.seek(start)
+    if not sample:
+        return None
+    compressor = zlib.compressobj(compresslevel)
+    compressed_size = len(compressor.compress(sample))
+    compressed_size += len(compressor.flush())
+    return float(compressed_size) / len(sample)
+
+
 class StreamingBuffer(object):
 
     """Provides a file-like object that writes to a temporary buffer.
@@ -92,33 +259,113 @@ class StreamingBuffer(object):
     When data is read from the buffer, it is permanently removed. This is
     useful when there are memory constraints preventing the entire buffer from
     being stored in memory.
+
+    Data is held as a queue of the segments that were written. Reads take
+    bytes from the front segment without re-slicing or re-joining the
+    segments left behind, and readinto and readview avoid copying further.
+
+    If max_memory is set, once more than that many bytes are held in
+    memory, further writes go to a temporary file instead, until all of
+    the spilled data has been read back.
     """
 
-    def __init__(self):
+    def __init__(self, max_memory=None):
         # The buffer of byte arrays.
         self.__buf = deque()
-        # The number of bytes in __buf.
-        self.__size = 0
+        # The number of bytes already read from the first segment in __buf.
+        self.__offset = 0
+        # The number of bytes in __buf, excluding those read.
+        self.__memory_size = 0
+        # Spill file, and the offsets of the next read and write in it.
+        self.__max_memory = max_memory
+        self.__file = None
+        self.__file_read = 0
+        self.__file_write = 0
 
     def __len__(self):
-        return self.__size
+        return self.length
 
     def __nonzero__(self):
         # For 32-bit python2.x, len() cannot exceed a 32-bit number; avoid
         # accidental len() calls from httplib in the form of "if this_object:".
-        return bool(self.__size)
+        return bool(self.length)
+
+    __bool__ = __nonzero__
 
     @property
     def length(self):
         # For 32-bit python2.x, len() cannot exceed a 32-bit number.
-        return self.__size
+        return self.__memory_size + self.__file_write - self.__file_read
+
+    @property
+    def memory_size(self):
+        """The number of unread bytes held in memory."""
+        return self.__memory_size
 
     def write(self, data):
         # Gzip can write many 0 byte chunks for highly compressible data.
         # Prevent them from being added internally.
-        if data is not None and data:
+        if data is None or not data:
+            return
+        if self.__file_write > self.__file_read or (
+                self.__max_memory is not None and
+                self.__memory_size + len(data) > self.__max_memory):
+            # Once anything has been spilled, all later data has to follow
+            # it in the file to keep the bytes in order.
+            if self.__file is None:
+                self.__file = tempfile.TemporaryFile()
+            self.__file.seek(self.__file_write)
+            self.__file.write(data)
+            self.__file_write += len(data)
+        else:
             self.__buf.append(data)
-            self.__size += len(data)
+            self.__memory_size += len(data)
+
+    def readview(self, size=None):
+        """Read up to size bytes as a memoryview, without copying.
+
+        Unlike read, this returns at most the rest of one written segment,
+        so it may return fewer bytes than requested even when more are
+        available. The view is only valid until the buffer is next written
+        to.
+
+        Args:
+          size: If provided, read no more than size bytes from the buffer.
+
+        Returns:
+          A memoryview of the bytes read, which is empty once the buffer
+          is empty.
+        """
+        if not self.__buf:
+            return memoryview(self.__ReadFile(size))
+        segment = self.__buf[0]
+        available = len(segment) - self.__offset
+        if size is None or size > available:
+            size = available
+        view = memoryview(segment)[self.__offset:self.__offset + size]
+        self.__offset += size
+        self.__memory_size -= size
+        if self.__offset == len(segment):
+            self.__buf.popleft()
+            self.__offset = 0
+        return view
+
+    def readinto(self, b):
+        """Read bytes into the writable buffer b.
+
+        Args:
+          b: A writable bytes-like object.
+
+        Returns:
+          The number of bytes read into b.
+        """
+        out = memoryview(b)
+        filled = 0
+        while filled < len(out) and self.length:
+            view = self.readview(len(out) - filled)
+            out[filled:filled + len(view)] = view
+            filled += len(view)
+        return filled
 
     def read(self, size=None):
         """Read at most size bytes from this buffer.
@@ -132,16 +379,30 @@ class StreamingBuffer(object):
         Returns:
           The bytes read from this buffer.
         """
-        if size is None:
-            size = self.__size
-        ret_list = []
-        while size > 0 and self.__buf:
-            data = self.__buf.popleft()
-            size -= len(data)
-            ret_list.append(data)
-        if size < 0:
-            ret_list[-1], remainder = ret_list[-1][:size], ret_list[-1][size:]
-            self.__buf.appendleft(remainder)
-        ret = b''.join(ret_list)
-        self.__size -= len(ret)
-        return ret
+        if size is None or size < 0 or size > self.length:
+            size = self.length
+        if (self.__buf and not self.__offset and
+                len(self.__buf[0]) == size and
+                isinstance(self.__buf[0], bytes)):
+            # The whole of the next segment; hand it over as it is.
+            self.__memory_size -= size
+            return self.__buf.popleft()
+        result = bytearray(size)
+        self.readinto(result)
+        return bytes(result)
+
+    def __ReadFile(self, size):
+        """Read up to size spilled bytes, releasing the file once drained."""
+        if self.__file is None:
+            return b''
+        available = self.__file_write - self.__file_read
+        if size is None or size > available:
+            size = available
+        self.__file.seek(self.__file_read)
+        data = self.__file.read(size)
+        self.__file_read += len(data)
+        if self.__file_read == self.__file_write:
+            self.__file.close()
+            self.__file = None
+            self.__file_read = self.__file_write = 0
+        return data
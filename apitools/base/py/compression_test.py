@@ -16,8 +16,13 @@
 
 """Tests for compression."""
 
+import io
+from multiprocessing import pool as multiprocessing_pool
+import os
 import unittest
 
+import mock
+
 from apitools.base.py import compression
 from apitools.base.py import gzip
 
@@ -98,6 +103,128 @@ class CompressionTest(unittest.TestCase):
         # Ensure the input stream was exhausted.
         self.assertTrue(exhausted)
 
+    def testParallelCompressionIntegrity(self):
+        """Test that data compressed on several threads can be decompressed.
+
+        The blocks must form a single gzip member with the CRC and size of
+        the whole input.
+        """
+        output, read, exhausted = compression.CompressStream(
+            self.stream,
+            self.length,
+            9,
+            max_workers=4)
+        # Ensure the compressed buffer is smaller than the input buffer.
+        self.assertLess(output.length, self.length)
+        # Ensure uncompressed data matches the sample data.
+        with gzip.GzipFile(fileobj=output) as f:
+            original = f.read()
+            self.assertEqual(original, self.sample_data)
+        self.assertEqual(read, self.length)
+        self.assertTrue(exhausted)
+
+    def testParallelCompressionSmallBlocks(self):
+        """Test blocks smaller than the deflate window and uneven chunks."""
+        data = b''.join(six.int2byte(i % 251) for i in range(100000)) * 3
+        output, read, exhausted = compression.CompressStream(
+            six.BytesIO(data),
+            None,
+            chunksize=70001,
+            max_workers=3,
+            blocksize=10000)
+        self.assertEqual(read, len(data))
+        self.assertTrue(exhausted)
+        with gzip.GzipFile(fileobj=output) as f:
+            self.assertEqual(f.read(), data)
+
+    def testParallelCompressionPartial(self):
+        """Test that the length parameter works with parallel compression."""
+        output_length = 40
+        output, read, exhausted = compression.CompressStream(
+            self.stream,
+            output_length,
+            9,
+            chunksize=1048576,
+            max_workers=2)
+        self.assertLessEqual(output_length, output.length)
+        self.assertEqual(read, 1048576)
+        self.assertFalse(exhausted)
+        # The partial output is still a complete gzip member.
+        with gzip.GzipFile(fileobj=output) as f:
+            self.assertEqual(f.read(), self.sample_data[:read])
+
+    def testParallelCompressionReusesPool(self):
+        """Test that small bodies skip the pool and others share one."""
+        data = b''.join(six.int2byte(i % 251) for i in range(30000))
+        new_pool = mock.Mock(wraps=multiprocessing_pool.ThreadPool)
+        with mock.patch.dict(compression._thread_pools, clear=True):
+            with mock.patch.object(compression.multiprocessing_pool,
+                                   'ThreadPool', new_pool):
+                for blocksize in (len(data), len(data), 10000, 10000):
+                    output, _, _ = compression.CompressStream(
+                        six.BytesIO(data), None, max_workers=2,
+                        blocksize=blocksize)
+                    with gzip.GzipFile(fileobj=output) as f:
+                        self.assertEqual(f.read(), data)
+        self.assertEqual(1, new_pool.call_count)
+
+    def testParallelCompressionEmpty(self):
+        """Test that an empty stream produces a valid empty gzip member."""
+        output, read, exhausted = compression.CompressStream(
+            six.BytesIO(), None, max_workers=2)
+        self.assertEqual(read, 0)
+        self.assertTrue(exhausted)
+        with gzip.GzipFile(fileobj=output) as f:
+            self.assertEqual(f.read(), b'')
+
+
+class SampleCompressionRatioTest(unittest.TestCase):
+
+    def testCompressibleSample(self):
+        stream = six.BytesIO(b'abc' * 1000)
+        stream.seek(3)
+        ratio = compression.SampleCompressionRatio(stream, sample_size=600)
+        self.assertLess(ratio, 0.2)
+        # Ensure the stream is left where it was.
+        self.assertEqual(stream.tell(), 3)
+
+    def testIncompressibleSample(self):
+        stream = six.BytesIO(os.urandom(4096))
+        ratio = compression.SampleCompressionRatio(stream)
+        self.assertGreaterEqual(ratio, 1.0)
+        self.assertEqual(stream.tell(), 0)
+
+    def testUnsampleableStream(self):
+        # Nothing left to read.
+        self.assertIsNone(
+            compression.SampleCompressionRatio(six.BytesIO()))
+        # Not seekable.
+        stream = mock.Mock()
+        stream.tell.side_effect = IOError('not seekable')
+        self.assertIsNone(compression.SampleCompressionRatio(stream))
+
+    def testTellOnlyStream(self):
+        class TellOnlyStream(six.BytesIO):
+
+            def seekable(self):
+                return False
+
+            def seek(self, *unused_args):
+                raise io.UnsupportedOperation('seek')
+
+        stream = TellOnlyStream(b'abc' * 1000)
+        self.assertIsNone(compression.SampleCompressionRatio(stream))
+        # No bytes were consumed.
+        self.assertEqual(0, stream.tell())
+        self.assertEqual(b'abc' * 1000, stream.read())
+
+    def testStreamWithoutSeekable(self):
+        stream = mock.Mock(spec=['read', 'tell', 'seek'])
+        stream.tell.return_value = 0
+        stream.seek.side_effect = IOError('not seekable')
+        self.assertIsNone(compression.SampleCompressionRatio(stream))
+        self.assertFalse(stream.read.called)
+
 
 class StreamingBufferTest(unittest.TestCase):
 
@@ -148,3 +275,65 @@ class StreamingBufferTest(unittest.TestCase):
         data = self.stream.read(100)
         self.assertEqual(data, b'Sample')
         self.assertEqual(self.stream.length, 0)
+
+    def testReadAcrossSegments(self):
+        """Test reads that span and split written segments."""
+        for data in (b'abc', b'defg', b'hi'):
+            self.stream.write(data)
+        self.assertEqual(self.stream.read(2), b'ab')
+        self.assertEqual(self.stream.read(4), b'cdef')
+        self.assertEqual(self.stream.length, 3)
+        self.assertEqual(self.stream.read(), b'ghi')
+        self.assertEqual(self.stream.read(), b'')
+
+    def testReadWholeSegmentIsNotCopied(self):
+        data = b'Sample data'
+        self.stream.write(data)
+        self.assertIs(self.stream.read(len(data)), data)
+
+    def testReadinto(self):
+        self.stream.write(b'Sample')
+        self.stream.write(b' data')
+        buf = bytearray(8)
+        self.assertEqual(self.stream.readinto(buf), 8)
+        self.assertEqual(bytes(buf), b'Sample d')
+        self.assertEqual(self.stream.readinto(buf), 3)
+        self.assertEqual(bytes(buf[:3]), b'ata')
+        self.assertEqual(self.stream.readinto(buf), 0)
+
+    def testReadview(self):
+        self.stream.write(b'Sample')
+        self.stream.write(b' data')
+        view = self.stream.readview(4)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view.tobytes(), b'Samp')
+        # A view never extends past the end of a segment.
+        self.assertEqual(self.stream.readview(100).tobytes(), b'le')
+        self.assertEqual(self.stream.readview().tobytes(), b' data')
+        self.assertEqual(len(self.stream.readview()), 0)
+
+    def testSpillToDisk(self):
+        """Test that data beyond max_memory is kept in a temporary file."""
+        stream = compression.StreamingBuffer(max_memory=10)
+        stream.write(b'0123456789')
+        stream.write(b'abcdef')
+        # Once spilled, later writes follow in the file even if they fit.
+        stream.write(b'g')
+        self.assertEqual(stream.memory_size, 10)
+        self.assertEqual(stream.length, 17)
+        self.assertEqual(stream.read(12), b'0123456789ab')
+        self.assertEqual(stream.read(), b'cdefg')
+        self.assertEqual(stream.length, 0)
+        # Once drained, the buffer holds data in memory again.
+        stream.write(b'xyz')
+        self.assertEqual(stream.memory_size, 3)
+        self.assertEqual(stream.read(), b'xyz')
+
+    def testCompressionWithBoundedMemory(self):
+        data = os.urandom(1 << 20)
+        output, read, _ = compression.CompressStream(
+            six.BytesIO(data), None, chunksize=65536, max_memory=100000)
+        self.assertEqual(read, len(data))
+        self.assertLessEqual(output.memory_size, 100000)
+        with gzip.GzipFile(fileobj=output) as f:
+            self.assertEqual(f.read(), data)
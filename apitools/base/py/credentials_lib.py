@@ -21,8 +21,11 @@ import argparse
 import contextlib
 import datetime
 import json
+import logging
 import os
+import random
 import threading
+import time
 import warnings
 
 import httplib2
@@ -84,6 +87,8 @@ __all__ = [
     'GceAssertionCredentials',
     'GetCredentials',
     'GetUserinfo',
+    'JwtAccessCredentials',
+    'RefreshAheadCredentials',
     'ServiceAccountCredentialsFromFile',
 ]
 
@@ -157,9 +162,41 @@ def GetCredentials(package_name, scopes, client_id, client_secret, user_agent,
     raise exceptions.CredentialsError('Could not create valid credentials')
 
 
-def ServiceAccountCredentialsFromFile(filename, scopes, user_agent=None):
-    """Use the credentials in filename to create a token for scopes."""
+def ServiceAccountCredentialsFromFile(filename, scopes, user_agent=None,
+                                      use_jwt_access=False,
+                                      jwt_audience=None):
+    """Use the credentials in filename to create a token for scopes.
+
+    Args:
+      filename: str, The path of a service account .json key file.
+      scopes: The scopes to request a token for.
+      user_agent: str, The user agent for requests.
+      use_jwt_access: bool, If true, send self-signed JWTs instead of
+          getting tokens from the token endpoint; see JwtAccessCredentials.
+          Only for APIs that accept them. scopes is ignored.
+      jwt_audience: str, The audience of the self-signed JWTs. Defaults to
+          the root URL of each request.
+
+    Returns:
+      The credentials.
+
+    Raises:
+      NotYetImplementedError: if use_jwt_access is requested and the
+          installed oauth2client doesn't support it.
+    """
     filename = os.path.expanduser(filename)
+    if use_jwt_access:
+        # pylint: disable=protected-access
+        jwt_credentials_class = getattr(
+            service_account, '_JWTAccessCredentials', None)
+        # pylint: enable=protected-access
+        if jwt_credentials_class is None:
+            raise exceptions.NotYetImplementedError(
+                'Self-signed JWT access requires oauth2client >= 2.0.0')
+        credentials = jwt_credentials_class.from_json_keyfile_name(filename)
+        if user_agent is not None:
+            credentials.user_agent = user_agent
+        return JwtAccessCredentials(credentials, audience=jwt_audience)
     # We have two options, based on our version of oauth2client.
     if oauth2client.__version__ > '1.5.2':
         # oauth2client >= 2.0.0
@@ -231,6 +268,39 @@ def _GceMetadataRequest(relative_url, use_metadata_ip=False):
     return response
 
 
+# Seconds for which service accounts and scopes looked up on the metadata
+# server are reused by new GceAssertionCredentials.
+_GCE_METADATA_CACHE_TTL = 300
+
+# Maps (kind of lookup, service account) to (expiry time, result).
+_gce_metadata_cache = {}
+_gce_metadata_cache_lock = threading.Lock()
+
+
+def _CachedGceMetadata(key, lookup):
+    """Return the cached result of lookup, calling it if there is none.
+
+    Only results that are true are cached, so that a lookup that failed,
+    perhaps for a passing reason, is tried again next time.
+    """
+    with _gce_metadata_cache_lock:
+        expiry, result = _gce_metadata_cache.get(key, (0, None))
+    if time.time() < expiry:
+        return result
+    result = lookup()
+    if not result:
+        return result
+    with _gce_metadata_cache_lock:
+        _gce_metadata_cache[key] = (time.time() + _GCE_METADATA_CACHE_TTL,
+                                    result)
+    return result
+
+
+def _ResetGceMetadataCache():
+    with _gce_metadata_cache_lock:
+        _gce_metadata_cache.clear()
+
+
 class GceAssertionCredentials(gce.AppAssertionCredentials):
 
     """Assertion credentials for GCE instances."""
@@ -338,19 +408,22 @@ class GceAssertionCredentials(gce.AppAssertionCredentials):
         if not util.DetectGce():
             raise exceptions.ResourceUnavailableError(
                 'GCE credentials requested outside a GCE instance')
-        if not self.GetServiceAccount(self.__service_account_name):
+        account = self.__service_account_name
+        if not _CachedGceMetadata(('account', account),
+                                  lambda: self.GetServiceAccount(account)):
             raise exceptions.ResourceUnavailableError(
                 'GCE credentials requested but service account '
                 '%s does not exist.' % self.__service_account_name)
+        instance_scopes = _CachedGceMetadata(('scopes', account),
+                                             self.GetInstanceScopes)
         if scopes:
             scope_ls = util.NormalizeScopes(scopes)
-            instance_scopes = self.GetInstanceScopes()
             if scope_ls > instance_scopes:
                 raise exceptions.CredentialsError(
                     'Instance did not have access to scopes %s' % (
                         sorted(list(scope_ls - instance_scopes)),))
         else:
-            scopes = self.GetInstanceScopes()
+            scopes = set(instance_scopes)
         return scopes
 
     def GetServiceAccount(self, account):
@@ -509,6 +582,267 @@ class GaeAssertionCredentials(oauth2client.client.AssertionCredentials):
             'Compute Engine service accounts cannot sign blobs')
 
 
+class RefreshAheadCredentials(object):
+
+    """Wraps credentials to refresh their token before it expires.
+
+    Once a token is within refresh_margin seconds of its token_expiry,
+    plus a random share of jitter, the next request starts a refresh in a
+    background thread and goes ahead with the token, which is still
+    valid. Threads only wait for a refresh when there is no valid token
+    at all. Refreshes are single-flight: while one is in progress, other
+    threads that need one wait for it instead of starting their own, and
+    a thread whose request was rejected with a token that has been
+    replaced since just retries with the new one. After a background
+    refresh fails, the next one waits for failure_backoff seconds.
+
+    Use it in place of the credentials it wraps:
+
+      credentials = RefreshAheadCredentials(credentials)
+      http = credentials.authorize(httplib2.Http())
+
+    Attributes not defined here are those of the wrapped credentials.
+    """
+
+    def __init__(self, credentials, refresh_margin=300, jitter=0.5,
+                 http_factory=None, failure_backoff=5):
+        """Initialize a RefreshAheadCredentials.
+
+        Args:
+          credentials: oauth2client.client.OAuth2Credentials, The
+              credentials to refresh.
+          refresh_margin: Seconds before token_expiry to refresh the token.
+          jitter: Fraction of refresh_margin by which refreshes are made
+              randomly earlier, so processes started together don't all
+              refresh at once.
+          http_factory: (callable, optional) Returns the http object for a
+              background refresh. Defaults to httplib2.Http.
+          failure_backoff: Seconds after a failed background refresh
+              before starting another, made randomly longer by jitter.
+        """
+        self.__credentials = credentials
+        self.__refresh_margin = refresh_margin
+        self.__jitter = jitter
+        self.__http_factory = http_factory or httplib2.Http
+        self.__failure_backoff = failure_backoff
+        # Held while refreshing.
+        self.__refresh_lock = threading.Lock()
+        # Guards the fields below.
+        self.__lock = threading.Lock()
+        self.__background_refresh = None
+        # When background refreshes may start again after a failure.
+        self.__retry_after = None
+        self.__refresh_at = None
+        self.__refresh_at_token = None
+        # The token each thread last sent.
+        self.__local = threading.local()
+
+    def __getattr__(self, name):
+        if name.startswith('_RefreshAheadCredentials__'):
+            raise AttributeError(name)
+        return getattr(self.__credentials, name)
+
+    @property
+    def credentials(self):
+        """The wrapped credentials."""
+        return self.__credentials
+
+    def authorize(self, http):
+        """Authorize http to make requests with these credentials."""
+        authorize = six.get_unbound_function(
+            oauth2client.client.OAuth2Credentials.authorize)
+        return authorize(self, http)
+
+    def __Expired(self):
+        credentials = self.__credentials
+        return not credentials.access_token or credentials.access_token_expired
+
+    def __RefreshDue(self):
+        """Whether the token is close enough to expiry to refresh it."""
+        credentials = self.__credentials
+        token_expiry = credentials.token_expiry
+        if token_expiry is None:
+            return False
+        with self.__lock:
+            if self.__refresh_at_token != credentials.access_token:
+                margin = self.__refresh_margin * (
+                    1 + self.__jitter * random.random())
+                self.__refresh_at = token_expiry - datetime.timedelta(
+                    seconds=margin)
+                self.__refresh_at_token = credentials.access_token
+            refresh_at = self.__refresh_at
+        now = datetime.datetime.now(
+            tz=datetime.timezone.utc).replace(tzinfo=None)
+        return now >= refresh_at
+
+    def __Refresh(self, http_request, stale_token):
+        """Refresh the token, unless it was already replaced."""
+        with self.__refresh_lock:
+            if self.__credentials.access_token != stale_token:
+                return
+            # pylint: disable=protected-access
+            self.__credentials._refresh(http_request)
+
+    def __RefreshInBackground(self):
+        with self.__lock:
+            if self.__background_refresh is not None:
+                return
+            if (self.__retry_after is not None and
+                    time.time() < self.__retry_after):
+                return
+            self.__background_refresh = threading.Thread(
+                target=self.__BackgroundRefresh,
+                args=(self.__credentials.access_token,))
+            self.__background_refresh.daemon = True
+            self.__background_refresh.start()
+
+    def __BackgroundRefresh(self, stale_token):
+        retry_after = None
+        try:
+            self.__Refresh(self.__http_factory().request, stale_token)
+        except Exception:  # pylint: disable=broad-except
+            # Requests go on with the current token, and refresh it
+            # themselves once it expires.
+            logging.warning('Background token refresh failed',
+                            exc_info=True)
+            retry_after = time.time() + self.__failure_backoff * (
+                1 + self.__jitter * random.random())
+        finally:
+            with self.__lock:
+                self.__background_refresh = None
+                self.__retry_after = retry_after
+
+    def _refresh(self, http_request):
+        """Refresh the token, as a request was rejected or it expired."""
+        # Only refresh the token this thread sent, if it sent any.
+        stale_token = getattr(self.__local, 'token',
+                              self.__credentials.access_token)
+        self.__Refresh(http_request, stale_token)
+
+    def refresh(self, http):
+        """Force a refresh of the token."""
+        self.__Refresh(http.request, self.__credentials.access_token)
+
+    def apply(self, headers):
+        """Add the token to headers, refreshing it if it is due."""
+        if self.__Expired():
+            self.__Refresh(self.__http_factory().request,
+                           self.__credentials.access_token)
+        elif self.__RefreshDue():
+            self.__RefreshInBackground()
+        token = self.__credentials.access_token
+        self.__local.token = token
+        headers['Authorization'] = 'Bearer ' + token
+
+
+class JwtAccessCredentials(object):
+
+    """Service account credentials that sign their own tokens.
+
+    Instead of exchanging a signed assertion for an access token at the
+    OAuth token endpoint, requests carry a JWT signed locally with the
+    service account key, whose audience is the API called: the root URL
+    of the request, as in https://www.googleapis.com/, unless an audience
+    is given. Only APIs that accept self-signed JWTs can be called this
+    way. Tokens are cached per audience until refresh_margin seconds
+    before they expire, so each API costs one signature an hour and no
+    request waits for the token endpoint.
+
+    Attributes not defined here are those of the wrapped credentials.
+    """
+
+    def __init__(self, credentials, audience=None, refresh_margin=300):
+        """Initialize a JwtAccessCredentials.
+
+        Args:
+          credentials: oauth2client.service_account._JWTAccessCredentials,
+              The service account to sign tokens with.
+          audience: str, The audience of all tokens, or None to use the
+              root URL of each request.
+          refresh_margin: Seconds before expiry to sign a new token.
+        """
+        self.__credentials = credentials
+        self.__audience = audience
+        self.__refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self.__lock = threading.Lock()
+        # Audience -> (token, expiry).
+        self.__tokens = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_JwtAccessCredentials__'):
+            raise AttributeError(name)
+        return getattr(self.__credentials, name)
+
+    @property
+    def credentials(self):
+        """The wrapped credentials."""
+        return self.__credentials
+
+    def GetAudience(self, uri):
+        """Return the audience of tokens for requests to uri."""
+        if self.__audience is not None:
+            return self.__audience
+        parts = urllib.parse.urlsplit(uri)
+        return '%s://%s/' % (parts.scheme, parts.netloc)
+
+    def GetToken(self, audience):
+        """Return a token for audience, signing one if needed."""
+        now = datetime.datetime.now(
+            tz=datetime.timezone.utc).replace(tzinfo=None)
+        with self.__lock:
+            token, expiry = self.__tokens.get(audience, (None, None))
+            if token is None or now >= expiry - self.__refresh_margin:
+                # pylint: disable=protected-access
+                token, expiry = self.__credentials._create_token(
+                    {'aud': audience})
+                self.__tokens[audience] = (token, expiry)
+        return token
+
+    def refresh(self, unused_http):
+        """Drop the cached tokens, so new ones are signed."""
+        with self.__lock:
+            self.__tokens.clear()
+
+    def _refresh(self, unused_http_request):
+        self.refresh(None)
+
+    def authorize(self, http):
+        """Authorize http to make requests with self-signed JWTs."""
+        orig_request = http.request
+
+        def NewRequest(uri, method='GET', body=None, headers=None,
+                       redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                       connection_type=None):
+            """Send the request with a token for its audience."""
+            headers = dict(headers or {})
+            user_agent = self.__credentials.user_agent
+            if user_agent is not None:
+                if 'user-agent' in headers:
+                    user_agent = '%s %s' % (user_agent,
+                                            headers['user-agent'])
+                headers['user-agent'] = user_agent
+            audience = self.GetAudience(uri)
+            headers['Authorization'] = 'Bearer ' + self.GetToken(audience)
+            response, content = orig_request(
+                uri, method, body, headers, redirections, connection_type)
+            if (response.status == http_client.UNAUTHORIZED and
+                    not hasattr(body, 'read')):
+                # The token may have been rejected for clock skew; retry
+                # once with a new one.
+                with self.__lock:
+                    self.__tokens.pop(audience, None)
+                headers['Authorization'] = 'Bearer ' + self.GetToken(
+                    audience)
+                response, content = orig_request(
+                    uri, method, body, headers, redirections,
+                    connection_type)
+            return response, content
+
+        http.request = NewRequest
+        http.request.credentials = self
+        return http
+
+
 def _GetRunFlowFlags(args=None):
     """Retrieves command line flags based on gflags module."""
     # There's one rare situation where gsutil will not have argparse
@@ -716,14 +1050,16 @@ def _GetUserinfoUrl(credentials):
 @_RegisterCredentialsMethod
 def _GetServiceAccountCredentials(
         client_info, service_account_name=None, service_account_keyfile=None,
-        service_account_json_keyfile=None, **unused_kwds):
+        service_account_json_keyfile=None, use_jwt_access=False,
+        **unused_kwds):
     """Returns ServiceAccountCredentials from give file."""
     scopes = client_info['scope'].split()
     user_agent = client_info['user_agent']
     # Use the .json credentials, if provided.
     if service_account_json_keyfile:
         return ServiceAccountCredentialsFromFile(
-            service_account_json_keyfile, scopes, user_agent=user_agent)
+            service_account_json_keyfile, scopes, user_agent=user_agent,
+            use_jwt_access=use_jwt_access)
     # Fall back to .p12 if there's no .json credentials.
     if ((service_account_name and not service_account_keyfile) or
             (service_account_keyfile and not service_account_name)):
@@ -13,16 +13,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import datetime
 import json
 import os.path
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
+import httplib2
 import mock
+from oauth2client import service_account
+import rsa
 import six
 
 from apitools.base.py import credentials_lib
+from apitools.base.py import exceptions
 from apitools.base.py import util
 
 
@@ -45,6 +53,10 @@ class MetadataMock(object):
 
 class CredentialsLibTest(unittest.TestCase):
 
+    def setUp(self):
+        credentials_lib._ResetGceMetadataCache()
+        self.addCleanup(credentials_lib._ResetGceMetadataCache)
+
     def _RunGceAssertionCredentials(
             self, service_account_name=None, scopes=None, cache_filename=None):
         kwargs = {}
@@ -59,6 +71,7 @@ class CredentialsLibTest(unittest.TestCase):
         return credentials
 
     def _GetServiceCreds(self, service_account_name=None, scopes=None):
+        credentials_lib._ResetGceMetadataCache()
         metadatamock = MetadataMock(scopes, service_account_name)
         with mock.patch.object(util, 'DetectGce', autospec=True) as gce_detect:
             gce_detect.return_value = True
@@ -124,6 +137,34 @@ class CredentialsLibTest(unittest.TestCase):
         # Only one metadata request is made if the cache is hit.
         self.assertEqual(opener_mock.call_count, 4)
 
+    @mock.patch.object(util, 'DetectGce', autospec=True)
+    def testGceMetadataLookupsCached(self, mock_detect):
+        mock_detect.return_value = True
+        metadatamock = MetadataMock(['scope1'], 'default')
+        with mock.patch.object(credentials_lib,
+                               '_GceMetadataRequest',
+                               side_effect=metadatamock,
+                               autospec=True) as opener_mock:
+            self._RunGceAssertionCredentials(scopes=['scope1'])
+            self.assertEqual(3, opener_mock.call_count)
+            # Only the token is fetched for new credentials.
+            self._RunGceAssertionCredentials()
+            self.assertEqual(4, opener_mock.call_count)
+            with mock.patch.object(
+                    credentials_lib.time, 'time',
+                    return_value=time.time() +
+                    credentials_lib._GCE_METADATA_CACHE_TTL):
+                self._RunGceAssertionCredentials()
+            self.assertEqual(7, opener_mock.call_count)
+
+    def testGceMetadataFailuresNotCached(self):
+        lookup = mock.Mock(side_effect=[False, True])
+        key = ('account', 'default')
+        self.assertFalse(credentials_lib._CachedGceMetadata(key, lookup))
+        self.assertTrue(credentials_lib._CachedGceMetadata(key, lookup))
+        self.assertTrue(credentials_lib._CachedGceMetadata(key, lookup))
+        self.assertEqual(2, lookup.call_count)
+
     def testGetServiceAccount(self):
         # We'd also like to test the metadata calls, which requires
         # having some knowledge about how HTTP calls are made (so that
@@ -153,6 +194,287 @@ class CredentialsLibTest(unittest.TestCase):
         self.assertIsNone(creds)
 
 
+class FakeCredentials(object):
+
+    """Credentials whose refreshes count up token0, token1, ..."""
+
+    def __init__(self, expires_in=3600):
+        self.refreshes = 0
+        self.expires_in = expires_in
+        self.access_token = None
+        self.token_expiry = None
+        self.invalid = False
+        self.user_agent = None
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.fail = False
+
+    @property
+    def access_token_expired(self):
+        return self.token_expiry is not None and _UtcNow() >= self.token_expiry
+
+    def _refresh(self, unused_http_request):
+        self.proceed.wait(10)
+        if self.fail:
+            raise exceptions.CredentialsError('failed')
+        self.token_expiry = _UtcNow() + datetime.timedelta(
+            seconds=self.expires_in)
+        self.access_token = 'token%d' % self.refreshes
+        self.refreshes += 1
+
+
+def _UtcNow():
+    return datetime.datetime.now(
+        tz=datetime.timezone.utc).replace(tzinfo=None)
+
+
+class RefreshAheadCredentialsTest(unittest.TestCase):
+
+    def _Apply(self, credentials):
+        headers = {}
+        credentials.apply(headers)
+        return headers['Authorization']
+
+    def _WaitForToken(self, fake, token):
+        for _ in range(1000):
+            if fake.access_token == token:
+                return
+            time.sleep(0.01)
+        self.fail('Token not refreshed')
+
+    def testAppliesValidToken(self):
+        fake = FakeCredentials()
+        fake._refresh(None)
+        credentials = credentials_lib.RefreshAheadCredentials(fake)
+        self.assertEqual('Bearer token0', self._Apply(credentials))
+        self.assertEqual(1, fake.refreshes)
+        self.assertIs(fake, credentials.credentials)
+        self.assertFalse(credentials.invalid)
+
+    def testRefreshesAheadInBackground(self):
+        fake = FakeCredentials(expires_in=60)
+        fake._refresh(None)
+        fake.proceed.clear()
+        credentials = credentials_lib.RefreshAheadCredentials(
+            fake, refresh_margin=120, http_factory=mock.Mock())
+        # Requests keep using the old token while the refresh is blocked.
+        self.assertEqual('Bearer token0', self._Apply(credentials))
+        self.assertEqual('Bearer token0', self._Apply(credentials))
+        fake.expires_in = 3600
+        fake.proceed.set()
+        self._WaitForToken(fake, 'token1')
+        self.assertEqual('Bearer token1', self._Apply(credentials))
+        self.assertEqual(2, fake.refreshes)
+
+    def testCoalescesConcurrentRefreshes(self):
+        fake = FakeCredentials()
+        fake.proceed.clear()
+        credentials = credentials_lib.RefreshAheadCredentials(
+            fake, http_factory=mock.Mock())
+        results = []
+
+        def Apply():
+            results.append(self._Apply(credentials))
+
+        threads = [threading.Thread(target=Apply) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        fake.proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['Bearer token0'] * 10, results)
+        self.assertEqual(1, fake.refreshes)
+
+    def testRefreshesRejectedTokenOnce(self):
+        fake = FakeCredentials()
+        fake._refresh(None)
+        credentials = credentials_lib.RefreshAheadCredentials(fake)
+        self._Apply(credentials)
+        other_thread = threading.Thread(
+            target=lambda: (self._Apply(credentials),
+                            credentials._refresh(None)))
+        other_thread.start()
+        other_thread.join()
+        self.assertEqual(2, fake.refreshes)
+        # This thread's token was already replaced, so it doesn't refresh.
+        credentials._refresh(None)
+        self.assertEqual(2, fake.refreshes)
+        self.assertEqual('Bearer token1', self._Apply(credentials))
+        credentials._refresh(None)
+        self.assertEqual(3, fake.refreshes)
+
+    def testBackgroundRefreshFailure(self):
+        fake = FakeCredentials(expires_in=60)
+        fake._refresh(None)
+        fake.fail = True
+        credentials = credentials_lib.RefreshAheadCredentials(
+            fake, refresh_margin=120, http_factory=mock.Mock())
+        with mock.patch.object(credentials_lib.logging,
+                               'warning') as mock_warning:
+            self.assertEqual('Bearer token0', self._Apply(credentials))
+            for _ in range(1000):
+                if mock_warning.called:
+                    break
+                time.sleep(0.01)
+        self.assertTrue(mock_warning.called)
+        self.assertEqual('Bearer token0', self._Apply(credentials))
+
+    def testBackgroundRefreshBacksOffAfterFailure(self):
+        fake = FakeCredentials(expires_in=60)
+        fake._refresh(None)
+        fake.fail = True
+        http_factory = mock.Mock()
+        credentials = credentials_lib.RefreshAheadCredentials(
+            fake, refresh_margin=120, http_factory=http_factory,
+            failure_backoff=10, jitter=0)
+        threads = []
+        start_thread = threading.Thread.start
+
+        def Start(thread):
+            threads.append(thread)
+            start_thread(thread)
+
+        with mock.patch.object(threading.Thread, 'start', Start), \
+                mock.patch.object(credentials_lib.logging, 'warning'):
+            self._Apply(credentials)
+            threads[0].join()
+            # Within the backoff, no refresh starts.
+            self._Apply(credentials)
+            self._Apply(credentials)
+            self.assertEqual(1, len(threads))
+            later = time.time() + 11
+            with mock.patch.object(credentials_lib.time, 'time',
+                                   return_value=later):
+                fake.proceed.clear()
+                self._Apply(credentials)
+                self._Apply(credentials)
+                fake.proceed.set()
+                threads[-1].join()
+        self.assertEqual(2, len(threads))
+        self.assertEqual(2, http_factory.call_count)
+
+    def testAuthorize(self):
+        fake = FakeCredentials()
+        fake._refresh(None)
+        credentials = credentials_lib.RefreshAheadCredentials(fake)
+        sent_tokens = []
+
+        def Request(uri, method='GET', body=None, headers=None,
+                    redirections=None, connection_type=None):
+            sent_tokens.append(headers[b'Authorization'])
+            status = 401 if len(sent_tokens) == 1 else 200
+            return httplib2.Response({'status': status}), b''
+
+        http = mock.Mock(request=Request)
+        http = credentials.authorize(http)
+        response, _ = http.request('https://www.example.com')
+        self.assertEqual(200, response.status)
+        self.assertEqual([b'Bearer token0', b'Bearer token1'], sent_tokens)
+        self.assertIs(credentials, http.request.credentials)
+
+
+@unittest.skipIf(not hasattr(service_account, '_JWTAccessCredentials'),
+                 'oauth2client does not support self-signed JWTs')
+class JwtAccessCredentialsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.public_key, private_key = rsa.newkeys(512)
+        cls.tempdir = tempfile.mkdtemp()
+        cls.keyfile = os.path.join(cls.tempdir, 'key.json')
+        with open(cls.keyfile, 'w') as f:
+            json.dump({
+                'type': 'service_account',
+                'client_email': 'sa@example.iam.gserviceaccount.com',
+                'client_id': '123',
+                'private_key_id': 'key-id',
+                'private_key': private_key.save_pkcs1().decode('ascii'),
+            }, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def setUp(self):
+        self.requests = []
+        self.statuses = []
+
+    def _Request(self, uri, method='GET', body=None, headers=None,
+                 redirections=None, connection_type=None):
+        self.requests.append((uri, dict(headers)))
+        status = self.statuses.pop(0) if self.statuses else 200
+        return httplib2.Response({'status': status}), b''
+
+    def _Http(self, **kwds):
+        credentials = credentials_lib.ServiceAccountCredentialsFromFile(
+            self.keyfile, ['scope'], use_jwt_access=True, **kwds)
+        return credentials.authorize(mock.Mock(request=self._Request))
+
+    def _Claims(self, token):
+        """Check the signature of token, and return its header and claims."""
+        signed, signature = token.encode('ascii').rsplit(b'.', 1)
+        rsa.verify(signed, base64.urlsafe_b64decode(signature + b'=='),
+                   self.public_key)
+        segments = [base64.urlsafe_b64decode(
+            segment + b'=' * (-len(segment) % 4))
+            for segment in signed.split(b'.')]
+        return [json.loads(segment.decode('utf-8')) for segment in segments]
+
+    def _SentToken(self, index):
+        authorization = self.requests[index][1]['Authorization']
+        self.assertTrue(authorization.startswith('Bearer '))
+        return authorization[len('Bearer '):]
+
+    def testSignsTokenPerAudience(self):
+        http = self._Http(user_agent='agent')
+        http.request('https://www.googleapis.com/storage/v1/b?project=p')
+        http.request('https://www.googleapis.com/storage/v1/b/other')
+        http.request('https://pubsub.googleapis.com/v1/topics')
+        self.assertEqual(3, len(self.requests))
+        header, claims = self._Claims(self._SentToken(0))
+        self.assertEqual('key-id', header['kid'])
+        self.assertEqual('https://www.googleapis.com/', claims['aud'])
+        self.assertEqual('sa@example.iam.gserviceaccount.com',
+                         claims['iss'])
+        self.assertEqual('agent', self.requests[0][1]['user-agent'])
+        # The token is reused for the same audience only.
+        self.assertEqual(self._SentToken(0), self._SentToken(1))
+        _, claims = self._Claims(self._SentToken(2))
+        self.assertEqual('https://pubsub.googleapis.com/', claims['aud'])
+
+    def testAudience(self):
+        http = self._Http(jwt_audience='https://example.com/api')
+        http.request('https://www.googleapis.com/storage/v1/b')
+        _, claims = self._Claims(self._SentToken(0))
+        self.assertEqual('https://example.com/api', claims['aud'])
+
+    def testSignsNewTokenNearExpiry(self):
+        http = self._Http()
+        jwt_credentials = http.request.credentials.credentials
+        # Tokens last an hour, so they are always within this margin.
+        credentials = credentials_lib.JwtAccessCredentials(
+            jwt_credentials, refresh_margin=3600)
+        http = credentials.authorize(mock.Mock(request=self._Request))
+        with mock.patch.object(
+                jwt_credentials, '_create_token',
+                wraps=jwt_credentials._create_token) as create:
+            http.request('https://www.googleapis.com/a')
+            http.request('https://www.googleapis.com/b')
+        self.assertEqual(2, create.call_count)
+
+    def testRetriesUnauthorized(self):
+        http = self._Http()
+        self.statuses = [401]
+        credentials = http.request.credentials
+        with mock.patch.object(
+                credentials.credentials, '_create_token',
+                wraps=credentials.credentials._create_token) as create:
+            response, _ = http.request('https://www.googleapis.com/a')
+        self.assertEqual(200, response.status)
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual(2, create.call_count)
+
+
 class TestGetRunFlowFlags(unittest.TestCase):
 
     def setUp(self):
@@ -24,6 +24,7 @@ import collections
 import contextlib
 import logging
 import socket
+import threading
 import time
 
 import httplib2
@@ -72,6 +73,67 @@ ExceptionRetryArgs = collections.namedtuple(
                            'max_retry_wait', 'total_wait_sec'])
 
 
+# Whether httplib2 keeps Content-Encoding in the current thread, and how
+# many threads are in _Httplib2RawContent; see there.
+_raw_content = threading.local()
+_raw_content_lock = threading.Lock()
+_raw_content_users = 0
+# The httplib2._decompressContent replaced while there are users.
+_httplib2_decompress_content = None
+
+
+def _DecompressContent(response, new_content, *args, **kwds):
+    """Replaces httplib2._decompressContent to allow keeping raw content."""
+    if getattr(_raw_content, 'enabled', False):
+        return new_content
+    return _httplib2_decompress_content(response, new_content, *args, **kwds)
+
+
+@contextlib.contextmanager
+def _Httplib2RawContent(enabled=True):
+    """Keep httplib2 from decoding responses in this thread, if enabled.
+
+    httplib2 decodes gzip and deflate Content-Encodings itself, and drops
+    the Content-Encoding header when it does. That fails for a range of a
+    compressed body, which can't be decoded on its own. Within the `with`
+    block, responses received by this thread keep the body and headers
+    exactly as sent.
+
+    httplib2 has no option for this, so its decoding function is replaced
+    while any thread is in the `with` block, and put back once none is.
+    Responses received by other threads are still decoded.
+
+    Args:
+      enabled: (bool) whether to keep the raw content.
+
+    Yields:
+      None.
+    """
+    global _httplib2_decompress_content  # pylint: disable=global-statement
+    global _raw_content_users  # pylint: disable=global-statement
+    # pylint: disable=protected-access
+    if not enabled or not hasattr(httplib2, '_decompressContent'):
+        # Nothing to do, or this version of httplib2 doesn't decode content.
+        yield
+        return
+    with _raw_content_lock:
+        if not _raw_content_users:
+            _httplib2_decompress_content = httplib2._decompressContent
+            httplib2._decompressContent = _DecompressContent
+        _raw_content_users += 1
+    old_enabled = getattr(_raw_content, 'enabled', False)
+    _raw_content.enabled = True
+    try:
+        yield
+    finally:
+        _raw_content.enabled = old_enabled
+        with _raw_content_lock:
+            _raw_content_users -= 1
+            if not _raw_content_users:
+                httplib2._decompressContent = _httplib2_decompress_content
+                _httplib2_decompress_content = None
+
+
 @contextlib.contextmanager
 def _Httplib2Debuglevel(http_request, level, http=None):
     """Temporarily change the value of httplib2.debuglevel, if necessary.
@@ -343,7 +405,15 @@ def MakeRequest(http, http_request, retries=7, max_retry_wait=60,
     # https://github.com/googleapis/google-api-python-client/issues/803
     if hasattr(http, 'redirect_codes'):
         http.redirect_codes = set(http.redirect_codes) - {308}
+    # A retried request must resend the whole body, so remember where a
+    # seekable body starts (as oauth2client does when refreshing).
+    body_position = None
+    if all(hasattr(http_request.body, attr) for attr in
+           ('read', 'seek', 'tell')):
+        body_position = http_request.body.tell()
     while True:
+        if retry and body_position is not None:
+            http_request.body.seek(body_position)
         try:
             return _MakeRequestNoRetry(
                 http, http_request, redirections=redirections,
@@ -15,14 +15,17 @@
 
 """Tests for http_wrapper."""
 import socket
+import threading
 import unittest
 
 import httplib2
+import six
 from six.moves import http_client
 
 from mock import patch
 
 from apitools.base.py import exceptions
+from apitools.base.py import gzip
 from apitools.base.py import http_wrapper
 
 # pylint: disable=ungrouped-imports
@@ -57,6 +60,15 @@ class RaisesExceptionOnLen(object):
         return 1
 
 
+def _DecompressContent(response, content):
+    """Call httplib2._decompressContent, which newer versions limit."""
+    # pylint: disable=protected-access
+    try:
+        return httplib2._decompressContent(response, content, {})
+    except TypeError:
+        return httplib2._decompressContent(response, content)
+
+
 class HttpWrapperTest(unittest.TestCase):
 
     def testRequestBodyUsesLengthProperty(self):
@@ -137,3 +149,61 @@ class HttpWrapperTest(unittest.TestCase):
             with patch('time.sleep', return_value=None):
                 http_wrapper.HandleExceptionsAndRebuildHttpConnections(
                     retry_args)
+
+    def testMakeRequestRewindsSeekableBodyOnRetry(self):
+
+        class SeekableBody(six.BytesIO):
+            length = 8
+
+        body = SeekableBody(b'0123456789')
+        body.seek(2)
+        sent_bodies = []
+
+        class FakeHttp(object):
+
+            connections = {}
+
+            def request(self, unused_url, **kwds):
+                sent_bodies.append(kwds['body'].read())
+                if len(sent_bodies) == 1:
+                    raise socket.error('connection reset')
+                return {'status': '200'}, 'ok'
+
+        request = http_wrapper.Request(
+            'http://www.example.com', http_method='PUT', body=body)
+        with patch('time.sleep', return_value=None):
+            response = http_wrapper.MakeRequest(FakeHttp(), request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([b'23456789', b'23456789'], sent_bodies)
+
+    def testRawContentIsScoped(self):
+        # pylint: disable=protected-access
+        decompress_content = httplib2._decompressContent
+        encoded = gzip.compress(b'data')
+        decoded = []
+        entered = threading.Event()
+        leave = threading.Event()
+
+        def Decode():
+            response = httplib2.Response({'content-encoding': 'gzip'})
+            decoded.append(_DecompressContent(response, encoded))
+
+        def KeepRaw():
+            with http_wrapper._Httplib2RawContent():
+                entered.set()
+                leave.wait(10)
+
+        thread = threading.Thread(target=KeepRaw)
+        thread.start()
+        entered.wait(10)
+        with http_wrapper._Httplib2RawContent():
+            response = httplib2.Response({'content-encoding': 'gzip'})
+            self.assertEqual(encoded, _DecompressContent(response, encoded))
+            # Other threads still get decoded content.
+            other_thread = threading.Thread(target=Decode)
+            other_thread.start()
+            other_thread.join()
+        self.assertEqual([b'data'], decoded)
+        leave.set()
+        thread.join()
+        self.assertIs(decompress_content, httplib2._decompressContent)
@@ -16,11 +16,26 @@
 
 """A helper function that executes a series of List queries for many APIs."""
 
+import collections
+import heapq
+import itertools
+from multiprocessing import pool as multiprocessing_pool
+import sys
+import threading
+import time
+
 from apitools.base.py import encoding
+from apitools.base.py import exceptions
 import six
+from six.moves import queue
 
 __all__ = [
+    'AdaptivePageSize',
+    'ListCheckpoint',
+    'PrefixPartitioner',
+    'RangePartitioner',
     'YieldFromList',
+    'YieldFromListParallel',
 ]
 
 
@@ -62,13 +77,270 @@ def _SetattrNested(message, attribute, value):
                        attribute[-1], value)
 
 
+class ListCheckpoint(collections.namedtuple(
+        'ListCheckpoint', ['page_token', 'offset'])):
+
+    """A position in a listing, from which YieldFromList can resume.
+
+    Attributes:
+      page_token: The token of the page to continue from, or None for the
+        first page.
+      offset: The number of items at the start of that page that were
+        already processed, counting those dropped by a predicate.
+
+    Being a tuple of a string and an int, a checkpoint can be pickled, or
+    stored with json.dumps(checkpoint) and restored with
+    ListCheckpoint(*json.loads(data)).
+    """
+
+    __slots__ = ()
+
+
+class AdaptivePageSize(object):
+
+    """Chooses the page size of YieldFromList from the pages seen so far.
+
+    Pass an instance as the batch_size of YieldFromList. Each page is
+    sized to take about target_latency seconds to fetch and to hold about
+    target_bytes of items, judging by the time and item size of earlier
+    pages, with more weight on recent ones. Pages grow by at most a factor
+    of max_growth at a time, but shrink at once when items turn out to be
+    large or slow, and stay between min_size and max_size, which should
+    be the largest page size the server accepts. This class is
+    thread-safe, so one instance can be shared by concurrent listings.
+    """
+
+    def __init__(self, initial_size=100, min_size=1, max_size=1000,
+                 target_bytes=1 << 20, target_latency=1.0, max_growth=2.0,
+                 smoothing=0.5, item_size_func=None):
+        """Create a new AdaptivePageSize.
+
+        Args:
+          initial_size: int, The size of the first page.
+          min_size: int, The smallest page size to request.
+          max_size: int, The largest page size to request.
+          target_bytes: int, The size of the items of a page to aim for, or
+              None to only consider latency.
+          target_latency: float, The seconds a page should take, or None to
+              only consider size.
+          max_growth: float, The largest factor by which the page size
+              grows from one page to the next.
+          smoothing: float, The weight of the latest page, between 0 and 1.
+          item_size_func: Function returning the size of an item in bytes.
+              Defaults to the length of its JSON encoding. Only a few items
+              of each page are measured.
+        """
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__target_bytes = target_bytes
+        self.__target_latency = target_latency
+        self.__max_growth = max_growth
+        self.__smoothing = smoothing
+        self.__item_size_func = item_size_func or (
+            lambda item: len(encoding.MessageToJson(item)))
+        self.__lock = threading.Lock()
+        self.__page_size = max(min_size, min(initial_size, max_size))
+        self.__bytes_per_item = None
+        self.__seconds_per_item = None
+
+    @property
+    def page_size(self):
+        """The number of items to request in the next page."""
+        return self.__page_size
+
+    @property
+    def max_size(self):
+        """The largest page size to request."""
+        return self.__max_size
+
+    def __Smooth(self, average, value):
+        if average is None:
+            return value
+        return self.__smoothing * value + (1 - self.__smoothing) * average
+
+    def RecordPage(self, items, elapsed_seconds):
+        """Update the page size after fetching a page.
+
+        Args:
+          items: list, The items of the page, as returned by the service.
+          elapsed_seconds: float, The time it took to fetch and decode the
+              page.
+        """
+        if not items:
+            return
+        num_items = len(items)
+        bytes_per_item = None
+        if self.__target_bytes is not None:
+            sample = items[::max(1, num_items // 3)][:3]
+            bytes_per_item = sum(
+                self.__item_size_func(item) for item in sample
+            ) / float(len(sample))
+        with self.__lock:
+            if bytes_per_item is not None:
+                self.__bytes_per_item = self.__Smooth(
+                    self.__bytes_per_item, bytes_per_item)
+            self.__seconds_per_item = self.__Smooth(
+                self.__seconds_per_item, elapsed_seconds / num_items)
+            page_size = self.__max_size
+            if self.__target_bytes is not None and self.__bytes_per_item:
+                page_size = min(
+                    page_size, self.__target_bytes / self.__bytes_per_item)
+            if (self.__target_latency is not None and
+                    self.__seconds_per_item):
+                page_size = min(
+                    page_size,
+                    self.__target_latency / self.__seconds_per_item)
+            page_size = min(page_size,
+                            self.__page_size * self.__max_growth)
+            self.__page_size = max(self.__min_size, int(page_size))
+
+
+# A page of results: the tokens of the page and of the one after it, the
+# items to yield, and for each item the offset just past it in the page.
+# The page is complete unless limit cut it short.
+_Page = collections.namedtuple(
+    '_Page', ['page_token', 'next_page_token', 'items', 'ends', 'complete'])
+
+
+def _YieldPages(service, request, global_params, limit, batch_size, method,
+                field, predicate, current_token_attribute,
+                next_token_attribute, batch_size_attribute, get_field_func,
+                resume_from=None):
+    """Make a series of List requests, yielding a _Page for each.
+
+    See YieldFromList for a description of the arguments. The items of the
+    pages are already filtered by predicate and cut short at limit.
+    """
+    request = encoding.CopyProtoMessage(request)
+    resume_from = resume_from or ListCheckpoint(None, 0)
+    token = resume_from.page_token
+    # The number of items to skip at the start of the page.
+    skip = resume_from.offset
+    _SetattrNested(request, current_token_attribute, token)
+    page_sizing = None
+    if isinstance(batch_size, AdaptivePageSize):
+        page_sizing = batch_size
+    while limit is None or limit:
+        if page_sizing is not None:
+            batch_size = page_sizing.page_size
+        if batch_size_attribute:
+            # On Py3, None is not comparable so min() below will fail.
+            # On Py2, None is always less than any number so if batch_size
+            # is None, the request_batch_size will always be None regardless
+            # of the value of limit. This doesn't generally strike me as the
+            # correct behavior, but this change preserves the existing Py2
+            # behavior on Py3.
+            if batch_size is None:
+                request_batch_size = None
+            else:
+                request_batch_size = min(batch_size,
+                                         limit if limit else batch_size)
+                if skip:
+                    # The skipped items come on top of those to yield. An
+                    # adaptive page size may have shrunk since the
+                    # checkpoint, so this can be more than batch_size.
+                    request_batch_size += skip
+                    if page_sizing is not None:
+                        request_batch_size = min(request_batch_size,
+                                                 page_sizing.max_size)
+            _SetattrNested(request, batch_size_attribute, request_batch_size)
+        start_time = time.time()
+        response = getattr(service, method)(request,
+                                            global_params=global_params)
+        items = get_field_func(response, field)
+        if page_sizing is not None:
+            page_sizing.RecordPage(items, time.time() - start_time)
+        ends = None
+        complete = True
+        if skip or predicate or limit is not None:
+            indexed_items = [(end, item) for end, item in
+                             enumerate(items, 1) if end > skip]
+            if predicate:
+                indexed_items = [(end, item) for end, item in indexed_items
+                                 if predicate(item)]
+            if limit is not None:
+                complete = len(indexed_items) <= limit
+                indexed_items = indexed_items[:limit]
+                limit -= len(indexed_items)
+            ends = [end for end, _ in indexed_items]
+            items = [item for _, item in indexed_items]
+        next_token = _GetattrNested(response, next_token_attribute)
+        yield _Page(token, next_token, items, ends, complete)
+        if not limit and limit is not None:
+            return
+        if not next_token:
+            return
+        token = next_token
+        skip = 0
+        _SetattrNested(request, current_token_attribute, token)
+
+
+def _PrefetchPages(pages, prefetch):
+    """Iterate over pages, fetching up to prefetch of them ahead.
+
+    The pages are fetched in a background thread as soon as the page
+    before them is known, while the caller processes earlier pages; no
+    more than prefetch pages are held that the caller hasn't taken yet.
+    Errors are raised in the caller when it reaches the failed page, and
+    closing the returned generator stops the thread.
+
+    Args:
+      pages: A generator of pages.
+      prefetch: int, The number of pages to fetch ahead.
+
+    Yields:
+      The pages, in order.
+    """
+    results = queue.Queue()
+    # One slot per page that may be fetched but not yet taken.
+    slots = threading.Semaphore(prefetch)
+    stopped = threading.Event()
+
+    def Fetch():
+        try:
+            while True:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                try:
+                    page = next(pages)
+                except StopIteration:
+                    results.put((False, None))
+                    return
+                results.put((True, page))
+        except Exception:  # pylint: disable=broad-except
+            results.put((False, sys.exc_info()))
+        finally:
+            pages.close()
+
+    thread = threading.Thread(target=Fetch)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            is_page, value = results.get()
+            if not is_page:
+                if value is not None:
+                    six.reraise(*value)
+                return
+            slots.release()
+            yield value
+    finally:
+        stopped.set()
+        slots.release()
+        # Wait for a request in progress, so that the client is no longer
+        # in use once the generator is closed.
+        thread.join()
+
+
 def YieldFromList(
         service, request, global_params=None, limit=None, batch_size=100,
         method='List', field='items', predicate=None,
         current_token_attribute='pageToken',
         next_token_attribute='nextPageToken',
         batch_size_attribute='maxResults',
-        get_field_func=_GetattrNested):
+        get_field_func=_GetattrNested, prefetch=None, resume_from=None,
+        checkpoint_callback=None, checkpoint_interval=1):
     """Make a series of List requests, keeping track of page tokens.
 
     Args:
@@ -81,7 +353,8 @@ def YieldFromList(
            provide when calling the given method.
       limit: int, The maximum number of records to yield. None if all available
           records should be yielded.
-      batch_size: int, The number of items to retrieve per request.
+      batch_size: int, The number of items to retrieve per request, or an
+          AdaptivePageSize to choose it for each request.
       method: str, The name of the method used to fetch resources.
       field: str, The field in the response that will be a list of items.
       predicate: lambda, A function that returns true for items to be yielded.
@@ -97,31 +370,245 @@ def YieldFromList(
           If a tuple, path to the attribute.
       get_field_func: Function that returns the items to be yielded. Argument
           is response message, and field.
+      prefetch: int, If given, up to this many pages are fetched ahead in a
+          background thread while the caller processes earlier ones. The
+          requests are the same as without prefetching, but they are made
+          from that thread, so the client of service shouldn't be used for
+          other calls until the generator is exhausted or closed.
+      resume_from: ListCheckpoint, The position to start listing from, as
+          passed to checkpoint_callback by an earlier listing. limit counts
+          the items yielded from there.
+      checkpoint_callback: Function called with the ListCheckpoint that
+          follows the items yielded so far, after every checkpoint_interval
+          pages and when the generator is closed, stopped by limit or fails
+          with an error. It is called with None once every item has been
+          listed.
+      checkpoint_interval: int, The number of pages between calls to
+          checkpoint_callback.
 
     Yields:
       protorpc.message.Message, The resources listed by the service.
 
     """
-    request = encoding.CopyProtoMessage(request)
-    _SetattrNested(request, current_token_attribute, None)
-    while limit is None or limit:
-        if batch_size_attribute:
-            # On Py3, None is not comparable so min() below will fail.
-            # On Py2, None is always less than any number so if batch_size
-            # is None, the request_batch_size will always be None regardless
-            # of the value of limit. This doesn't generally strike me as the
-            # correct behavior, but this change preserves the existing Py2
-            # behavior on Py3.
-            if batch_size is None:
-                request_batch_size = None
+    if checkpoint_interval < 1:
+        raise exceptions.InvalidUserInputError(
+            'checkpoint_interval must be at least 1, got %r' %
+            (checkpoint_interval,))
+    pages = _YieldPages(
+        service, request, global_params, limit, batch_size, method, field,
+        predicate, current_token_attribute, next_token_attribute,
+        batch_size_attribute, get_field_func, resume_from=resume_from)
+    if prefetch:
+        pages = _PrefetchPages(pages, prefetch)
+    position = resume_from or ListCheckpoint(None, 0)
+    saved = position
+    try:
+        for pages_done, page in enumerate(pages, 1):
+            for index, item in enumerate(page.items):
+                end = page.ends[index] if page.ends else index + 1
+                position = ListCheckpoint(page.page_token, end)
+                yield item
+            if not page.complete:
+                break
+            if page.next_page_token:
+                position = ListCheckpoint(page.next_page_token, 0)
             else:
-                request_batch_size = min(batch_size, limit or batch_size)
-            _SetattrNested(request, batch_size_attribute, request_batch_size)
-        response = getattr(service, method)(request,
-                                            global_params=global_params)
-        items = get_field_func(response, field)
-        if predicate:
-            items = list(filter(predicate, items))
+                position = None
+            if (checkpoint_callback is not None and
+                    pages_done % checkpoint_interval == 0):
+                checkpoint_callback(position)
+                saved = position
+    finally:
+        pages.close()
+        if checkpoint_callback is not None and position != saved:
+            checkpoint_callback(position)
+
+
+def PrefixPartitioner(prefixes, attribute='prefix'):
+    """Returns a partitioner listing each of prefixes in its own shard.
+
+    Each prefix is appended to any prefix already set on the request, so
+    for instance PrefixPartitioner(string.ascii_lowercase + string.digits)
+    splits a listing of Cloud Storage objects named with lowercase letters
+    and digits into 36 shards. The prefixes must cover every name to list.
+
+    Args:
+      prefixes: An iterable of str, the prefix of each shard.
+      attribute: str or tuple, The name of the attribute in a request
+          message holding the prefix. If a tuple, path to the attribute.
+
+    Returns:
+      A partitioner for YieldFromListParallel.
+    """
+    prefixes = list(prefixes)
+
+    def Partition(request):
+        base = _GetattrNested(request, attribute) or ''
+        shards = []
+        for prefix in prefixes:
+            shard = encoding.CopyProtoMessage(request)
+            _SetattrNested(shard, attribute, base + prefix)
+            shards.append(shard)
+        return shards
+
+    return Partition
+
+
+def RangePartitioner(boundaries, start_attribute, end_attribute):
+    """Returns a partitioner listing each range of values in its own shard.
+
+    Shard i lists from boundaries[i] to boundaries[i + 1], which suits
+    listings that can be filtered by time, such as BigQuery jobs with
+    minCreationTime and maxCreationTime.
+
+    Args:
+      boundaries: A sorted sequence of at least two boundary values.
+      start_attribute: str or tuple, The name of the attribute in a
+          request message holding the start of the range. If a tuple,
+          path to the attribute.
+      end_attribute: str or tuple, The same for the end of the range.
+
+    Returns:
+      A partitioner for YieldFromListParallel.
+    """
+    boundaries = list(boundaries)
+
+    def Partition(request):
+        shards = []
+        for start, end in zip(boundaries, boundaries[1:]):
+            shard = encoding.CopyProtoMessage(request)
+            _SetattrNested(shard, start_attribute, start)
+            _SetattrNested(shard, end_attribute, end)
+            shards.append(shard)
+        return shards
+
+    return Partition
+
+
+# Marks the end of a shard in the results of _FetchPage.
+_END_OF_SHARD = object()
+
+
+def YieldFromListParallel(
+        service, request, partitioner, global_params=None, limit=None,
+        batch_size=100, method='List', field='items', predicate=None,
+        current_token_attribute='pageToken',
+        next_token_attribute='nextPageToken',
+        batch_size_attribute='maxResults',
+        get_field_func=_GetattrNested, max_workers=4, key=None):
+    """List the shards of a collection concurrently.
+
+    partitioner splits request into one request per shard, and each shard
+    is then paged through as by YieldFromList. Up to max_workers page
+    requests are made at a time, from a pool of threads, and each shard
+    has at most one page fetched ahead of the caller.
+
+    Without key, items are yielded in the order their pages arrive. With
+    key, the shards are merged into the order of key(item); each shard
+    must then list its items in that order, as listings sorted by name
+    do.
+
+    The client of service is used from the pool threads, so it shouldn't
+    be used for other calls until the generator is exhausted or closed;
+    closing the generator waits for the requests in progress.
+
+    Args:
+      service: apitools_base.BaseApiService, A service with a .List() method.
+      request: protorpc.messages.Message, The request message to split.
+      partitioner: Function taking request and returning a list of
+          request messages, one per shard; see PrefixPartitioner and
+          RangePartitioner.
+      global_params: protorpc.messages.Message, The global query parameters to
+           provide when calling the given method.
+      limit: int, The maximum number of records to yield over all shards.
+          None if all available records should be yielded.
+      batch_size: int, The number of items to retrieve per request, or an
+          AdaptivePageSize shared by the shards.
+      method: str, The name of the method used to fetch resources.
+      field: str, The field in the response that will be a list of items.
+      predicate: lambda, A function that returns true for items to be yielded.
+      current_token_attribute: str or tuple, The name of the attribute in a
+          request message holding the page token for the page being
+          requested. If a tuple, path to attribute.
+      next_token_attribute: str or tuple, The name of the attribute in a
+          response message holding the page token for the next page. If a
+          tuple, path to the attribute.
+      batch_size_attribute: str or tuple, The name of the attribute in a
+          response message holding the maximum number of results to be
+          returned. None if caller-specified batch size is unsupported.
+          If a tuple, path to the attribute.
+      get_field_func: Function that returns the items to be yielded. Argument
+          is response message, and field.
+      max_workers: int, The most page requests to make at once.
+      key: Function of an item, If given, items are merged in key order.
+
+    Yields:
+      protorpc.message.Message, The resources listed by the service.
+
+    """
+    if limit is not None and not limit:
+        return
+    shard_pages = [
+        _YieldPages(
+            service, shard_request, global_params, limit, batch_size,
+            method, field, predicate, current_token_attribute,
+            next_token_attribute, batch_size_attribute, get_field_func)
+        for shard_request in partitioner(request)]
+    if not shard_pages:
+        return
+    # In key order, each shard gets its own queue of results.
+    if key is None:
+        results = [queue.Queue()] * len(shard_pages)
+    else:
+        results = [queue.Queue() for _ in shard_pages]
+
+    def FetchPage(shard):
+        try:
+            page = next(shard_pages[shard], _END_OF_SHARD)
+            if page is not _END_OF_SHARD:
+                page = page.items
+            results[shard].put((shard, page, None))
+        except Exception:  # pylint: disable=broad-except
+            results[shard].put((shard, None, sys.exc_info()))
+
+    def TakePage(shard=0):
+        """Wait for a page, and start fetching the next one of its shard."""
+        shard, page, error = results[shard].get()
+        if error is not None:
+            six.reraise(*error)
+        if page is not _END_OF_SHARD:
+            thread_pool.apply_async(FetchPage, (shard,))
+        return shard, page
+
+    def ShardItems(shard):
+        index = itertools.count()
+        while True:
+            _, page = TakePage(shard)
+            if page is _END_OF_SHARD:
+                return
+            for item in page:
+                yield key(item), shard, next(index), item
+
+    def UnorderedItems():
+        num_shards = len(shard_pages)
+        while num_shards:
+            _, page = TakePage()
+            if page is _END_OF_SHARD:
+                num_shards -= 1
+                continue
+            for item in page:
+                yield item
+
+    thread_pool = multiprocessing_pool.ThreadPool(
+        min(max_workers, len(shard_pages)))
+    try:
+        for shard in range(len(shard_pages)):
+            thread_pool.apply_async(FetchPage, (shard,))
+        if key is None:
+            items = UnorderedItems()
+        else:
+            items = (item for _, _, _, item in heapq.merge(
+                *[ShardItems(shard) for shard in range(len(shard_pages))]))
         for item in items:
             yield item
             if limit is None:
@@ -129,7 +616,8 @@ def YieldFromList(
             limit -= 1
             if not limit:
                 return
-        token = _GetattrNested(response, next_token_attribute)
-        if not token:
-            return
-        _SetattrNested(request, current_token_attribute, token)
+    finally:
+        thread_pool.terminate()
+        thread_pool.join()
+        for pages in shard_pages:
+            pages.close()
@@ -15,8 +15,14 @@
 
 """Tests for list_pager."""
 
+import json
+import threading
+import time
 import unittest
 
+from mock import patch
+
+from apitools.base.py import exceptions
 from apitools.base.py import list_pager
 from apitools.base.py.testing import mock
 from samples.fusiontables_sample.fusiontables_v1 \
@@ -295,6 +301,391 @@ class ListPagerTest(unittest.TestCase):
         self.assertEqual(1, len(custom_getter_called))
 
 
+class FakeColumnService(object):
+
+    """Lists columns c0, c1, ..., page_size at a time."""
+
+    def __init__(self, num_pages, page_size=2, failing_page=None):
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.failing_page = failing_page
+        self.condition = threading.Condition()
+        self.page_tokens = []
+
+    def List(self, request, global_params=None):
+        del global_params  # Unused.
+        with self.condition:
+            self.page_tokens.append(request.pageToken)
+            self.condition.notify_all()
+        page = int(request.pageToken or 0)
+        if page == self.failing_page:
+            raise exceptions.HttpError({'status': 500}, 'Failed', 'url')
+        start = page * self.page_size
+        next_page_token = None
+        if page + 1 < self.num_pages:
+            next_page_token = str(page + 1)
+        return messages.ColumnList(
+            items=[messages.Column(name='c%d' % i)
+                   for i in range(start, start + self.page_size)],
+            nextPageToken=next_page_token)
+
+    def WaitForRequests(self, num_requests):
+        with self.condition:
+            while len(self.page_tokens) < num_requests:
+                self.condition.wait(1)
+
+
+class ListPagerPrefetchTest(unittest.TestCase):
+
+    def _List(self, service, **kwds):
+        return list_pager.YieldFromList(
+            service, messages.FusiontablesColumnListRequest(tableId='t'),
+            **kwds)
+
+    def testPrefetch(self):
+        service = FakeColumnService(num_pages=5)
+        results = self._List(service, prefetch=2)
+        self.assertEqual(['c%d' % i for i in range(10)],
+                         [column.name for column in results])
+        self.assertEqual([None, '1', '2', '3', '4'], service.page_tokens)
+
+    def testPrefetchWithLimit(self):
+        service = FakeColumnService(num_pages=5)
+        results = self._List(service, limit=5, prefetch=3)
+        self.assertEqual(['c%d' % i for i in range(5)],
+                         [column.name for column in results])
+        # The last page is requested with the remaining limit only.
+        self.assertEqual([None, '1', '2'], service.page_tokens)
+
+    def testPrefetchIsBounded(self):
+        service = FakeColumnService(num_pages=10)
+        results = self._List(service, prefetch=2)
+        self.assertEqual('c0', next(results).name)
+        # The first page has been taken; two more may be fetched.
+        service.WaitForRequests(3)
+        self.assertEqual('c1', next(results).name)
+        self.assertEqual(3, len(service.page_tokens))
+        results.close()
+        self.assertEqual(3, len(service.page_tokens))
+
+    def testPrefetchError(self):
+        service = FakeColumnService(num_pages=5, failing_page=1)
+        results = self._List(service, prefetch=2)
+        self.assertEqual('c0', next(results).name)
+        self.assertEqual('c1', next(results).name)
+        self.assertRaises(exceptions.HttpError, next, results)
+        self.assertEqual([None, '1'], service.page_tokens)
+
+
+class SizedColumnService(object):
+
+    """Lists num_items columns, each taking seconds_per_item to fetch."""
+
+    def __init__(self, num_items, seconds_per_item, clock):
+        self.num_items = num_items
+        self.seconds_per_item = seconds_per_item
+        self.clock = clock
+        self.page_sizes = []
+
+    def List(self, request, global_params=None):
+        del global_params  # Unused.
+        self.page_sizes.append(request.maxResults)
+        start = int(request.pageToken or 0)
+        end = min(self.num_items, start + request.maxResults)
+        self.clock[0] += self.seconds_per_item * (end - start)
+        next_page_token = None
+        if end < self.num_items:
+            next_page_token = str(end)
+        return messages.ColumnList(
+            items=[messages.Column(name='c%d' % i)
+                   for i in range(start, end)],
+            nextPageToken=next_page_token)
+
+
+class AdaptivePageSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = [0.0]
+        patcher = patch.object(list_pager.time, 'time',
+                               side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _List(self, service, page_sizing):
+        return list_pager.YieldFromList(
+            service, messages.FusiontablesColumnListRequest(tableId='t'),
+            batch_size=page_sizing)
+
+    def testGrowsTowardsTargetLatency(self):
+        service = SizedColumnService(1000, 0.001, self.clock)
+        page_sizing = list_pager.AdaptivePageSize(
+            initial_size=10, max_size=500, target_bytes=None)
+        results = self._List(service, page_sizing)
+        self.assertEqual(['c%d' % i for i in range(1000)],
+                         [column.name for column in results])
+        # A page of 1000 items would take a second, but the server only
+        # allows 500.
+        self.assertEqual([10, 20, 40, 80, 160, 320, 500],
+                         service.page_sizes)
+
+    def testShrinksForSlowItems(self):
+        service = SizedColumnService(100, 0.1, self.clock)
+        page_sizing = list_pager.AdaptivePageSize(
+            initial_size=50, target_bytes=None)
+        list(self._List(service, page_sizing))
+        self.assertEqual([50, 10, 10, 10, 10, 10], service.page_sizes)
+
+    def testResume(self):
+        service = SizedColumnService(3000, 0.001, self.clock)
+        page_sizing = list_pager.AdaptivePageSize(
+            initial_size=10, max_size=1000, target_bytes=None)
+        results = list_pager.YieldFromList(
+            service, messages.FusiontablesColumnListRequest(tableId='t'),
+            batch_size=page_sizing,
+            resume_from=list_pager.ListCheckpoint('300', 400))
+        self.assertEqual(['c%d' % i for i in range(700, 3000)],
+                         [column.name for column in results])
+        # The first request covers the 400 skipped items and a page.
+        self.assertEqual(410, service.page_sizes[0])
+
+    def testTargetBytes(self):
+        page_sizing = list_pager.AdaptivePageSize(
+            initial_size=100, target_bytes=2000, target_latency=None,
+            item_size_func=lambda item: 100)
+        page_sizing.RecordPage(['x'] * 100, 1.0)
+        self.assertEqual(20, page_sizing.page_size)
+
+    def testSmoothing(self):
+        page_sizing = list_pager.AdaptivePageSize(
+            initial_size=10, target_bytes=None, smoothing=0.5)
+        page_sizing.RecordPage(['x'] * 10, 0.1)
+        self.assertEqual(20, page_sizing.page_size)
+        # The average is now 5ms per item.
+        page_sizing.RecordPage(['x'] * 10, 0.0)
+        self.assertEqual(40, page_sizing.page_size)
+        page_sizing.RecordPage(['x'] * 10, 1.0)
+        self.assertEqual(19, page_sizing.page_size)
+
+    def testBounds(self):
+        page_sizing = list_pager.AdaptivePageSize(
+            initial_size=5000, min_size=5, max_size=100)
+        self.assertEqual(100, page_sizing.page_size)
+        page_sizing.RecordPage([messages.Column(name='c')], 10.0)
+        self.assertEqual(5, page_sizing.page_size)
+        page_sizing.RecordPage([], 10.0)
+        self.assertEqual(5, page_sizing.page_size)
+
+
+class ListPagerCheckpointTest(unittest.TestCase):
+
+    def _List(self, service, **kwds):
+        return list_pager.YieldFromList(
+            service, messages.FusiontablesColumnListRequest(tableId='t'),
+            **kwds)
+
+    def testCheckpointEveryPage(self):
+        checkpoints = []
+        list(self._List(FakeColumnService(num_pages=3),
+                        checkpoint_callback=checkpoints.append))
+        self.assertEqual([list_pager.ListCheckpoint('1', 0),
+                          list_pager.ListCheckpoint('2', 0),
+                          None], checkpoints)
+
+    def testCheckpointInterval(self):
+        checkpoints = []
+        list(self._List(FakeColumnService(num_pages=5),
+                        checkpoint_callback=checkpoints.append,
+                        checkpoint_interval=2))
+        self.assertEqual([list_pager.ListCheckpoint('2', 0),
+                          list_pager.ListCheckpoint('4', 0),
+                          None], checkpoints)
+
+    def testCheckpointOnClose(self):
+        checkpoints = []
+        results = self._List(FakeColumnService(num_pages=5, page_size=3),
+                             checkpoint_callback=checkpoints.append)
+        self.assertEqual(['c0', 'c1', 'c2', 'c3'],
+                         [next(results).name for _ in range(4)])
+        results.close()
+        self.assertEqual([list_pager.ListCheckpoint('1', 0),
+                          list_pager.ListCheckpoint('1', 1)], checkpoints)
+
+    def testResume(self):
+        checkpoint = list_pager.ListCheckpoint(*json.loads(
+            json.dumps(list_pager.ListCheckpoint('1', 1))))
+        service = FakeColumnService(num_pages=3, page_size=3)
+        results = self._List(service, resume_from=checkpoint)
+        self.assertEqual(['c4', 'c5', 'c6', 'c7', 'c8'],
+                         [column.name for column in results])
+        self.assertEqual(['1', '2'], service.page_tokens)
+
+    def testResumeWithLimitAndPredicate(self):
+        checkpoints = []
+        results = self._List(
+            FakeColumnService(num_pages=3, page_size=3), limit=2,
+            predicate=lambda column: column.name != 'c5',
+            resume_from=list_pager.ListCheckpoint('1', 1),
+            checkpoint_callback=checkpoints.append)
+        self.assertEqual(['c4', 'c6'], [column.name for column in results])
+        self.assertEqual([list_pager.ListCheckpoint('2', 0),
+                          list_pager.ListCheckpoint('2', 1)], checkpoints)
+
+    def testCheckpointWithPrefetch(self):
+        checkpoints = []
+        results = self._List(FakeColumnService(num_pages=5), prefetch=2,
+                             checkpoint_callback=checkpoints.append)
+        self.assertEqual('c0', next(results).name)
+        results.close()
+        self.assertEqual([list_pager.ListCheckpoint(None, 1)], checkpoints)
+
+    def testCheckpointOnError(self):
+        checkpoints = []
+        results = self._List(FakeColumnService(num_pages=5, failing_page=2),
+                             checkpoint_callback=checkpoints.append,
+                             checkpoint_interval=5)
+        self.assertRaises(exceptions.HttpError, list, results)
+        self.assertEqual([list_pager.ListCheckpoint('2', 0)], checkpoints)
+
+    def testInvalidCheckpointInterval(self):
+        results = self._List(FakeColumnService(num_pages=1),
+                             checkpoint_interval=0)
+        self.assertRaises(exceptions.InvalidUserInputError, next, results)
+
+
+class FakeShardedColumnService(object):
+
+    """Lists the columns named for each table, page_size at a time."""
+
+    def __init__(self, names_by_table, page_size=2, delay=0):
+        self.names_by_table = names_by_table
+        self.page_size = page_size
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.num_requests = 0
+
+    def List(self, request, global_params=None):
+        del global_params  # Unused.
+        with self.lock:
+            self.num_requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        names = self.names_by_table[request.tableId]
+        if names is None:
+            raise exceptions.HttpError({'status': 500}, 'Failed', 'url')
+        start = int(request.pageToken or 0)
+        end = start + min(self.page_size, request.maxResults)
+        return messages.ColumnList(
+            items=[messages.Column(name=name) for name in names[start:end]],
+            nextPageToken=str(end) if end < len(names) else None)
+
+
+class ListPagerParallelTest(unittest.TestCase):
+
+    def _List(self, service, tables, **kwds):
+        return list_pager.YieldFromListParallel(
+            service, messages.FusiontablesColumnListRequest(tableId=''),
+            list_pager.PrefixPartitioner(tables, attribute='tableId'),
+            **kwds)
+
+    def testWithMockClient(self):
+        mocked_client = mock.Client(fusiontables.FusiontablesV1)
+        mocked_client.Mock()
+        self.addCleanup(mocked_client.Unmock)
+        mocked_client.column.List.Expect(
+            messages.FusiontablesColumnListRequest(
+                maxResults=100, pageToken=None, tableId='ta'),
+            messages.ColumnList(
+                items=[messages.Column(name='c0')], nextPageToken='x'))
+        mocked_client.column.List.Expect(
+            messages.FusiontablesColumnListRequest(
+                maxResults=100, pageToken=None, tableId='tb'),
+            messages.ColumnList(items=[messages.Column(name='c1')]))
+        mocked_client.column.List.Expect(
+            messages.FusiontablesColumnListRequest(
+                maxResults=100, pageToken='x', tableId='ta'),
+            messages.ColumnList(items=[messages.Column(name='c2')]))
+
+        client = fusiontables.FusiontablesV1(get_credentials=False)
+        request = messages.FusiontablesColumnListRequest(tableId='t')
+        # With one worker, the requests are made in a predictable order.
+        results = list_pager.YieldFromListParallel(
+            client.column, request,
+            list_pager.PrefixPartitioner('ab', attribute='tableId'),
+            max_workers=1)
+
+        self.assertEqual(['c0', 'c1', 'c2'],
+                         [column.name for column in results])
+
+    def testConcurrentShards(self):
+        service = FakeShardedColumnService(dict(
+            (table, ['%s%d' % (table, i) for i in range(4)])
+            for table in 'abcdef'), delay=0.01)
+        results = self._List(service, 'abcdef', max_workers=3)
+        self.assertEqual(
+            sorted('%s%d' % (table, i) for table in 'abcdef'
+                   for i in range(4)),
+            sorted(column.name for column in results))
+        self.assertEqual(12, service.num_requests)
+        self.assertEqual(3, service.max_in_flight)
+
+    def testMergeByKey(self):
+        service = FakeShardedColumnService({
+            'a': ['c1', 'c4', 'c5'],
+            'b': ['c0', 'c2', 'c3', 'c6'],
+            'c': [],
+        })
+        results = self._List(service, 'abc', key=lambda column: column.name)
+        self.assertEqual(['c%d' % i for i in range(7)],
+                         [column.name for column in results])
+
+    def testLimit(self):
+        service = FakeShardedColumnService({
+            'a': ['a%d' % i for i in range(10)],
+            'b': ['b%d' % i for i in range(10)],
+        })
+        results = list(self._List(service, 'ab', limit=3,
+                                  key=lambda column: column.name))
+        self.assertEqual(['a0', 'a1', 'a2'],
+                         [column.name for column in results])
+
+    def testCloseEarly(self):
+        service = FakeShardedColumnService({
+            'a': ['a%d' % i for i in range(100)],
+            'b': ['b%d' % i for i in range(100)],
+        })
+        results = self._List(service, 'ab', max_workers=2)
+        next(results)
+        results.close()
+        num_requests = service.num_requests
+        # At most the next page of each shard was fetched ahead.
+        self.assertLessEqual(num_requests, 4)
+        time.sleep(0.05)
+        self.assertEqual(num_requests, service.num_requests)
+        self.assertEqual(0, service.in_flight)
+
+    def testError(self):
+        service = FakeShardedColumnService({'a': ['a0'], 'b': None})
+        results = self._List(service, 'ab', key=lambda column: column.name)
+        self.assertRaises(exceptions.HttpError, list, results)
+
+    def testRangePartitioner(self):
+        partitioner = list_pager.RangePartitioner(
+            [0, 10, 25], 'startIndex', 'maxResults')
+        shards = partitioner(messages.FusiontablesTaskListRequest(
+            tableId='t'))
+        self.assertEqual(
+            [messages.FusiontablesTaskListRequest(
+                tableId='t', startIndex=0, maxResults=10),
+             messages.FusiontablesTaskListRequest(
+                 tableId='t', startIndex=10, maxResults=25)],
+            shards)
+
+
 class ListPagerAttributeTest(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Waits for many long-running operations by polling them in batches."""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from six.moves import http_client
+
+from apitools.base.py import batch
+from apitools.base.py import exceptions
+
+try:
+    from concurrent import futures
+except ImportError:
+    # Python 2 without the futures backport; OperationWaiter is unavailable.
+    futures = None
+
+__all__ = [
+    'OperationWaiter',
+]
+
+
+def _HasField(message_type, name):
+    try:
+        message_type.field_by_name(name)
+    except KeyError:
+        return False
+    return True
+
+
+def _DefaultRequestFunc(service, method):
+    """Return a function making the request for polling an operation.
+
+    The operation name goes to the name field of the request, if there is
+    one, or else the last segment of the name goes to the only path
+    parameter, as in operations/{operationsId}.
+    """
+    method_config = service.GetMethodConfig(method)
+    request_type = service.GetRequestType(method)
+    if _HasField(request_type, 'name'):
+        return lambda operation: request_type(name=operation.name)
+    if len(method_config.path_params) == 1:
+        field = method_config.path_params[0]
+        return lambda operation: request_type(
+            **{field: operation.name.rsplit('/', 1)[-1]})
+    raise exceptions.InvalidUserInputError(
+        'Cannot tell how to poll an operation with %s; pass request_func' %
+        request_type.__name__)
+
+
+class _PendingOperation(object):
+
+    """An operation being waited for, with its polling state."""
+
+    def __init__(self, request, future, interval):
+        self.request = request
+        self.future = future
+        self.interval = interval
+        # The number of polls in a row that failed.
+        self.failures = 0
+
+
+class OperationWaiter(object):
+
+    """Polls long-running operations until they are done.
+
+    Operations are polled with the Get method of an operations service.
+    Each operation has its own polling interval, which starts at
+    initial_interval and grows by multiplier after every poll up to
+    max_interval, with random jitter so that operations started together
+    spread out. The operations due at about the same time are polled
+    together in batch requests, so the number of requests grows with the
+    number of batches rather than with the number of operations:
+
+      with operation_waiter.OperationWaiter(client.operations) as waiter:
+          results = [waiter.Add(operation) for operation in operations]
+          for result in results:
+              operation = result.result()
+
+    Polling happens in a background thread, using an http that no other
+    thread uses. A future resolves to the finished operation, whose error
+    field tells whether it failed, or raises the HttpError of a poll that
+    failed with a code that isn't retryable. Cancel a future to stop
+    polling its operation.
+    """
+
+    def __init__(self, service, http=None, method='Get', request_func=None,
+                 global_params=None, batch_url=None, max_batch_size=100,
+                 initial_interval=1.0, max_interval=60.0, multiplier=1.5,
+                 jitter=0.25, batch_window=1.0, retryable_codes=None,
+                 max_retries=1):
+        """Initialize an OperationWaiter.
+
+        Args:
+          service: base_api.BaseApiService, The service of the operations.
+          http: httplib2.Http object for the batch requests, used only by
+              the polling thread. Defaults to a new http authorized with
+              the credentials of the client of service.
+          method: str, The name of the method polling an operation.
+          request_func: Function returning the request message for polling
+              an operation. Defaults to one passing the name of the
+              operation.
+          global_params: Additional parameters for the poll requests.
+          batch_url: URL to send batch requests to.
+          max_batch_size: The most polls to send in one batch.
+          initial_interval: Seconds between adding an operation and polling
+              it for the first time.
+          max_interval: Upper bound in seconds between polls of an
+              operation.
+          multiplier: Factor by which the interval grows after each poll.
+          jitter: Fraction by which intervals are randomly made shorter or
+              longer.
+          batch_window: Polls due within this many seconds are sent along
+              with those due now.
+          retryable_codes: A list of integer HTTP codes of failed polls to
+              retry later. Defaults to 429 and the 5xx codes that are
+              usually transient.
+          max_retries: Max number of polls of an operation in a row that
+              may fail with a retryable code, or with an error sending
+              their batch, before its future raises the error. Failed
+              polls are retried on the schedule of the operation, not
+              within the batch, so that other operations aren't held up.
+
+        Raises:
+          InvalidUserInputError: if max_batch_size is not positive, or the
+              request for polling can't be made without request_func.
+          NotYetImplementedError: if concurrent.futures is not available.
+        """
+        if futures is None:
+            raise exceptions.NotYetImplementedError(
+                'OperationWaiter requires concurrent.futures')
+        if max_batch_size < 1:
+            raise exceptions.InvalidUserInputError(
+                'max_batch_size must be positive')
+        self.__service = service
+        if http is None:
+            credentials = getattr(
+                getattr(service.client.http, 'request', None), 'credentials',
+                None)
+            # pylint: disable=protected-access
+            http = batch._NewHttp(credentials)
+        self.__http = http
+        self.__method = method
+        self.__request_func = (request_func or
+                               _DefaultRequestFunc(service, method))
+        self.__global_params = global_params
+        self.__batch_url = batch_url
+        self.__max_batch_size = max_batch_size
+        self.__initial_interval = initial_interval
+        self.__max_interval = max_interval
+        self.__multiplier = multiplier
+        self.__jitter = jitter
+        self.__batch_window = batch_window
+        if retryable_codes is None:
+            retryable_codes = [429, http_client.INTERNAL_SERVER_ERROR,
+                               http_client.BAD_GATEWAY,
+                               http_client.SERVICE_UNAVAILABLE,
+                               http_client.GATEWAY_TIMEOUT]
+        self.__retryable_codes = retryable_codes
+        self.__max_retries = max_retries
+
+        self.__condition = threading.Condition()
+        # Heap of (due time, sequence number, _PendingOperation).
+        self.__pending = []
+        self.__sequence = itertools.count()
+        self.__closed = False
+        self.__thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Add(self, operation):
+        """Start waiting for an operation.
+
+        Args:
+          operation: The Operation message returned by the call that
+              started it.
+
+        Returns:
+          A concurrent.futures.Future for the finished Operation.
+
+        Raises:
+          InvalidUserInputError: if the OperationWaiter is closed.
+        """
+        future = futures.Future()
+        if operation.done:
+            future.set_running_or_notify_cancel()
+            future.set_result(operation)
+            return future
+        pending = _PendingOperation(self.__request_func(operation), future,
+                                    self.__initial_interval)
+        with self.__condition:
+            if self.__closed:
+                raise exceptions.InvalidUserInputError(
+                    'Cannot add operations to a closed OperationWaiter')
+            self.__Schedule(pending)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__PollLoop)
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify_all()
+        return future
+
+    def Wait(self, operations, timeout=None):
+        """Wait for operations to finish.
+
+        Args:
+          operations: The Operation messages to wait for.
+          timeout: Seconds to wait in total, or None to wait for as long
+              as it takes.
+
+        Returns:
+          The finished Operation messages, in the same order.
+
+        Raises:
+          concurrent.futures.TimeoutError: if the operations didn't finish
+              in time. They are no longer polled.
+          HttpError: if polling an operation failed.
+        """
+        results = [self.Add(operation) for operation in operations]
+        done, not_done = futures.wait(results, timeout=timeout)
+        for result in not_done:
+            result.cancel()
+        if not_done:
+            raise futures.TimeoutError(
+                '%d of %d operations not done after %s seconds' %
+                (len(not_done), len(results), timeout))
+        return [result.result() for result in results]
+
+    def Close(self):
+        """Stop polling, and cancel the futures of unfinished operations."""
+        with self.__condition:
+            self.__closed = True
+            thread = self.__thread
+            self.__condition.notify_all()
+        if thread is not None:
+            thread.join()
+        for _, _, pending in self.__pending:
+            pending.future.cancel()
+        self.__pending = []
+
+    def __Schedule(self, pending):
+        """Add pending to the heap, due after its interval with jitter."""
+        due = time.time() + pending.interval * random.uniform(
+            1 - self.__jitter, 1 + self.__jitter)
+        heapq.heappush(self.__pending,
+                       (due, next(self.__sequence), pending))
+
+    def __NextPolls(self):
+        """Wait for polls to be due and take them, or None when closed."""
+        with self.__condition:
+            while not self.__closed:
+                if self.__pending:
+                    timeout = self.__pending[0][0] - time.time()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                self.__condition.wait(timeout)
+            if self.__closed:
+                return None
+            # Send the polls that are due soon anyway along with these.
+            horizon = time.time() + self.__batch_window
+            due = []
+            while self.__pending and self.__pending[0][0] <= horizon:
+                pending = heapq.heappop(self.__pending)[2]
+                if not pending.future.done():
+                    due.append(pending)
+            return due
+
+    def __PollLoop(self):
+        while True:
+            due = self.__NextPolls()
+            if due is None:
+                return
+            if not due:
+                continue
+            try:
+                self.__Poll(due)
+            except Exception as e:  # pylint: disable=broad-except
+                # Don't leave these futures pending forever.
+                logging.exception('Polling %d operations failed', len(due))
+                for pending in due:
+                    if pending.future.done():
+                        continue
+                    if pending.future.set_running_or_notify_cancel():
+                        pending.future.set_exception(e)
+
+    def __Poll(self, due):
+        """Poll operations, and resolve or reschedule each of them."""
+        batch_api_request = batch.BatchApiRequest(
+            batch_url=self.__batch_url,
+            retryable_codes=self.__retryable_codes)
+        for pending in due:
+            batch_api_request.Add(self.__service, self.__method,
+                                  pending.request,
+                                  global_params=self.__global_params)
+        batch_error = None
+        try:
+            # Send each poll once: retrying within Execute would hold up
+            # every other operation while it waits.
+            api_calls = batch_api_request.Execute(
+                self.__http, max_batch_size=self.__max_batch_size,
+                max_retries=1)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning('Polling %d operations failed', len(due),
+                            exc_info=True)
+            batch_error = e
+            api_calls = [None] * len(due)
+
+        for pending, api_call in zip(due, api_calls):
+            if api_call is not None and api_call.terminal_state:
+                if api_call.is_error:
+                    if pending.future.set_running_or_notify_cancel():
+                        pending.future.set_exception(api_call.exception)
+                    continue
+                if api_call.response.done:
+                    if pending.future.set_running_or_notify_cancel():
+                        pending.future.set_result(api_call.response)
+                    continue
+                pending.failures = 0
+            else:
+                # The poll failed in a way worth retrying.
+                pending.failures += 1
+                if pending.failures > self.__max_retries:
+                    error = batch_error
+                    if api_call is not None and api_call.is_error:
+                        error = api_call.exception
+                    if error is None:
+                        error = exceptions.CommunicationError(
+                            'No response polling %s' % pending.request)
+                    if pending.future.set_running_or_notify_cancel():
+                        pending.future.set_exception(error)
+                    continue
+            pending.interval = min(self.__max_interval,
+                                   pending.interval * self.__multiplier)
+            with self.__condition:
+                self.__Schedule(pending)
@@ -0,0 +1,220 @@
+#
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for operation_waiter."""
+
+from concurrent import futures
+import json
+import threading
+import unittest
+
+import mock
+
+from apitools.base.py import batch
+from apitools.base.py import exceptions
+from apitools.base.py import http_wrapper
+from apitools.base.py import operation_waiter
+from samples.servicemanagement_sample.servicemanagement_v1 \
+    import servicemanagement_v1_client as servicemanagement
+from samples.servicemanagement_sample.servicemanagement_v1 \
+    import servicemanagement_v1_messages as messages
+
+
+class OperationWaiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = servicemanagement.ServicemanagementV1(
+            get_credentials=False)
+        # Operation id -> polls left until it is done.
+        self.polls_left = {}
+        # Operation id -> status codes of its next polls.
+        self.failures = {}
+        self.batches = []
+        self.https = []
+        self.lock = threading.Lock()
+        patcher = mock.patch.object(http_wrapper, 'MakeRequest',
+                                    side_effect=self._MakeRequest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _MakeRequest(self, http, request, **unused_kwds):
+        """Answer each poll in the batch from polls_left and failures."""
+        boundary = batch._GetBoundary(request.headers['content-type'])
+        ids = []
+        parts = []
+        for part in batch._SplitMultipart(
+                request.body.decode('utf-8'), boundary):
+            headers, payload = batch._ParseHeaders(part)
+            content_id = dict((name.lower(), value)
+                              for name, value in headers)['content-id']
+            operation_id = payload.split(' ')[1].split('/')[-1].split('?')[0]
+            ids.append(operation_id)
+            with self.lock:
+                statuses = self.failures.get(operation_id)
+                status = statuses.pop(0) if statuses else 200
+                if status == 200:
+                    self.polls_left[operation_id] -= 1
+                done = self.polls_left[operation_id] <= 0
+            body = json.dumps({'name': 'operations/' + operation_id,
+                               'done': done})
+            parts.append(
+                'content-id: %s\n\nHTTP/1.1 %d X\n'
+                'content-type: application/json\n\n%s' % (
+                    content_id, status, body))
+        with self.lock:
+            self.batches.append(ids)
+            self.https.append(http)
+        return http_wrapper.Response(
+            info={
+                'status': '200',
+                'content-type': 'multipart/mixed; boundary="b"',
+            },
+            content='--b\n%s\n--b--' % '\n--b\n'.join(parts),
+            request_url=None)
+
+    def _Waiter(self, **kwds):
+        kwds.setdefault('initial_interval', 0.01)
+        kwds.setdefault('max_interval', 0.05)
+        kwds.setdefault('batch_window', 0.5)
+        return operation_waiter.OperationWaiter(
+            self.client.operations, **kwds)
+
+    def _Operations(self, num_operations, polls):
+        for i in range(num_operations):
+            self.polls_left['op%d' % i] = polls
+        return [messages.Operation(name='operations/op%d' % i)
+                for i in range(num_operations)]
+
+    def testPollsInBatches(self):
+        operations = self._Operations(250, polls=3)
+        # Leave time to add every operation before the first poll.
+        with self._Waiter(initial_interval=0.2) as waiter:
+            results = waiter.Wait(operations, timeout=10)
+        self.assertEqual(['operations/op%d' % i for i in range(250)],
+                         [operation.name for operation in results])
+        self.assertTrue(all(operation.done for operation in results))
+        # Each poll of 250 operations takes three batches.
+        self.assertEqual(9, len(self.batches))
+        self.assertTrue(all(len(ids) <= 100 for ids in self.batches))
+
+    def testFinishesFuturesIndividually(self):
+        operations = self._Operations(2, polls=1)
+        self.polls_left['op1'] = 4
+        with self._Waiter(batch_window=0) as waiter:
+            first, second = [waiter.Add(op) for op in operations]
+            self.assertTrue(first.result(timeout=10).done)
+            self.assertFalse(second.done())
+            self.assertTrue(second.result(timeout=10).done)
+
+    def testDoneOperation(self):
+        with self._Waiter() as waiter:
+            result = waiter.Add(messages.Operation(name='x', done=True))
+        self.assertEqual('x', result.result().name)
+        self.assertEqual([], self.batches)
+
+    def testRetriesTransientFailures(self):
+        operations = self._Operations(1, polls=1)
+        self.failures['op0'] = [503, 503]
+        with self._Waiter(max_retries=2) as waiter:
+            result, = waiter.Wait(operations, timeout=10)
+        self.assertTrue(result.done)
+        self.assertEqual(3, len(self.batches))
+
+    def testTransientFailuresDontHoldUpPolling(self):
+        operations = self._Operations(2, polls=1)
+        self.polls_left['op1'] = 2
+        self.failures['op0'] = [503] * 100
+        with mock.patch.object(batch.time, 'sleep') as sleep:
+            with self._Waiter(batch_window=0, max_retries=100) as waiter:
+                first, second = [waiter.Add(op) for op in operations]
+                self.assertTrue(second.result(timeout=10).done)
+                first.cancel()
+        # Failed polls are rescheduled, not retried inside the batch.
+        self.assertFalse(sleep.called)
+
+    def testGivesUpAfterMaxRetries(self):
+        operations = self._Operations(1, polls=1)
+        self.failures['op0'] = [503] * 3
+        with self._Waiter(max_retries=2) as waiter:
+            result = waiter.Add(operations[0])
+            with self.assertRaises(exceptions.HttpError) as context:
+                result.result(timeout=10)
+        self.assertEqual(503, context.exception.status_code)
+        self.assertEqual(3, len(self.batches))
+
+    def testFailure(self):
+        operations = self._Operations(2, polls=1)
+        self.failures['op1'] = [404]
+        with self._Waiter() as waiter:
+            first, second = [waiter.Add(op) for op in operations]
+            self.assertTrue(first.result(timeout=10).done)
+            with self.assertRaises(exceptions.HttpError) as context:
+                second.result(timeout=10)
+        self.assertEqual(404, context.exception.status_code)
+
+    def testBackoff(self):
+        operations = self._Operations(1, polls=100)
+        with mock.patch.object(operation_waiter.random, 'uniform',
+                               return_value=1.0):
+            with self._Waiter(initial_interval=0.01, max_interval=0.04,
+                              multiplier=2, batch_window=0) as waiter:
+                result = waiter.Add(operations[0])
+                self.assertRaises(futures.TimeoutError, result.result,
+                                  timeout=0.5)
+        self.assertTrue(result.cancelled())
+        # Polls 0.01, 0.02 and then every 0.04 seconds.
+        self.assertLess(len(self.batches), 15)
+        self.assertGreater(len(self.batches), 5)
+
+    def testWaitTimeout(self):
+        operations = self._Operations(1, polls=100)
+        with self._Waiter() as waiter:
+            self.assertRaises(futures.TimeoutError, waiter.Wait, operations,
+                              timeout=0.1)
+
+    def testRequestFunc(self):
+        self.polls_left['custom'] = 1
+        with self._Waiter(
+                request_func=lambda operation:
+                messages.ServicemanagementOperationsGetRequest(
+                    operationsId='custom')) as waiter:
+            result, = waiter.Wait([messages.Operation(name='other')])
+        self.assertEqual('operations/custom', result.name)
+
+    def testUsesOwnHttp(self):
+        operations = self._Operations(1, polls=1)
+        with self._Waiter() as waiter:
+            waiter.Wait(operations, timeout=10)
+        http, = self.https
+        self.assertIsNotNone(http)
+        self.assertIsNot(self.client.http, http)
+
+    def testUnexpectedPollError(self):
+        operations = self._Operations(2, polls=1)
+        with self._Waiter() as waiter:
+            with mock.patch.object(batch.BatchApiRequest, 'Add',
+                                   side_effect=ValueError('unexpected')):
+                result = waiter.Add(operations[0])
+                with self.assertRaises(ValueError):
+                    result.result(timeout=10)
+            # The polling thread is still running.
+            result = waiter.Add(operations[1])
+            self.assertTrue(result.result(timeout=10).done)
+
+    def testClosed(self):
+        waiter = self._Waiter()
+        waiter.Close()
+        self.assertRaises(exceptions.InvalidUserInputError, waiter.Add,
+                          messages.Operation(name='operations/x'))
@@ -23,10 +23,11 @@ class StreamSlice(object):
 
     """Provides a slice-like object for streams."""
 
-    def __init__(self, stream, max_bytes):
+    def __init__(self, stream, max_bytes, bandwidth_limiter=None):
         self.__stream = stream
         self.__remaining_bytes = max_bytes
         self.__max_bytes = max_bytes
+        self.__bandwidth_limiter = bandwidth_limiter
 
     def __str__(self):
         return 'Slice of stream %s with %s/%s bytes not yet read' % (
@@ -76,4 +77,6 @@ class StreamSlice(object):
                     self.__max_bytes,
                     self.__max_bytes - self.__remaining_bytes))
         self.__remaining_bytes -= len(data)
+        if self.__bandwidth_limiter is not None:
+            self.__bandwidth_limiter.Consume(len(data))
         return data
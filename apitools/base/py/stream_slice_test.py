@@ -18,6 +18,7 @@
 import string
 import unittest
 
+import mock
 import six
 
 from apitools.base.py import exceptions
@@ -63,3 +64,12 @@ class StreamSliceTest(unittest.TestCase):
         with self.assertRaises(exceptions.StreamExhausted) as e:
             ss.read(10)
         self.assertIn('exhausted after %d' % len(self.value), str(e.exception))
+
+    def testBandwidthLimiterChargedPerRead(self):
+        limiter = mock.Mock()
+        ss = stream_slice.StreamSlice(self.stream, 10,
+                                      bandwidth_limiter=limiter)
+        ss.read(3)
+        ss.read()
+        self.assertEqual([mock.call(3), mock.call(7)],
+                         limiter.Consume.call_args_list)
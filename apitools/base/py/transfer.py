@@ -18,16 +18,24 @@
 from __future__ import print_function
 
 import email.generator as email_generator
-import email.mime.multipart as mime_multipart
-import email.mime.nonmultipart as mime_nonmultipart
+import collections
 import io
 import json
+import logging
 import mimetypes
+import mmap
 import os
+import random
+import socket
+import sys
 import threading
+import time
+import zlib
 
+import httplib2
 import six
 from six.moves import http_client
+from six.moves import queue
 
 from apitools.base.py import buffered_stream
 from apitools.base.py import compression
@@ -37,10 +45,17 @@ from apitools.base.py import stream_slice
 from apitools.base.py import util
 
 __all__ = [
+    'BandwidthLimiter',
     'Download',
+    'RemoteFile',
     'Upload',
     'RESUMABLE_UPLOAD',
     'SIMPLE_UPLOAD',
+    'TransferManager',
+    'TransferStats',
+    'UploadStrategyPolicy',
+    'ThresholdUploadStrategyPolicy',
+    'AdaptiveUploadStrategyPolicy',
     'DownloadProgressPrinter',
     'DownloadCompletePrinter',
     'UploadProgressPrinter',
@@ -48,8 +63,13 @@ __all__ = [
 ]
 
 _RESUMABLE_UPLOAD_THRESHOLD = 5 << 20
+# Smallest size AdaptiveUploadStrategyPolicy uses resumable uploads for by
+# default; below this the extra round-trip is rarely worth it.
+_MIN_ADAPTIVE_UPLOAD_THRESHOLD = 256 << 10
 SIMPLE_UPLOAD = 'simple'
 RESUMABLE_UPLOAD = 'resumable'
+# Content-Encodings that Download(decompress=True) decodes.
+_DECOMPRESSIBLE_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
 
 
 def DownloadProgressPrinter(response, unused_download):
@@ -75,12 +95,94 @@ def UploadCompletePrinter(unused_response, unused_upload):
     print('Upload complete')
 
 
+class BandwidthLimiter(object):
+
+    """A token bucket limiting the rate of bytes sent or received.
+
+    A limiter can be shared by any number of transfers, in any number of
+    threads, to cap their combined rate. To also cap a single transfer,
+    give it its own limiter with the shared one as parent; bytes are then
+    charged to both.
+
+    Requests for bytes are granted in first-come, first-served order, in
+    pieces of at most quantum bytes, so a transfer asking for a large chunk
+    can't hold up others asking for small reads for long.
+
+    Fields:
+      bytes_per_second: Sustained rate allowed through this limiter.
+      burst_bytes: Number of bytes that may be granted at once after the
+          limiter has been idle.
+      parent: Optional BandwidthLimiter that is also charged.
+    """
+
+    def __init__(self, bytes_per_second, burst_bytes=None, parent=None,
+                 quantum=65536):
+        if bytes_per_second <= 0:
+            raise exceptions.InvalidUserInputError(
+                'bytes_per_second must be positive')
+        self.bytes_per_second = float(bytes_per_second)
+        self.burst_bytes = burst_bytes or max(int(bytes_per_second), 1)
+        self.parent = parent
+        self.__quantum = max(1, min(quantum, self.burst_bytes))
+        self.__condition = threading.Condition()
+        self.__tokens = float(self.burst_bytes)
+        self.__last_refill = time.time()
+        self.__waiters = collections.deque()
+
+    def __Refill(self):
+        now = time.time()
+        self.__tokens = min(
+            self.burst_bytes,
+            self.__tokens + (now - self.__last_refill) * self.bytes_per_second)
+        self.__last_refill = now
+
+    def __Acquire(self, num_bytes):
+        """Block until num_bytes (at most one quantum) are available."""
+        ticket = object()
+        with self.__condition:
+            self.__waiters.append(ticket)
+            try:
+                while True:
+                    self.__Refill()
+                    if (self.__waiters[0] is ticket and
+                            self.__tokens >= num_bytes):
+                        self.__tokens -= num_bytes
+                        return
+                    if self.__waiters[0] is ticket:
+                        timeout = ((num_bytes - self.__tokens) /
+                                   self.bytes_per_second)
+                    else:
+                        timeout = None
+                    self.__condition.wait(timeout)
+            finally:
+                self.__waiters.remove(ticket)
+                self.__condition.notify_all()
+
+    def Consume(self, num_bytes):
+        """Block until num_bytes may be transferred.
+
+        Args:
+          num_bytes: (int) Number of bytes about to be, or just, sent or
+              received.
+
+        Returns:
+          None.
+        """
+        while num_bytes > 0:
+            piece = min(num_bytes, self.__quantum)
+            self.__Acquire(piece)
+            if self.parent is not None:
+                self.parent.Consume(piece)
+            num_bytes -= piece
+
+
 class _Transfer(object):
 
     """Generic bits common to Uploads and Downloads."""
 
     def __init__(self, stream, close_stream=False, chunksize=None,
-                 auto_transfer=True, http=None, num_retries=5):
+                 auto_transfer=True, http=None, num_retries=5,
+                 bandwidth_limiter=None):
         self.__bytes_http = None
         self.__close_stream = close_stream
         self.__http = http
@@ -95,6 +197,8 @@ class _Transfer(object):
             http_wrapper.HandleExceptionsAndRebuildHttpConnections)
         self.auto_transfer = auto_transfer
         self.chunksize = chunksize or 1048576
+        # An optional BandwidthLimiter for the bytes of this transfer.
+        self.bandwidth_limiter = bandwidth_limiter
 
     def __repr__(self):
         return str(self)
@@ -188,6 +292,12 @@ class Download(_Transfer):
 
     Public attributes:
       chunksize: default chunksize to use for transfers.
+
+    If decompress is True, responses sent with a gzip or deflate
+    Content-Encoding are decompressed incrementally as they are written to
+    the stream. progress and total_size always count bytes as sent by the
+    server, while decompressed_progress counts the bytes written to the
+    stream. Decompressing downloads can only be fetched sequentially.
     """
     _ACCEPTABLE_STATUSES = set((
         http_client.OK,
@@ -199,13 +309,16 @@ class Download(_Transfer):
         'auto_transfer', 'progress', 'total_size', 'url'))
 
     def __init__(self, stream, progress_callback=None, finish_callback=None,
-                 **kwds):
+                 decompress=False, **kwds):
         total_size = kwds.pop('total_size', None)
         super(Download, self).__init__(stream, **kwds)
         self.__initial_response = None
         self.__progress = 0
         self.__total_size = total_size
         self.__encoding = None
+        self.__decompress = decompress
+        self.__decompressor = None
+        self.__decompressed_progress = 0
 
         self.progress_callback = progress_callback
         self.finish_callback = finish_callback
@@ -218,6 +331,10 @@ class Download(_Transfer):
     def encoding(self):
         return self.__encoding
 
+    @property
+    def decompressed_progress(self):
+        return self.__decompressed_progress
+
     @classmethod
     def FromFile(cls, filename, overwrite=False, auto_transfer=True, **kwds):
         """Create a new download object from a filename."""
@@ -245,6 +362,9 @@ class Download(_Transfer):
                 'Invalid serialization data, missing keys: %s' % (
                     ', '.join(missing_keys)))
         download = cls.FromStream(stream, **kwds)
+        if download.decompress and info['progress']:
+            raise exceptions.InvalidUserInputError(
+                'Cannot resume a partially decompressed download')
         if auto_transfer is not None:
             download.auto_transfer = auto_transfer
         else:
@@ -274,6 +394,10 @@ class Download(_Transfer):
     def total_size(self):
         return self.__total_size
 
+    @property
+    def decompress(self):
+        return self.__decompress
+
     def __str__(self):
         if not self.initialized:
             return 'Download (uninitialized)'
@@ -282,12 +406,24 @@ class Download(_Transfer):
 
     def ConfigureRequest(self, http_request, url_builder):
         url_builder.query_params['alt'] = 'media'
+        if self.__FitsInOneChunk():
+            return
         # TODO(craigcitro): We need to send range requests because by
         # default httplib2 stores entire reponses in memory. Override
         # httplib2's download method (as gsutil does) so that this is not
         # necessary.
         http_request.headers['Range'] = 'bytes=0-%d' % (self.chunksize - 1,)
 
+    def __FitsInOneChunk(self):
+        """Whether the whole download is known to fit in one chunk.
+
+        This is the case when total_size was provided up front (e.g. from
+        the object's metadata) and is no more than chunksize, in which case
+        the media is fetched with a single unranged request.
+        """
+        return (self.total_size is not None and
+                self.total_size <= self.chunksize)
+
     def __SetTotal(self, info):
         """Sets the total size based off info if possible otherwise 0."""
         if 'content-range' in info:
@@ -319,12 +455,21 @@ class Download(_Transfer):
             http_request.url = client.FinalizeTransferUrl(http_request.url)
         url = http_request.url
         if self.auto_transfer:
-            end_byte = self.__ComputeEndByte(0)
-            self.__SetRangeHeader(http_request, 0, end_byte)
-            response = http_wrapper.MakeRequest(
-                self.bytes_http or http, http_request)
+            # Drop any Range header from ConfigureRequest; it is replaced
+            # below, or not needed at all for a small download.
+            http_request.headers.pop('Range', None)
+            if self.__FitsInOneChunk():
+                http_request.headers.pop('range', None)
+            else:
+                end_byte = self.__ComputeEndByte(0)
+                self.__SetRangeHeader(http_request, 0, end_byte)
+            with self.__RawContent():
+                response = http_wrapper.MakeRequest(
+                    self.bytes_http or http, http_request)
             if response.status_code not in self._ACCEPTABLE_STATUSES:
                 raise exceptions.HttpError.FromResponse(response)
+            if self.bandwidth_limiter is not None:
+                self.bandwidth_limiter.Consume(response.length)
             self.__initial_response = response
             self.__SetTotal(response.info)
             url = response.info.get('content-location', response.request_url)
@@ -408,6 +553,11 @@ class Download(_Transfer):
 
         return end_byte
 
+    def __RawContent(self):
+        """Keep httplib2 from decoding responses we decompress ourselves."""
+        # pylint: disable=protected-access
+        return http_wrapper._Httplib2RawContent(self.__decompress)
+
     def __GetChunk(self, start, end, additional_headers=None):
         """Retrieve a chunk, and return the full response."""
         self.EnsureInitialized()
@@ -415,9 +565,15 @@ class Download(_Transfer):
         self.__SetRangeHeader(request, start, end=end)
         if additional_headers is not None:
             request.headers.update(additional_headers)
-        return http_wrapper.MakeRequest(
-            self.bytes_http, request, retry_func=self.retry_func,
-            retries=self.num_retries)
+        with self.__RawContent():
+            response = http_wrapper.MakeRequest(
+                self.bytes_http, request, retry_func=self.retry_func,
+                retries=self.num_retries)
+        # httplib2 reads the whole response at once, so downloads are
+        # charged a chunk at a time, once the chunk has arrived.
+        if self.bandwidth_limiter is not None:
+            self.bandwidth_limiter.Consume(response.length)
+        return response
 
     def __ProcessResponse(self, response):
         """Process response (by updating self and writing to self.stream)."""
@@ -431,15 +587,28 @@ class Download(_Transfer):
                 raise exceptions.TransferRetryError(response.content)
         if response.status_code in (http_client.OK,
                                     http_client.PARTIAL_CONTENT):
+            encoding = None
+            if response.info and 'content-encoding' in response.info:
+                encoding = response.info['content-encoding']
+            content = response.content
+            if self.__decompress:
+                if self.__progress and encoding != self.__encoding:
+                    raise exceptions.TransferInvalidError(
+                        'Content-Encoding changed from %s to %s during '
+                        'download' % (self.__encoding, encoding))
+                if encoding in _DECOMPRESSIBLE_ENCODINGS:
+                    content = self.__Decompress(
+                        six.ensure_binary(content))
             try:
-                self.stream.write(six.ensure_binary(response.content))
+                self.stream.write(six.ensure_binary(content))
             except TypeError:
-                self.stream.write(six.ensure_text(response.content))
+                self.stream.write(six.ensure_text(content))
             self.__progress += response.length
-            if response.info and 'content-encoding' in response.info:
+            self.__decompressed_progress += len(content)
+            if encoding is not None:
                 # TODO(craigcitro): Handle the case where this changes over a
-                # download.
-                self.__encoding = response.info['content-encoding']
+                # download when not decompressing.
+                self.__encoding = encoding
         elif response.status_code == http_client.NO_CONTENT:
             # It's important to write something to the stream for the case
             # of a 0-byte download to a file, as otherwise python won't
@@ -447,6 +616,35 @@ class Download(_Transfer):
             self.stream.write('')
         return response
 
+    def __Decompress(self, data):
+        """Decompress the next chunk of an encoded download.
+
+        The decompressor is carried across chunks, so data must follow on
+        from the previous chunk. Concatenated gzip members are each
+        decompressed in turn.
+        """
+        pieces = []
+        while data:
+            if self.__decompressor is None:
+                # Accept either a gzip or a zlib header.
+                self.__decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            try:
+                pieces.append(self.__decompressor.decompress(data))
+            except zlib.error as e:
+                raise exceptions.TransferInvalidError(
+                    'Could not decompress %s download: %s' % (
+                        self.__encoding or 'encoded', e))
+            data = self.__decompressor.unused_data
+            if self.__decompressor.eof:
+                self.__decompressor = None
+        return b''.join(pieces)
+
+    def __FinishDecompression(self):
+        """Ensure a decompressing download didn't stop mid-stream."""
+        if self.__decompressor is not None:
+            raise exceptions.TransferInvalidError(
+                'Download ended partway through a compressed stream')
+
     def GetRange(self, start, end=None, additional_headers=None,
                  use_chunks=True):
         """Retrieve a given byte range from this download, inclusive.
@@ -471,6 +669,10 @@ class Download(_Transfer):
           None. Streams bytes into self.stream.
         """
         self.EnsureInitialized()
+        if self.__decompress and start != self.progress:
+            raise exceptions.InvalidUserInputError(
+                'Decompressing downloads can only fetch the range starting '
+                'at the current progress %d' % self.progress)
         progress_end_normalized = False
         if self.total_size is not None:
             progress, end_byte = self.__NormalizeStartEnd(start, end)
@@ -546,9 +748,220 @@ class Download(_Transfer):
             if (response.status_code == http_client.OK or
                     self.progress >= self.total_size):
                 break
+        self.__FinishDecompression()
         self._ExecuteCallback(finish_callback, response)
 
 
+class RemoteFile(io.RawIOBase):
+
+    """A read-only, seekable file object over the bytes of a download.
+
+    Reads are served from a cache of fixed-size blocks, which are fetched
+    from the server with Download.GetRange as they are needed. This makes
+    it cheap to read small regions (such as file footers or index blocks)
+    of a large object:
+
+      * the least recently used blocks are evicted once max_cached_blocks
+        are held;
+      * consecutive missing blocks needed by a read are fetched with a
+        single range request, so many small adjacent reads cost one
+        request per block at most;
+      * once reads are seen to be sequential, each fetch also takes the
+        next read_ahead_blocks blocks.
+
+    Fields:
+      block_size: Size in bytes of each cached block.
+      max_cached_blocks: Number of blocks kept in the cache.
+      read_ahead_blocks: Number of blocks prefetched on sequential reads.
+    """
+
+    def __init__(self, download, block_size=262144, max_cached_blocks=64,
+                 read_ahead_blocks=4):
+        """Create a RemoteFile from an initialized Download.
+
+        Only the url, http and size of download are used; its stream is
+        not written to.
+
+        Args:
+          download: An initialized Download, e.g. one created with
+              auto_transfer=False.
+          block_size: (int, default: 256KiB) Size of each cached block.
+          max_cached_blocks: (int, default: 64) Number of blocks to cache.
+          read_ahead_blocks: (int, default: 4) Number of extra blocks to
+              fetch when reads are sequential. 0 disables read-ahead.
+        """
+        super(RemoteFile, self).__init__()
+        download.EnsureInitialized()
+        if block_size <= 0 or max_cached_blocks <= 0 or read_ahead_blocks < 0:
+            raise exceptions.InvalidUserInputError(
+                'Invalid RemoteFile cache configuration')
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.read_ahead_blocks = read_ahead_blocks
+        self.__buffer = six.BytesIO()
+        self.__download = Download.FromStream(
+            self.__buffer, auto_transfer=False,
+            total_size=download.total_size, chunksize=download.chunksize,
+            num_retries=download.num_retries)
+        self.__download.bytes_http = download.bytes_http
+        self.__download.retry_func = download.retry_func
+        self.__download.bandwidth_limiter = download.bandwidth_limiter
+        self.__download._Initialize(  # pylint: disable=protected-access
+            download.http, download.url)
+        self.__blocks = collections.OrderedDict()
+        self.__position = 0
+        self.__last_read_end = None
+        self.__bytes_fetched = 0
+        self.__range_requests = 0
+
+    @classmethod
+    def FromUrl(cls, url, http, total_size=None, **kwds):
+        """Create a RemoteFile for the media at url."""
+        download = Download.FromStream(
+            six.BytesIO(), auto_transfer=False, total_size=total_size)
+        download._Initialize(http, url)  # pylint: disable=protected-access
+        return cls(download, **kwds)
+
+    @property
+    def size(self):
+        """Total size of the remote object, fetched if not yet known."""
+        if self.__download.total_size is None:
+            self.__FetchBlocks(0, 0)
+        return self.__download.total_size
+
+    @property
+    def bytes_fetched(self):
+        """Number of bytes received from the server."""
+        return self.__bytes_fetched
+
+    @property
+    def range_requests(self):
+        """Number of range requests sent to the server."""
+        return self.__range_requests
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.__position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence value %r' % (whence,))
+        if position < 0:
+            raise ValueError('Negative seek position %d' % position)
+        self.__position = position
+        return position
+
+    def readinto(self, b):
+        self._checkClosed()
+        size = self.size
+        start = self.__position
+        end = min(start + len(b), size)
+        if start >= end:
+            return 0
+        sequential = start == self.__last_read_end
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+        blocks = self.__GetBlocks(first_block, last_block, sequential)
+        out = memoryview(b)
+        written = 0
+        for index in range(first_block, last_block + 1):
+            block_start = index * self.block_size
+            data = blocks[index][max(start - block_start, 0):
+                                 end - block_start]
+            out[written:written + len(data)] = data
+            written += len(data)
+        self.__position = end
+        self.__last_read_end = end
+        return written
+
+    def readall(self):
+        return self.read(max(self.size - self.tell(), 0))
+
+    def close(self):
+        self.__blocks.clear()
+        super(RemoteFile, self).close()
+
+    def __GetBlocks(self, first_block, last_block, sequential):
+        """Return a dict of the blocks in [first_block, last_block].
+
+        Missing blocks are fetched, in runs of consecutive blocks. If the
+        read is sequential and the last block must be fetched, the final
+        run is extended with read-ahead blocks.
+        """
+        runs = []
+        for index in range(first_block, last_block + 1):
+            if index in self.__blocks:
+                continue
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        if sequential and runs and runs[-1][1] == last_block:
+            final_block = (self.size - 1) // self.block_size
+            read_ahead_end = min(last_block + self.read_ahead_blocks,
+                                 final_block)
+            while (runs[-1][1] < read_ahead_end and
+                   runs[-1][1] + 1 not in self.__blocks):
+                runs[-1][1] += 1
+        blocks = {}
+        for index in range(first_block, last_block + 1):
+            if index in self.__blocks:
+                blocks[index] = self.__blocks.pop(index)
+                self.__blocks[index] = blocks[index]
+        for run_start, run_end in runs:
+            blocks.update(self.__FetchBlocks(run_start, run_end))
+        return blocks
+
+    def __FetchBlocks(self, first_block, last_block):
+        """Fetch blocks [first_block, last_block] in one range and cache them.
+
+        Args:
+          first_block: Index of the first block to fetch.
+          last_block: Index of the last block to fetch.
+
+        Returns:
+          A dict mapping block indexes to their bytes.
+        """
+        start = first_block * self.block_size
+        end = (last_block + 1) * self.block_size - 1
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+        self.__range_requests += 1
+        try:
+            self.__download.GetRange(start, end)
+        except exceptions.TransferInvalidError:
+            # A range can't be requested from an empty object; GetRange
+            # learns the size from the response before raising.
+            if self.__download.total_size != 0:
+                raise
+        data = self.__buffer.getvalue()
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+        self.__bytes_fetched += len(data)
+        blocks = {}
+        for offset in range(0, len(data), self.block_size):
+            index = first_block + offset // self.block_size
+            blocks[index] = data[offset:offset + self.block_size]
+            self.__blocks.pop(index, None)
+            self.__blocks[index] = blocks[index]
+        while len(self.__blocks) > self.max_cached_blocks:
+            self.__blocks.popitem(last=False)
+        return blocks
+
+
 if six.PY3:
     class MultipartBytesGenerator(email_generator.BytesGenerator):
         """Generates a bytes Message object tree for multipart messages
@@ -572,6 +985,277 @@ if six.PY3:
         _writeBody = _handle_text
 
 
+class MultipartRelatedBody(object):
+
+    """A file-like multipart/related body, generated as it is read.
+
+    The body holds a metadata part and a media part, in the same wire
+    format that email.generator produces for MIMEMultipart('related').
+    The media is read from its stream only as this body is read, so the
+    media is never held in memory. The total length is known up front for
+    the content-length header. The body can be rewound with seek() so that
+    a retried request sends it again.
+    """
+
+    def __init__(self, metadata, metadata_type, media_stream, media_type,
+                 media_length, boundary=None):
+        """Initialize a multipart/related body.
+
+        Args:
+          metadata: (str or bytes) Body of the metadata part.
+          metadata_type: MIME type of the metadata part.
+          media_stream: Stream positioned at the start of the media.
+          media_type: MIME type of the media part.
+          media_length: Number of bytes of media to read from media_stream.
+          boundary: (str, optional) Multipart boundary. A random boundary is
+              generated if not provided.
+        """
+        if isinstance(metadata, six.text_type):
+            metadata = metadata.encode('utf-8')
+        if boundary is None:
+            boundary = self.__MakeBoundary(metadata)
+        self.__boundary = boundary
+        delimiter = b'--' + boundary.encode('ascii')
+        self.__preamble = b''.join((
+            delimiter, b'\nContent-Type: ', metadata_type.encode('ascii'),
+            b'\nMIME-Version: 1.0\n\n', metadata, b'\n',
+            delimiter, b'\nContent-Type: ', media_type.encode('ascii'),
+            b'\nMIME-Version: 1.0\nContent-Transfer-Encoding: binary\n\n'))
+        self.__epilogue = b'\n' + delimiter + b'--\n'
+        self.__media_stream = media_stream
+        self.__media_start = media_stream.tell()
+        self.__media_length = media_length
+        self.__media_end = len(self.__preamble) + media_length
+        self.__length = self.__media_end + len(self.__epilogue)
+        self.__position = 0
+
+    @staticmethod
+    def __MakeBoundary(metadata):
+        # Same form as email.generator; the media is never scanned, but
+        # with 63 random bits a collision is not a practical concern.
+        while True:
+            boundary = '=' * 15 + repr(random.randrange(sys.maxsize)) + '=='
+            if boundary.encode('ascii') not in metadata:
+                return boundary
+
+    def __str__(self):
+        return 'Multipart body at %s/%s with boundary %s' % (
+            self.__position, self.__length, self.__boundary)
+
+    def __len__(self):
+        return self.__length
+
+    def __nonzero__(self):
+        # For 32-bit python2.x, len() cannot exceed a 32-bit number; avoid
+        # accidental len() calls from httplib in the form of "if this_object:".
+        return bool(self.__length)
+
+    __bool__ = __nonzero__
+
+    @property
+    def length(self):
+        # For 32-bit python2.x, len() cannot exceed a 32-bit number.
+        return self.__length
+
+    @property
+    def boundary(self):
+        return self.__boundary
+
+    @property
+    def loggable_body(self):
+        """The body with the media replaced by a placeholder."""
+        return self.__preamble + b'<media body>\n' + self.__epilogue
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to a new position in the body."""
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += self.__length
+        if offset < 0:
+            raise exceptions.InvalidUserInputError(
+                'Cannot seek to negative position %d' % offset)
+        self.__position = min(offset, self.__length)
+        media_offset = min(
+            max(self.__position - len(self.__preamble), 0),
+            self.__media_length)
+        self.__media_stream.seek(self.__media_start + media_offset)
+        return self.__position
+
+    def read(self, size=None):
+        """Read at most size bytes from the body.
+
+        Args:
+          size: If provided, read no more than size bytes. Otherwise, read
+              the remainder of the body.
+
+        Returns:
+          The bytes read.
+
+        Raises:
+          exceptions.StreamExhausted: if the media stream ends early.
+        """
+        remaining = self.__length - self.__position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        pieces = []
+        while size > 0:
+            position = self.__position
+            if position < len(self.__preamble):
+                data = self.__preamble[position:position + size]
+            elif position < self.__media_end:
+                data = self.__media_stream.read(
+                    min(size, self.__media_end - position))
+                if not data:
+                    raise exceptions.StreamExhausted(
+                        'Not enough bytes in stream; expected %d, exhausted '
+                        'after %d' % (self.__media_length,
+                                      position - len(self.__preamble)))
+            else:
+                offset = position - self.__media_end
+                data = self.__epilogue[offset:offset + size]
+            pieces.append(data)
+            self.__position += len(data)
+            size -= len(data)
+        return b''.join(pieces)
+
+
+class UploadStrategyPolicy(object):
+
+    """Chooses between simple and resumable uploads.
+
+    A policy is consulted by Upload.ConfigureRequest when no strategy has
+    been set explicitly and the endpoint allows either one. Uploads report
+    the requests they make back to their policy through the Record
+    methods, so a policy shared by many uploads (for instance by setting
+    BaseApiClient.upload_strategy_policy) can learn from them.
+    """
+
+    def ChooseStrategy(self, total_size):
+        """Return SIMPLE_UPLOAD or RESUMABLE_UPLOAD for an upload.
+
+        Args:
+          total_size: (int or None) Size of the upload, if known.
+
+        Returns:
+          The strategy to use.
+        """
+        raise NotImplementedError()
+
+    def RecordRoundTrip(self, elapsed_seconds):
+        """Record the time taken by a request that carried no media."""
+
+    def RecordTransfer(self, num_bytes, elapsed_seconds, succeeded):
+        """Record the outcome of a request that sent num_bytes of media."""
+
+
+class ThresholdUploadStrategyPolicy(UploadStrategyPolicy):
+
+    """Uses resumable uploads for sizes above a fixed threshold.
+
+    This is the default policy.
+    """
+
+    def __init__(self, threshold=_RESUMABLE_UPLOAD_THRESHOLD):
+        self.__threshold = threshold
+
+    @property
+    def threshold(self):
+        return self.__threshold
+
+    def ChooseStrategy(self, total_size):
+        if total_size is not None and total_size > self.threshold:
+            return RESUMABLE_UPLOAD
+        return SIMPLE_UPLOAD
+
+
+class AdaptiveUploadStrategyPolicy(ThresholdUploadStrategyPolicy):
+
+    """Sets the resumable threshold from measured network conditions.
+
+    A resumable upload costs one extra round-trip to start the session,
+    while a failed simple upload has to resend everything. Simple uploads
+    are therefore chosen while
+
+      total_size < round_trip_time * throughput / failure_rate
+
+    using exponentially weighted averages of recent requests. The result
+    is kept between min_threshold and max_threshold, so on an unreliable
+    network uploads larger than min_threshold become resumable. Until both
+    a round-trip and a transfer have been measured, initial_threshold is
+    used, which defaults to the threshold of ThresholdUploadStrategyPolicy.
+    This class is thread-safe.
+    """
+
+    def __init__(self, min_threshold=_MIN_ADAPTIVE_UPLOAD_THRESHOLD,
+                 max_threshold=100 << 20, smoothing=0.2,
+                 min_failure_rate=0.01, initial_threshold=None):
+        if initial_threshold is None:
+            initial_threshold = max(
+                min_threshold,
+                min(_RESUMABLE_UPLOAD_THRESHOLD, max_threshold))
+        super(AdaptiveUploadStrategyPolicy, self).__init__(initial_threshold)
+        self.__initial_threshold = initial_threshold
+        self.__min_threshold = min_threshold
+        self.__max_threshold = max_threshold
+        self.__smoothing = smoothing
+        self.__min_failure_rate = min_failure_rate
+        self.__lock = threading.Lock()
+        self.__round_trip_time = None
+        self.__throughput = None
+        self.__failure_rate = 0.0
+
+    def __Average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.__smoothing * (sample - average)
+
+    @property
+    def round_trip_time(self):
+        """Average round-trip time in seconds, or None."""
+        return self.__round_trip_time
+
+    @property
+    def throughput(self):
+        """Average upload throughput in bytes per second, or None."""
+        return self.__throughput
+
+    @property
+    def failure_rate(self):
+        """Average fraction of media requests that failed."""
+        return self.__failure_rate
+
+    @property
+    def threshold(self):
+        with self.__lock:
+            if self.__round_trip_time is None or self.__throughput is None:
+                return self.__initial_threshold
+            failure_rate = max(self.__failure_rate, self.__min_failure_rate)
+            threshold = int(
+                self.__round_trip_time * self.__throughput / failure_rate)
+        return max(self.__min_threshold,
+                   min(threshold, self.__max_threshold))
+
+    def RecordRoundTrip(self, elapsed_seconds):
+        with self.__lock:
+            self.__round_trip_time = self.__Average(
+                self.__round_trip_time, elapsed_seconds)
+
+    def RecordTransfer(self, num_bytes, elapsed_seconds, succeeded):
+        with self.__lock:
+            self.__failure_rate = self.__Average(
+                self.__failure_rate, 0.0 if succeeded else 1.0)
+            if succeeded and num_bytes and elapsed_seconds > 0:
+                self.__throughput = self.__Average(
+                    self.__throughput, num_bytes / float(elapsed_seconds))
+
+
+_DEFAULT_UPLOAD_STRATEGY_POLICY = ThresholdUploadStrategyPolicy()
+
+
 class Upload(_Transfer):
 
     """Data for a single Upload.
@@ -584,6 +1268,24 @@ class Upload(_Transfer):
           stream when finished with the upload.
       auto_transfer: (default: True) If True, stream all bytes as soon as
           the upload is created.
+      use_mmap: (default: False) If True and stream is a regular file of
+          known size, send the media as memoryview slices of a read-only
+          memory map of the file rather than copying it through read().
+          The file must not be truncated while the upload is in progress.
+      gzip_max_workers: (optional) If gzip_encoded and greater than 1,
+          compress the upload on this many threads instead of one.
+      gzip_max_memory: (optional) If gzip_encoded, the number of compressed
+          bytes of each chunk to hold in memory; the rest are spilled to a
+          temporary file until sent.
+      gzip_ratio_threshold: (optional) If gzip_encoded, sample the start of
+          the stream before the upload begins and only compress the upload
+          if the sample compresses to less than this fraction of its size
+          (e.g. 0.9). Streams that can't be sampled are compressed as
+          requested. The outcome is reported by the gzip_encoded and
+          compression_ratio properties.
+      strategy_policy: (optional) An UploadStrategyPolicy used to pick the
+          strategy when none is set. Defaults to a policy that uses
+          resumable uploads above 5MiB.
     """
     _REQUIRED_SERIALIZATION_KEYS = set((
         'auto_transfer', 'mime_type', 'total_size', 'url'))
@@ -591,7 +1293,9 @@ class Upload(_Transfer):
     def __init__(self, stream, mime_type, total_size=None, http=None,
                  close_stream=False, chunksize=None, auto_transfer=True,
                  progress_callback=None, finish_callback=None,
-                 gzip_encoded=False, **kwds):
+                 gzip_encoded=False, use_mmap=False, gzip_max_workers=None,
+                 gzip_ratio_threshold=None, strategy_policy=None,
+                 gzip_max_memory=None, **kwds):
         super(Upload, self).__init__(
             stream, close_stream=close_stream, chunksize=chunksize,
             auto_transfer=auto_transfer, http=http, **kwds)
@@ -603,6 +1307,16 @@ class Upload(_Transfer):
         self.__strategy = None
         self.__total_size = None
         self.__gzip_encoded = gzip_encoded
+        self.__gzip_max_workers = gzip_max_workers
+        self.__gzip_max_memory = gzip_max_memory
+        self.__gzip_ratio_threshold = gzip_ratio_threshold
+        self.__compression_ratio = None
+        self.strategy_policy = strategy_policy
+        self.__use_mmap = use_mmap
+        self.__mmap = None
+        # Views of __mmap handed out as request bodies.
+        self.__mmap_views = []
+        self.__chunk_buffer = None
 
         self.progress_callback = progress_callback
         self.finish_callback = finish_callback
@@ -698,6 +1412,16 @@ class Upload(_Transfer):
     def mime_type(self):
         return self.__mime_type
 
+    @property
+    def gzip_encoded(self):
+        """Whether the upload is sent with Content-Encoding: gzip."""
+        return self.__gzip_encoded
+
+    @property
+    def compression_ratio(self):
+        """Ratio measured when sampling the stream, or None if not sampled."""
+        return self.__compression_ratio
+
     def __str__(self):
         if not self.initialized:
             return 'Upload (uninitialized)'
@@ -744,10 +1468,8 @@ class Upload(_Transfer):
             self.strategy = SIMPLE_UPLOAD
         if self.strategy is not None:
             return
-        strategy = SIMPLE_UPLOAD
-        if (self.total_size is not None and
-                self.total_size > _RESUMABLE_UPLOAD_THRESHOLD):
-            strategy = RESUMABLE_UPLOAD
+        policy = self.strategy_policy or _DEFAULT_UPLOAD_STRATEGY_POLICY
+        strategy = policy.ChooseStrategy(self.total_size)
         if http_request.body and not upload_config.simple_multipart:
             strategy = RESUMABLE_UPLOAD
         if not upload_config.simple_path:
@@ -768,6 +1490,7 @@ class Upload(_Transfer):
                 'MIME type %s does not match any accepted MIME ranges %s' % (
                     self.mime_type, upload_config.accept))
 
+        self.__CheckCompressibility()
         self.__SetDefaultUploadStrategy(upload_config, http_request)
         if self.strategy == SIMPLE_UPLOAD:
             url_builder.relative_path = upload_config.simple_path
@@ -778,11 +1501,10 @@ class Upload(_Transfer):
                 url_builder.query_params['uploadType'] = 'media'
                 self.__ConfigureMediaRequest(http_request)
             # Once the entire body is written, compress the body if configured
-            # to. Both multipart and media request uploads will read the
-            # entire stream into memory, which means full compression is also
-            # safe to perform. Because the strategy is set to SIMPLE_UPLOAD,
-            # StreamInChunks throws an exception, meaning double compression
-            # cannot happen.
+            # to. Compressing reads the entire body into memory, which is
+            # safe since the stream is not used again afterwards. Because the
+            # strategy is set to SIMPLE_UPLOAD, StreamInChunks throws an
+            # exception, meaning double compression cannot happen.
             if self.__gzip_encoded:
                 http_request.headers['Content-Encoding'] = 'gzip'
                 # Turn the body into a stream so that we can compress it, then
@@ -791,61 +1513,136 @@ class Upload(_Transfer):
                 # the body, which we can't do with a stream. So, we consume the
                 # bytes from the stream now and store them in a re-readable
                 # bytes container.
+                body_stream = http_request.body
+                if not hasattr(body_stream, 'read'):
+                    body_stream = six.BytesIO(body_stream)
                 http_request.body = (
                     compression.CompressStream(
-                        six.BytesIO(http_request.body))[0].read())
+                        body_stream,
+                        max_workers=self.__gzip_max_workers)[0].read())
         else:
             url_builder.relative_path = upload_config.resumable_path
             url_builder.query_params['uploadType'] = 'resumable'
             self.__ConfigureResumableRequest(http_request)
 
+    def __CheckCompressibility(self):
+        """Turn off gzip_encoded if a sample of the stream doesn't compress.
+
+        This is only done once, when gzip_ratio_threshold is set, and must
+        happen before any data is sent, since the encoding can't change
+        partway through an upload.
+        """
+        threshold = self.__gzip_ratio_threshold
+        if not self.__gzip_encoded or threshold is None:
+            return
+        self.__gzip_ratio_threshold = None
+        self.__compression_ratio = compression.SampleCompressionRatio(
+            self.stream)
+        if (self.__compression_ratio is not None and
+                self.__compression_ratio >= threshold):
+            self.__gzip_encoded = False
+
     def __ConfigureMediaRequest(self, http_request):
         """Configure http_request as a simple request for this upload."""
         http_request.headers['content-type'] = self.mime_type
-        http_request.body = self.stream.read()
+        start = self.stream.tell() if self.__GetMemoryMap() else None
+        if start is not None:
+            http_request.body = self.__MappedSlice(start, self.total_size)
+        else:
+            http_request.body = self.stream.read()
         http_request.loggable_body = '<media body>'
 
+    def __GetMemoryMap(self):
+        """Return a read-only memory map of self.stream, if enabled.
+
+        Memory mapping is only attempted for uncompressed uploads of
+        regular files with a known, non-zero size; if the stream can't be
+        mapped we quietly fall back to reading it.
+
+        Returns:
+          An mmap.mmap object or None.
+        """
+        if self.__mmap is None and self.__use_mmap:
+            self.__use_mmap = False
+            if self.__gzip_encoded or not self.total_size:
+                return None
+            try:
+                self.__mmap = mmap.mmap(self.stream.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            except (AttributeError, EnvironmentError, ValueError,
+                    io.UnsupportedOperation):
+                return None
+        return self.__mmap
+
+    def _ReleaseMemoryMap(self):
+        """Close the memory map of the stream, if there is one.
+
+        Views of it sent as request bodies are released first, so they
+        can't be read afterwards. A later request maps the stream again.
+        """
+        if self.__mmap is None:
+            return
+        for view in self.__mmap_views:
+            # Python 2 memoryviews don't hold on to the map.
+            release = getattr(view, 'release', None)
+            if release is not None:
+                release()
+        self.__mmap_views = []
+        self.__mmap.close()
+        self.__mmap = None
+        self.__use_mmap = True
+
+    def __MappedSlice(self, start, end):
+        """Return a zero-copy view of bytes [start, end) of the stream.
+
+        The stream position is moved to end, as if the bytes had been read.
+
+        Args:
+          start: First byte of the slice.
+          end: One past the last byte of the slice.
+
+        Returns:
+          A memoryview over the memory-mapped file.
+
+        Raises:
+          exceptions.StreamExhausted: if the file is shorter than end.
+        """
+        view = memoryview(self.__mmap)[start:end]
+        self.__mmap_views.append(view)
+        if len(view) != end - start:
+            raise exceptions.StreamExhausted(
+                'Not enough bytes in stream; expected %d, exhausted '
+                'after %d' % (end - start, len(view)))
+        self.stream.seek(end)
+        return view
+
+    def __GetChunkBuffer(self):
+        """Return a reusable buffer of self.chunksize bytes."""
+        if (self.__chunk_buffer is None or
+                len(self.__chunk_buffer) != self.chunksize):
+            self.__chunk_buffer = bytearray(self.chunksize)
+        return self.__chunk_buffer
+
     def __ConfigureMultipartRequest(self, http_request):
         """Configure http_request as a multipart request for this upload."""
-        # This is a multipart/related upload.
-        msg_root = mime_multipart.MIMEMultipart('related')
-        # msg_root should not write out its own headers
-        setattr(msg_root, '_write_headers', lambda self: None)
-
-        # attach the body as one part
-        msg = mime_nonmultipart.MIMENonMultipart(
-            *http_request.headers['content-type'].split('/'))
-        msg.set_payload(http_request.body)
-        msg_root.attach(msg)
-
-        # attach the media as the second part
-        msg = mime_nonmultipart.MIMENonMultipart(*self.mime_type.split('/'))
-        msg['Content-Transfer-Encoding'] = 'binary'
-        msg.set_payload(self.stream.read())
-        msg_root.attach(msg)
-
-        # NOTE: We encode the body, but can't use
-        #       `email.message.Message.as_string` because it prepends
-        #       `> ` to `From ` lines.
-        fp = six.BytesIO()
-        if six.PY3:
-            generator_class = MultipartBytesGenerator
+        # This is a multipart/related upload. The media is streamed from
+        # self.stream as the body is sent; without a known size we have
+        # to read it all first.
+        media_stream = self.stream
+        media_length = self.total_size
+        if media_length is None:
+            media = self.stream.read()
+            media_stream = six.BytesIO(media)
+            media_length = len(media)
         else:
-            generator_class = email_generator.Generator
-        g = generator_class(fp, mangle_from_=False)
-        g.flatten(msg_root, unixfrom=False)
-        http_request.body = fp.getvalue()
-
-        multipart_boundary = msg_root.get_boundary()
+            media_length -= self.stream.tell()
+        body = MultipartRelatedBody(
+            http_request.body, http_request.headers['content-type'],
+            media_stream, self.mime_type, media_length)
+        http_request.body = body
         http_request.headers['content-type'] = (
-            'multipart/related; boundary=%r' % multipart_boundary)
-        if isinstance(multipart_boundary, six.text_type):
-            multipart_boundary = multipart_boundary.encode('ascii')
-
-        body_components = http_request.body.split(multipart_boundary)
-        headers, _, _ = body_components[-2].partition(b'\n\n')
-        body_components[-2] = b'\n\n'.join([headers, b'<media body>\n\n--'])
-        http_request.loggable_body = multipart_boundary.join(body_components)
+            'multipart/related; boundary=%r' % body.boundary)
+        http_request.loggable_body = body.loggable_body
 
     def __ConfigureResumableRequest(self, http_request):
         http_request.headers['X-Upload-Content-Type'] = self.mime_type
@@ -899,12 +1696,18 @@ class Upload(_Transfer):
             raise exceptions.UserError('Must provide client or http.')
         if self.strategy != RESUMABLE_UPLOAD:
             return
-        http = http or client.http
+        # An http provided at construction time overrides the client's, as
+        # in _Initialize.
+        http = http or self.http or client.http
         if client is not None:
             http_request.url = client.FinalizeTransferUrl(http_request.url)
         self.EnsureUninitialized()
+        self.__CheckCompressibility()
+        start_time = time.time()
         http_response = http_wrapper.MakeRequest(http, http_request,
                                                  retries=self.num_retries)
+        if self.strategy_policy is not None:
+            self.strategy_policy.RecordRoundTrip(time.time() - start_time)
         if http_response.status_code != http_client.OK:
             raise exceptions.HttpError.FromResponse(http_response)
 
@@ -1021,16 +1824,22 @@ class Upload(_Transfer):
         Returns:
           http_wrapper.Response of final response.
         """
-        return self.__StreamMedia(
-            callback=callback, finish_callback=finish_callback,
-            additional_headers=additional_headers, use_chunks=False)
+        try:
+            return self.__StreamMedia(
+                callback=callback, finish_callback=finish_callback,
+                additional_headers=additional_headers, use_chunks=False)
+        finally:
+            self._ReleaseMemoryMap()
 
     def StreamInChunks(self, callback=None, finish_callback=None,
                        additional_headers=None):
         """Send this (resumable) upload in chunks."""
-        return self.__StreamMedia(
-            callback=callback, finish_callback=finish_callback,
-            additional_headers=additional_headers)
+        try:
+            return self.__StreamMedia(
+                callback=callback, finish_callback=finish_callback,
+                additional_headers=additional_headers)
+        finally:
+            self._ReleaseMemoryMap()
 
     def __SendMediaRequest(self, request, end):
         """Request helper function for SendMediaBody & SendChunk."""
@@ -1041,9 +1850,23 @@ class Upload(_Transfer):
                 raise exceptions.RequestError(
                     'Request to url %s did not return a response.' %
                     response.request_url)
-        response = http_wrapper.MakeRequest(
-            self.bytes_http, request, retry_func=self.retry_func,
-            retries=self.num_retries, check_response_func=CheckResponse)
+        if (self.bandwidth_limiter is not None and
+                not isinstance(request.body, stream_slice.StreamSlice)):
+            # Slices of the stream are charged as they are read; other
+            # bodies are charged in full before they are sent.
+            self.bandwidth_limiter.Consume(
+                int(request.headers.get('content-length', 0)))
+        start_time = time.time()
+        try:
+            response = http_wrapper.MakeRequest(
+                self.bytes_http, request, retry_func=self.retry_func,
+                retries=self.num_retries, check_response_func=CheckResponse)
+        except Exception:
+            self.__RecordTransfer(request, start_time, False)
+            raise
+        self.__RecordTransfer(request, start_time, response.status_code in (
+            http_client.OK, http_client.CREATED,
+            http_wrapper.RESUME_INCOMPLETE))
         if response.status_code == http_wrapper.RESUME_INCOMPLETE:
             last_byte = self.__GetLastByte(
                 self._GetRangeHeaderFromResponse(response))
@@ -1051,14 +1874,32 @@ class Upload(_Transfer):
                 self.stream.seek(last_byte + 1)
         return response
 
+    def __RecordTransfer(self, request, start_time, succeeded):
+        """Report a media request to the strategy policy, if any."""
+        if self.strategy_policy is not None:
+            num_bytes = int(request.headers.get('content-length', 0))
+            self.strategy_policy.RecordTransfer(
+                num_bytes, time.time() - start_time, succeeded)
+
+    def _RecordSimpleUpload(self, http_request, elapsed_seconds, succeeded):
+        """Report a simple upload to the strategy policy, if any."""
+        if self.strategy_policy is not None:
+            self.strategy_policy.RecordTransfer(
+                int(http_request.headers.get('content-length', 0)),
+                elapsed_seconds, succeeded)
+
     def __SendMediaBody(self, start, additional_headers=None):
         """Send the entire media stream in a single request."""
         self.EnsureInitialized()
         if self.total_size is None:
             raise exceptions.TransferInvalidError(
                 'Total size must be known for SendMediaBody')
-        body_stream = stream_slice.StreamSlice(
-            self.stream, self.total_size - start)
+        if self.__GetMemoryMap():
+            body_stream = self.__MappedSlice(start, self.total_size)
+        else:
+            body_stream = stream_slice.StreamSlice(
+                self.stream, self.total_size - start,
+                bandwidth_limiter=self.bandwidth_limiter)
 
         request = http_wrapper.Request(url=self.url, http_method='PUT',
                                        body=body_stream)
@@ -1084,7 +1925,9 @@ class Upload(_Transfer):
         if self.__gzip_encoded:
             request.headers['Content-Encoding'] = 'gzip'
             body_stream, read_length, exhausted = compression.CompressStream(
-                self.stream, self.chunksize)
+                self.stream, self.chunksize,
+                max_workers=self.__gzip_max_workers,
+                max_memory=self.__gzip_max_memory)
             end = start + read_length
             # If the stream length was previously unknown and the input stream
             # is exhausted, then we're at the end of the stream.
@@ -1093,8 +1936,11 @@ class Upload(_Transfer):
         elif self.total_size is None:
             # For the streaming resumable case, we need to detect when
             # we're at the end of the stream.
+            # The chunk is read into a buffer that is reused for every
+            # chunk of this upload, rather than allocating a new one.
             body_stream = buffered_stream.BufferedStream(
-                self.stream, start, self.chunksize)
+                self.stream, start, self.chunksize,
+                buffer=self.__GetChunkBuffer())
             end = body_stream.stream_end_position
             if body_stream.stream_exhausted:
                 self.__total_size = end
@@ -1106,7 +1952,12 @@ class Upload(_Transfer):
             body_stream = body_stream.read(self.chunksize)
         else:
             end = min(start + self.chunksize, self.total_size)
-            body_stream = stream_slice.StreamSlice(self.stream, end - start)
+            if self.__GetMemoryMap():
+                body_stream = self.__MappedSlice(start, end)
+            else:
+                body_stream = stream_slice.StreamSlice(
+                    self.stream, end - start,
+                    bandwidth_limiter=self.bandwidth_limiter)
         # TODO(craigcitro): Think about clearer errors on "no data in
         # stream".
         request.body = body_stream
@@ -1131,3 +1982,324 @@ class Upload(_Transfer):
             request.headers.update(additional_headers)
 
         return self.__SendMediaRequest(request, end)
+
+
+def _IsRetryableTransferError(exc):
+    """Returns True if a failed transfer job is worth attempting again."""
+    if isinstance(exc, exceptions.HttpError):
+        try:
+            status_code = exc.status_code
+        except (KeyError, TypeError, ValueError):
+            return False
+        return (status_code >= 500 or
+                status_code == http_wrapper.TOO_MANY_REQUESTS)
+    return isinstance(exc, (exceptions.TransferRetryError,
+                            exceptions.RequestError,
+                            socket.error,
+                            httplib2.HttpLib2Error))
+
+
+class TransferStats(object):
+
+    """Aggregate statistics for the jobs run by a TransferManager.
+
+    Attributes:
+      objects_completed: Number of jobs that finished successfully.
+      objects_failed: Number of jobs that failed after all retries.
+      bytes_transferred: Total bytes moved by successful jobs.
+      failures: List of (description, exception) for each failed job.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__start_time = None
+        self.__end_time = None
+        self.objects_completed = 0
+        self.objects_failed = 0
+        self.bytes_transferred = 0
+        self.failures = []
+
+    def __str__(self):
+        return ('%d objects completed, %d failed, %d bytes in %.1fs '
+                '(%.1f objects/s, %.1f bytes/s)' % (
+                    self.objects_completed, self.objects_failed,
+                    self.bytes_transferred, self.elapsed_seconds,
+                    self.objects_per_second, self.bytes_per_second))
+
+    @property
+    def elapsed_seconds(self):
+        if self.__start_time is None:
+            return 0.0
+        return (self.__end_time or time.time()) - self.__start_time
+
+    @property
+    def objects_per_second(self):
+        elapsed = self.elapsed_seconds
+        return self.objects_completed / elapsed if elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        elapsed = self.elapsed_seconds
+        return self.bytes_transferred / elapsed if elapsed else 0.0
+
+    def _Start(self):
+        with self.__lock:
+            if self.__start_time is None:
+                self.__start_time = time.time()
+            self.__end_time = None
+
+    def _Stop(self):
+        with self.__lock:
+            if self.__start_time is not None:
+                self.__end_time = time.time()
+
+    def _RecordSuccess(self, num_bytes):
+        with self.__lock:
+            self.objects_completed += 1
+            self.bytes_transferred += num_bytes or 0
+
+    def _RecordFailure(self, description, exc):
+        with self.__lock:
+            self.objects_failed += 1
+            self.failures.append((description, exc))
+
+
+class TransferManager(object):
+
+    """Runs many uploads and downloads concurrently.
+
+    Jobs are queued with AddUpload and AddDownload and run on a bounded
+    pool of worker threads. Since httplib2.Http instances are not
+    thread-safe, each worker sends all of its requests through its own
+    http, built once by http_factory and reused for every job the worker
+    runs. The upload strategy (simple, multipart or resumable) is chosen
+    per object by Upload.ConfigureRequest, exactly as for a single call.
+
+    Adding a job blocks while max_queued_jobs jobs are already waiting, so
+    memory stays bounded regardless of how many jobs are submitted.
+
+    Example:
+      with transfer.TransferManager(client) as manager:
+          for filename in filenames:
+              manager.AddUpload(client.objects, 'Insert',
+                                MakeInsertRequest(filename), filename)
+      print(manager.stats)
+    """
+
+    def __init__(self, client, max_workers=8, max_queued_jobs=None,
+                 num_retries=5, max_retry_wait=60, http_factory=None):
+        """Initialize a TransferManager.
+
+        Args:
+          client: The BaseApiClient whose services will be called.
+          max_workers: (int, default: 8) Number of concurrent jobs.
+          max_queued_jobs: (int, optional) Number of jobs allowed to wait
+              for a worker before AddUpload and AddDownload block.
+              Defaults to 4 * max_workers.
+          num_retries: (int, default: 5) Number of times a job that failed
+              with a retryable error is started over.
+          max_retry_wait: (int, default: 60) Maximum number of seconds to
+              wait between attempts of a job.
+          http_factory: (callable, optional) Returns a new http instance for
+              each worker. Defaults to a fresh http authorized with the
+              credentials of client.http, if any.
+        """
+        if max_workers < 1:
+            raise exceptions.InvalidUserInputError(
+                'max_workers must be positive')
+        util.Typecheck(num_retries, six.integer_types)
+        if num_retries < 0:
+            raise exceptions.InvalidDataError(
+                'Cannot have negative value for num_retries')
+        self.__client = client
+        self.__max_workers = max_workers
+        self.__num_retries = num_retries
+        self.__max_retry_wait = max_retry_wait
+        self.__http_factory = http_factory or self.__DefaultHttpFactory
+        self.__queue = queue.Queue(
+            maxsize=max_queued_jobs or 4 * max_workers)
+        self.__workers = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+        self.stats = TransferStats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def __DefaultHttpFactory(self):
+        http = http_wrapper.GetHttp()
+        credentials = getattr(
+            getattr(self.__client.http, 'request', None), 'credentials',
+            None)
+        if credentials is not None:
+            http = credentials.authorize(http)
+        return http
+
+    def __EnsureStarted(self):
+        with self.__lock:
+            if self.__closed:
+                raise exceptions.TransferInvalidError(
+                    'Cannot add jobs to a closed TransferManager')
+            if self.__workers:
+                return
+            self.stats._Start()  # pylint: disable=protected-access
+            for _ in range(self.__max_workers):
+                worker = threading.Thread(target=self.__WorkerLoop)
+                worker.daemon = True
+                worker.start()
+                self.__workers.append(worker)
+
+    def __WorkerLoop(self):
+        http = None
+        while True:
+            job = self.__queue.get()
+            try:
+                if job is None:
+                    return
+                if http is None:
+                    try:
+                        http = self.__http_factory()
+                    except Exception as e:  # pylint: disable=broad-except
+                        # Fail this job; the next one tries again.
+                        self.__FailJob(job, e)
+                        continue
+                self.__RunJob(job, http)
+            except Exception:  # pylint: disable=broad-except
+                # Only a callback can raise here; the worker must go on
+                # to keep the queue moving.
+                logging.exception('Callback of a transfer raised')
+            finally:
+                self.__queue.task_done()
+
+    def __FailJob(self, job, exc):
+        _, description, callback = job
+        self.stats._RecordFailure(  # pylint: disable=protected-access
+            description, exc)
+        if callback is not None:
+            callback(None, exc)
+
+    def __RunJob(self, job, http):
+        """Run job, starting it over on retryable errors."""
+        run_func, _, callback = job
+        # pylint: disable=protected-access
+        attempt = 0
+        while True:
+            try:
+                result, num_bytes = run_func(http, attempt)
+            except Exception as e:  # pylint: disable=broad-except
+                attempt += 1
+                if (attempt <= self.__num_retries and
+                        _IsRetryableTransferError(e)):
+                    time.sleep(util.CalculateWaitForRetry(
+                        attempt, max_wait=self.__max_retry_wait))
+                    continue
+                self.__FailJob(job, e)
+                return
+            self.stats._RecordSuccess(num_bytes)
+            if callback is not None:
+                callback(result, None)
+            return
+
+    def __Enqueue(self, run_func, description, callback):
+        self.__EnsureStarted()
+        self.__queue.put((run_func, description, callback))
+
+    def AddUpload(self, service, method, request, source, mime_type=None,
+                  callback=None, **kwds):
+        """Queue an upload of source.
+
+        Args:
+          service: A service inheriting from base_api.BaseApiService.
+          method: (str) Name of the upload method, e.g. 'Insert'.
+          request: The request message for service.method.
+          source: A filename, or a seekable stream positioned at the
+              start of the data to upload.
+          mime_type: MIME type of the upload; guessed from the filename
+              if not provided. Required for streams.
+          callback: (optional) Called from a worker thread as
+              callback(response, exception) when the job finishes.
+          **kwds: Additional keyword arguments for the Upload.
+
+        Returns:
+          None.
+        """
+        is_filename = isinstance(source, six.string_types)
+        start_position = None if is_filename else source.tell()
+
+        def RunUpload(http, attempt):
+            if is_filename:
+                upload = Upload.FromFile(source, mime_type=mime_type,
+                                         http=http, **kwds)
+            else:
+                if attempt:
+                    source.seek(start_position)
+                upload = Upload.FromStream(source, mime_type, http=http,
+                                           **kwds)
+            try:
+                result = getattr(service, method)(request, upload=upload)
+            finally:
+                if upload.close_stream:
+                    upload.stream.close()
+            return result, upload.total_size or upload.progress
+
+        self.__Enqueue(RunUpload, 'upload of %s' % (source,), callback)
+
+    def AddDownload(self, service, method, request, filename,
+                    overwrite=False, callback=None, **kwds):
+        """Queue a download into filename.
+
+        Args:
+          service: A service inheriting from base_api.BaseApiService.
+          method: (str) Name of the download method, e.g. 'Get'.
+          request: The request message for service.method.
+          filename: (str) Destination file.
+          overwrite: (bool, default: False) Whether an existing file may be
+              overwritten. Retries always overwrite their own partial file.
+          callback: (optional) Called from a worker thread as
+              callback(response, exception) when the job finishes.
+          **kwds: Additional keyword arguments for the Download.
+
+        Returns:
+          None.
+        """
+        def RunDownload(http, attempt):
+            download = Download.FromFile(
+                filename, overwrite=overwrite or bool(attempt), http=http,
+                **kwds)
+            try:
+                result = getattr(service, method)(request, download=download)
+            finally:
+                download.stream.close()
+            return result, download.progress
+
+        self.__Enqueue(RunDownload, 'download to %s' % filename, callback)
+
+    def Wait(self):
+        """Block until every queued job has finished.
+
+        Returns:
+          The TransferStats for this manager.
+        """
+        self.__queue.join()
+        return self.stats
+
+    def Close(self):
+        """Wait for all queued jobs, then stop the workers.
+
+        Returns:
+          The TransferStats for this manager.
+        """
+        with self.__lock:
+            if self.__closed:
+                return self.stats
+            self.__closed = True
+            workers = list(self.__workers)
+        for _ in workers:
+            self.__queue.put(None)
+        for worker in workers:
+            worker.join()
+        self.stats._Stop()  # pylint: disable=protected-access
+        return self.stats
@@ -15,13 +15,22 @@
 # limitations under the License.
 
 """Tests for transfer.py."""
+import email.mime.multipart as mime_multipart
+import email.mime.nonmultipart as mime_nonmultipart
+import io
+import os
+import shutil
 import string
+import tempfile
+import threading
+import time
 import unittest
 
 import httplib2
 import json
 import mock
 import six
+from six.moves import BaseHTTPServer as http_server
 from six.moves import http_client
 
 from apitools.base.py import base_api
@@ -119,8 +128,8 @@ class TransferTest(unittest.TestCase):
             self.assertEqual(1, make_request.call_count)
             received_request = make_request.call_args[0][1]
             self.assertEqual(base_url, received_request.url)
-            self.assertRangeAndContentRangeCompatible(
-                received_request, make_request.return_value)
+            # The size is known to fit in one chunk, so no range is sent.
+            self.assertNotIn('range', received_request.headers)
 
         with mock.patch.object(http_wrapper, 'MakeRequest',
                                autospec=True) as make_request:
@@ -189,12 +198,79 @@ class TransferTest(unittest.TestCase):
             self.assertEqual(1, make_request.call_count)
             received_request = make_request.call_args[0][1]
             self.assertEqual(base_url, received_request.url)
-            self.assertRangeAndContentRangeCompatible(
-                received_request, make_request.return_value)
+            # The size is known to fit in one chunk, so no range is sent.
+            self.assertNotIn('range', received_request.headers)
             download_stream.seek(0)
             self.assertEqual(string.ascii_lowercase * 2,
                              download_stream.getvalue())
 
+    def testDownloadChargesBandwidthLimiter(self):
+        limiter = mock.Mock()
+        download = transfer.Download.FromStream(
+            six.BytesIO(), chunksize=26, total_size=52,
+            bandwidth_limiter=limiter)
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as make_request:
+            make_request.return_value = http_wrapper.Response(
+                info={
+                    'content-range': 'bytes 0-25/52',
+                    'status': http_client.PARTIAL_CONTENT,
+                },
+                content=string.ascii_lowercase,
+                request_url='https://part.one/',
+            )
+            download.InitializeDownload(
+                http_wrapper.Request(url='https://part.one/'), http=object())
+        # Both chunks are charged once they arrive.
+        self.assertEqual([mock.call(26), mock.call(26)],
+                         limiter.Consume.call_args_list)
+
+    def testSmallDownloadOfUnknownSize(self):
+        download_stream = six.BytesIO()
+        download = transfer.Download.FromStream(download_stream,
+                                                chunksize=100)
+        url_builder = base_api._UrlBuilder('https://part.one/')
+        request = http_wrapper.Request(url='https://part.one/')
+        download.ConfigureRequest(request, url_builder)
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as make_request:
+            make_request.return_value = http_wrapper.Response(
+                info={
+                    'content-range': 'bytes 0-25/26',
+                    'status': http_client.PARTIAL_CONTENT,
+                },
+                content=string.ascii_lowercase,
+                request_url='https://part.one/',
+            )
+            download.InitializeDownload(request, http=object())
+            # The first ranged request completes the download.
+            self.assertEqual(1, make_request.call_count)
+            received_request = make_request.call_args[0][1]
+            self.assertEqual('bytes=0-99', received_request.headers['range'])
+            self.assertNotIn('Range', received_request.headers)
+        self.assertEqual(string.ascii_lowercase.encode('ascii'),
+                         download_stream.getvalue())
+
+    def testSmallDownloadOfKnownSizeIsUnranged(self):
+        download = transfer.Download.FromStream(six.BytesIO(),
+                                                total_size=0)
+        url_builder = base_api._UrlBuilder('https://part.one/')
+        request = http_wrapper.Request(url='https://part.one/')
+        download.ConfigureRequest(request, url_builder)
+        self.assertNotIn('Range', request.headers)
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as make_request:
+            make_request.return_value = http_wrapper.Response(
+                info={'status': http_client.OK},
+                content=b'',
+                request_url='https://part.one/',
+            )
+            download.InitializeDownload(request, http=object())
+            self.assertEqual(1, make_request.call_count)
+            received_request = make_request.call_args[0][1]
+            self.assertNotIn('range', received_request.headers)
+        self.assertEqual(0, download.progress)
+
     def testChunkedDownload(self):
         bytes_http = object()
         http = object()
@@ -244,6 +320,163 @@ class TransferTest(unittest.TestCase):
             self.assertEqual(string.ascii_lowercase + string.ascii_uppercase,
                              download_stream.getvalue())
 
+    def _DownloadEncodedChunks(self, encoded, chunksize, encodings=None,
+                               **kwds):
+        """Download encoded in chunks of chunksize, decompressing it."""
+        download_stream = six.BytesIO()
+        download = transfer.Download.FromStream(
+            download_stream, chunksize=chunksize, total_size=len(encoded),
+            decompress=True, **kwds)
+        download.bytes_http = object()
+
+        def _ReturnBytes(unused_http, http_request,
+                         *unused_args, **unused_kwds):
+            start, _, end = http_request.headers['range'][
+                len('bytes='):].partition('-')
+            start, end = int(start), int(end)
+            encoding = 'gzip'
+            if encodings is not None:
+                encoding = encodings[start // chunksize]
+            return http_wrapper.Response(
+                info={
+                    'content-range': 'bytes %d-%d/%d' % (
+                        start, end, len(encoded)),
+                    'content-encoding': encoding,
+                    'status': http_client.PARTIAL_CONTENT,
+                },
+                content=encoded[start:end + 1],
+                request_url='https://part.one/',
+            )
+
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as make_request:
+            make_request.side_effect = _ReturnBytes
+            request = http_wrapper.Request(url='https://part.one/')
+            download.InitializeDownload(request, http=object())
+        return download, download_stream.getvalue()
+
+    def testDecompressedDownload(self):
+        data = string.ascii_lowercase.encode('ascii') * 100
+        encoded = gzip.compress(data)
+        download, received = self._DownloadEncodedChunks(encoded, 7)
+        self.assertEqual(data, received)
+        self.assertEqual(len(encoded), download.progress)
+        self.assertEqual(len(data), download.decompressed_progress)
+        self.assertEqual('gzip', download.encoding)
+
+    def testDecompressedDownloadMultipleMembers(self):
+        data = b'first member ' * 10 + b'second member ' * 10
+        encoded = gzip.compress(data[:130]) + gzip.compress(data[130:])
+        _, received = self._DownloadEncodedChunks(encoded, 11)
+        self.assertEqual(data, received)
+
+    def testDecompressedDownloadRejectsEncodingChange(self):
+        encoded = gzip.compress(b'some data' * 10)
+        encodings = ['gzip', 'identity', 'identity', 'identity', 'identity']
+        with self.assertRaises(exceptions.TransferInvalidError):
+            self._DownloadEncodedChunks(encoded, 10, encodings=encodings)
+
+    def testDecompressedDownloadTruncated(self):
+        encoded = gzip.compress(b'some data' * 10)[:-4]
+        with self.assertRaises(exceptions.TransferInvalidError):
+            self._DownloadEncodedChunks(encoded, 10)
+
+    def testDecompressedDownloadPassesThroughDecodedContent(self):
+        """Content already decoded by httplib2 is written unchanged."""
+        download_stream = six.BytesIO()
+        download = transfer.Download.FromStream(
+            download_stream, decompress=True)
+        response = http_wrapper.Response(
+            info={'-content-encoding': 'gzip', 'content-length': '4',
+                  'status': http_client.OK},
+            content=b'data',
+            request_url='https://part.one/')
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               autospec=True) as make_request:
+            make_request.return_value = response
+            download.InitializeDownload(
+                http_wrapper.Request(url='https://part.one/'), http=object())
+        self.assertEqual(b'data', download_stream.getvalue())
+        self.assertEqual(4, download.decompressed_progress)
+
+    def testDecompressedDownloadCannotSkipAhead(self):
+        download = transfer.Download.FromStream(
+            six.BytesIO(), total_size=10, auto_transfer=False,
+            decompress=True)
+        download.InitializeDownload(
+            http_wrapper.Request(url='https://part.one/'), http=object())
+        with self.assertRaises(exceptions.InvalidUserInputError):
+            download.GetRange(5)
+
+    def _ServeEncoded(self, encoded):
+        """Serve encoded with Content-Encoding: gzip over local HTTP."""
+
+        class Handler(http_server.BaseHTTPRequestHandler):
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                byte_range = self.headers.get('range')
+                start, end = 0, len(encoded) - 1
+                if byte_range is not None:
+                    start, _, end = byte_range[
+                        len('bytes='):].partition('-')
+                    start = int(start)
+                    end = min(int(end), len(encoded) - 1)
+                    self.send_response(http_client.PARTIAL_CONTENT)
+                    self.send_header('content-range', 'bytes %d-%d/%d' % (
+                        start, end, len(encoded)))
+                else:
+                    self.send_response(http_client.OK)
+                self.send_header('content-encoding', 'gzip')
+                self.send_header('content-length', str(end + 1 - start))
+                self.end_headers()
+                self.wfile.write(encoded[start:end + 1])
+
+            def log_message(self, *unused_args):
+                pass
+
+        server = http_server.HTTPServer(('localhost', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://localhost:%d/' % server.server_address[1]
+
+    def testDecompressedDownloadOverHttplib2(self):
+        data = string.ascii_lowercase.encode('ascii') * 100
+        url = self._ServeEncoded(gzip.compress(data))
+        download_stream = six.BytesIO()
+        download = transfer.Download.FromStream(
+            download_stream, decompress=True)
+        download.InitializeDownload(
+            http_wrapper.Request(url=url), http=httplib2.Http())
+        self.assertEqual(data, download_stream.getvalue())
+        self.assertEqual(len(data), download.decompressed_progress)
+
+    def testDecompressedChunkedDownloadOverHttplib2(self):
+        data = string.ascii_lowercase.encode('ascii') * 100
+        encoded = gzip.compress(data)
+        url = self._ServeEncoded(encoded)
+        download_stream = six.BytesIO()
+        download = transfer.Download.FromStream(
+            download_stream, chunksize=10, total_size=len(encoded),
+            decompress=True)
+        download.InitializeDownload(
+            http_wrapper.Request(url=url), http=httplib2.Http())
+        self.assertEqual(data, download_stream.getvalue())
+        self.assertEqual(len(encoded), download.progress)
+        self.assertEqual(len(data), download.decompressed_progress)
+
+    def testUndecompressedDownloadOverHttplib2(self):
+        """Without decompress, httplib2 still decodes the content."""
+        data = string.ascii_lowercase.encode('ascii') * 100
+        url = self._ServeEncoded(gzip.compress(data))
+        download_stream = six.BytesIO()
+        download = transfer.Download.FromStream(download_stream)
+        download.InitializeDownload(
+            http_wrapper.Request(url=url), http=httplib2.Http())
+        self.assertEqual(data, download_stream.getvalue())
+
     # @mock.patch.object(transfer.Upload, 'RefreshResumableUploadState',
     #                    new=mock.Mock())
     def testFinalizesTransferUrlIfClientPresent(self):
@@ -309,7 +542,7 @@ class TransferTest(unittest.TestCase):
             self.assertEqual(
                 'multipart', url_builder.query_params['uploadType'])
             rewritten_upload_contents = b'\n'.join(
-                http_request.body.split(b'--')[2].splitlines()[1:])
+                http_request.body.read().split(b'--')[2].splitlines()[1:])
             self.assertTrue(rewritten_upload_contents.endswith(upload_bytes))
 
             # Test non-multipart (aka media): no body argument means this is
@@ -326,6 +559,254 @@ class TransferTest(unittest.TestCase):
             rewritten_upload_contents = http_request.body
             self.assertTrue(rewritten_upload_contents.endswith(upload_bytes))
 
+    def testMultipartBodyMatchesEmailGenerator(self):
+        media = b'line one\nFrom \n\x00\xff binary'
+        body = transfer.MultipartRelatedBody(
+            u'{"name": "R\xe4ksm\xf6rg\xe5s"}'.encode('utf-8'),
+            'application/json', six.BytesIO(media), 'text/plain',
+            len(media), boundary='===============1234==')
+
+        msg_root = mime_multipart.MIMEMultipart('related')
+        setattr(msg_root, '_write_headers', lambda self: None)
+        msg_root.set_boundary('===============1234==')
+        msg = mime_nonmultipart.MIMENonMultipart('application', 'json')
+        msg.set_payload(
+            u'{"name": "R\xe4ksm\xf6rg\xe5s"}'.encode('utf-8'))
+        msg_root.attach(msg)
+        msg = mime_nonmultipart.MIMENonMultipart('text', 'plain')
+        msg['Content-Transfer-Encoding'] = 'binary'
+        msg.set_payload(media)
+        msg_root.attach(msg)
+        fp = six.BytesIO()
+        transfer.MultipartBytesGenerator(fp, mangle_from_=False).flatten(
+            msg_root, unixfrom=False)
+
+        self.assertEqual(len(fp.getvalue()), body.length)
+        self.assertEqual(fp.getvalue(), body.read())
+        self.assertIn(b'binary\n\n<media body>\n\n--', body.loggable_body)
+
+    def testMultipartBodyPartialReadsAndSeek(self):
+        media = string.ascii_letters.encode('ascii')
+        media_stream = six.BytesIO(b'skipped' + media)
+        media_stream.seek(7)
+        body = transfer.MultipartRelatedBody(
+            '{}', 'application/json', media_stream, 'text/plain', len(media))
+        expected = body.read()
+        self.assertEqual(body.length, len(expected))
+        self.assertEqual(b'', body.read(10))
+
+        body.seek(0)
+        self.assertEqual(expected, b''.join(
+            iter(lambda: body.read(7), b'')))
+        body.seek(-30, os.SEEK_END)
+        self.assertEqual(expected[-30:], body.read())
+
+    def testMultipartBodyStreamTooShort(self):
+        body = transfer.MultipartRelatedBody(
+            '{}', 'application/json', six.BytesIO(b'abc'), 'text/plain', 10)
+        with self.assertRaises(exceptions.StreamExhausted):
+            body.read()
+
+
+class RemoteFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b''.join(
+            six.int2byte(i % 256) for i in range(1000))
+        self.requests = []
+        patcher = mock.patch.object(http_wrapper, 'MakeRequest',
+                                    autospec=True)
+        self.make_request = patcher.start()
+        self.make_request.side_effect = self._ReturnRange
+        self.addCleanup(patcher.stop)
+
+    def _ReturnRange(self, unused_http, http_request,
+                     *unused_args, **unused_kwds):
+        start, _, end = http_request.headers['range'][
+            len('bytes='):].partition('-')
+        start = int(start)
+        end = min(int(end), len(self.data) - 1)
+        self.requests.append((start, end))
+        if start >= len(self.data):
+            return http_wrapper.Response(
+                info={'content-range': 'bytes */%d' % len(self.data),
+                      'status': http_client.REQUESTED_RANGE_NOT_SATISFIABLE},
+                content=b'', request_url=http_request.url)
+        return http_wrapper.Response(
+            info={
+                'content-range': 'bytes %d-%d/%d' % (
+                    start, end, len(self.data)),
+                'status': http_client.PARTIAL_CONTENT,
+            },
+            content=self.data[start:end + 1],
+            request_url=http_request.url)
+
+    def _RemoteFile(self, **kwds):
+        return transfer.RemoteFile.FromUrl(
+            'https://object/', object(), **kwds)
+
+    def testSeekAndRead(self):
+        remote = self._RemoteFile(block_size=100)
+        self.assertEqual(992, remote.seek(-8, os.SEEK_END))
+        self.assertEqual(self.data[-8:], remote.read())
+        self.assertEqual(b'', remote.read(10))
+        remote.seek(250)
+        self.assertEqual(self.data[250:260], remote.read(10))
+        self.assertEqual(260, remote.tell())
+        # The size probe fetches block 0, then blocks 9 and 2.
+        self.assertEqual([(0, 99), (900, 999), (200, 299)], self.requests)
+
+    def testSmallReadsShareBlocks(self):
+        remote = self._RemoteFile(block_size=100, read_ahead_blocks=0)
+        remote.seek(500)
+        for offset in (500, 510, 520, 530):
+            remote.seek(offset)
+            self.assertEqual(self.data[offset:offset + 5], remote.read(5))
+        self.assertEqual([(0, 99), (500, 599)], self.requests)
+
+    def testReadSpanningBlocksIsCoalesced(self):
+        remote = self._RemoteFile(block_size=100, total_size=1000)
+        remote.seek(150)
+        self.assertEqual(self.data[150:420], remote.read(270))
+        # Blocks 1 to 4 are fetched with a single request.
+        self.assertEqual([(100, 499)], self.requests)
+        self.assertEqual(1, remote.range_requests)
+        self.assertEqual(400, remote.bytes_fetched)
+
+    def testSequentialReadAhead(self):
+        remote = self._RemoteFile(block_size=100, total_size=1000,
+                                  read_ahead_blocks=2)
+        remote.seek(100)
+        self.assertEqual(self.data[100:150], remote.read(50))
+        # This read continues where the last one ended.
+        self.assertEqual(self.data[150:250], remote.read(100))
+        self.assertEqual(self.data[250:550], remote.read(300))
+        self.assertEqual(
+            [(100, 199), (200, 499), (500, 799)], self.requests)
+
+    def testLruEviction(self):
+        remote = self._RemoteFile(block_size=100, total_size=1000,
+                                  max_cached_blocks=2)
+        for offset in (0, 300, 0, 600, 0, 300):
+            remote.seek(offset)
+            remote.read(1)
+        # Block 0 stays cached since it is used most recently; block 3 is
+        # evicted by block 6.
+        self.assertEqual(
+            [(0, 99), (300, 399), (600, 699), (300, 399)], self.requests)
+
+    def testReadinto(self):
+        remote = self._RemoteFile(block_size=64)
+        buf = bytearray(100)
+        remote.seek(30)
+        self.assertEqual(100, remote.readinto(buf))
+        self.assertEqual(self.data[30:130], bytes(buf))
+        self.assertTrue(remote.seekable())
+        remote.close()
+        with self.assertRaises(ValueError):
+            remote.read(1)
+
+    def testBufferedReaderAndEmptyObject(self):
+        remote = io.BufferedReader(self._RemoteFile(block_size=128))
+        self.assertEqual(self.data, remote.read())
+        self.data = b''
+        empty = self._RemoteFile()
+        self.assertEqual(0, empty.size)
+        self.assertEqual(b'', empty.read())
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+
+    def testLimitsRate(self):
+        limiter = transfer.BandwidthLimiter(100000, burst_bytes=10000)
+        start = time.time()
+        # The first 10000 bytes are the burst; the rest take 0.2s.
+        limiter.Consume(30000)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def testChargesParent(self):
+        parent = transfer.BandwidthLimiter(50000, burst_bytes=5000)
+        child = transfer.BandwidthLimiter(10 ** 9, parent=parent)
+        start = time.time()
+        child.Consume(15000)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def testSharesFairly(self):
+        limiter = transfer.BandwidthLimiter(50000, burst_bytes=1000,
+                                            quantum=1000)
+        limiter.Consume(1000)
+        finished = []
+
+        def Transfer(name, num_bytes):
+            limiter.Consume(num_bytes)
+            finished.append(name)
+
+        bulk = threading.Thread(target=Transfer, args=('bulk', 10000))
+        bulk.start()
+        time.sleep(0.03)
+        # A small request made while the bulk one is waiting isn't queued
+        # behind all of it.
+        Transfer('small', 1000)
+        bulk.join()
+        self.assertEqual(['small', 'bulk'], finished)
+
+    def testRejectsInvalidRate(self):
+        with self.assertRaises(exceptions.InvalidUserInputError):
+            transfer.BandwidthLimiter(0)
+
+
+class UploadStrategyPolicyTest(unittest.TestCase):
+
+    def testThresholdPolicy(self):
+        policy = transfer.ThresholdUploadStrategyPolicy(threshold=10)
+        self.assertEqual(transfer.SIMPLE_UPLOAD, policy.ChooseStrategy(10))
+        self.assertEqual(transfer.SIMPLE_UPLOAD, policy.ChooseStrategy(None))
+        self.assertEqual(transfer.RESUMABLE_UPLOAD, policy.ChooseStrategy(11))
+
+    def testAdaptivePolicyUsesInitialThresholdUntilMeasured(self):
+        policy = transfer.AdaptiveUploadStrategyPolicy(
+            min_threshold=100, max_threshold=10000, initial_threshold=500)
+        self.assertEqual(500, policy.threshold)
+        policy.RecordRoundTrip(0.5)
+        self.assertEqual(500, policy.threshold)
+        self.assertEqual(transfer.RESUMABLE_UPLOAD,
+                         policy.ChooseStrategy(501))
+
+    def testAdaptivePolicyDefaultThresholds(self):
+        policy = transfer.AdaptiveUploadStrategyPolicy()
+        self.assertEqual(5 << 20, policy.threshold)
+        # A flaky network makes uploads well below 5 MiB resumable.
+        policy.RecordRoundTrip(0.01)
+        policy.RecordTransfer(1 << 20, 1.0, False)
+        policy.RecordTransfer(1 << 20, 1.0, True)
+        self.assertLess(policy.threshold, 5 << 20)
+        self.assertEqual(transfer.RESUMABLE_UPLOAD,
+                         policy.ChooseStrategy(1 << 20))
+
+    def testAdaptivePolicyThreshold(self):
+        policy = transfer.AdaptiveUploadStrategyPolicy(
+            min_threshold=100, max_threshold=100000, smoothing=0.5,
+            min_failure_rate=0.01)
+        policy.RecordRoundTrip(0.1)
+        policy.RecordTransfer(200, 2.0, True)
+        # 0.1s * 100B/s / 0.01 failures.
+        self.assertEqual(1000, policy.threshold)
+        self.assertEqual(transfer.SIMPLE_UPLOAD, policy.ChooseStrategy(999))
+        # A failure raises the failure rate to 0.5, which brings the
+        # threshold down to the minimum.
+        policy.RecordTransfer(200, 1.0, False)
+        self.assertEqual(0.5, policy.failure_rate)
+        self.assertEqual(100, policy.threshold)
+        self.assertEqual(transfer.RESUMABLE_UPLOAD,
+                         policy.ChooseStrategy(999))
+
+    def testAdaptivePolicyClampsToMaximum(self):
+        policy = transfer.AdaptiveUploadStrategyPolicy(
+            min_threshold=100, max_threshold=5000)
+        policy.RecordRoundTrip(1.0)
+        policy.RecordTransfer(1 << 30, 1.0, True)
+        self.assertEqual(5000, policy.threshold)
+
 
 class UploadTest(unittest.TestCase):
 
@@ -385,6 +866,94 @@ class UploadTest(unittest.TestCase):
             # Ensure the stream was compresed.
             self.assertLess(len(request.body), len(self.sample_data))
 
+    def testStreamInChunksCompressedParallel(self):
+        """Test that StreamInChunks compresses on several threads."""
+        upload = transfer.Upload(
+            stream=self.sample_stream,
+            mime_type='text/plain',
+            total_size=len(self.sample_data),
+            close_stream=False,
+            gzip_encoded=True,
+            gzip_max_workers=4)
+        upload.strategy = transfer.RESUMABLE_UPLOAD
+        # Set the chunk size so the entire stream is uploaded.
+        upload.chunksize = len(self.sample_data)
+        # Mock the upload to return the sample response.
+        with mock.patch.object(transfer.Upload,
+                               '_Upload__SendMediaRequest') as mock_result, \
+                mock.patch.object(http_wrapper,
+                                  'MakeRequest') as make_request:
+            mock_result.return_value = self.response
+            make_request.return_value = self.response
+
+            # Initialization.
+            upload.InitializeUpload(self.request, 'http')
+            upload.StreamInChunks()
+            # Get the uploaded request and end position of the stream.
+            (request, _), _ = mock_result.call_args_list[0]
+            self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+            # Ensure the body decompresses to the original stream.
+            with gzip.GzipFile(fileobj=request.body) as f:
+                self.assertEqual(f.read(), self.sample_data)
+
+    def _StreamAdaptiveUpload(self, data, threshold):
+        upload = transfer.Upload(
+            stream=six.BytesIO(data),
+            mime_type='text/plain',
+            total_size=len(data),
+            close_stream=False,
+            gzip_encoded=True,
+            gzip_ratio_threshold=threshold)
+        upload.strategy = transfer.RESUMABLE_UPLOAD
+        upload.chunksize = len(data)
+        sent = []
+
+        def SendMediaRequest(request, unused_end):
+            # Consume the body, as sending it would.
+            sent.append((request, request.body.read()))
+            return self.response
+
+        with mock.patch.object(transfer.Upload, '_Upload__SendMediaRequest',
+                               side_effect=SendMediaRequest), \
+                mock.patch.object(http_wrapper,
+                                  'MakeRequest') as make_request:
+            make_request.return_value = self.response
+            upload.InitializeUpload(self.request, 'http')
+            upload.StreamInChunks()
+        return upload, sent[0][0], sent[0][1]
+
+    def testStreamInChunksSkipsIncompressibleData(self):
+        """Test that data which doesn't compress is sent uncompressed."""
+        data = os.urandom(4096)
+        upload, request, body = self._StreamAdaptiveUpload(data, 0.9)
+        self.assertFalse(upload.gzip_encoded)
+        self.assertGreaterEqual(upload.compression_ratio, 0.9)
+        self.assertNotIn('Content-Encoding', request.headers)
+        self.assertEqual(body, data)
+
+    def testStreamInChunksCompressesCompressibleData(self):
+        """Test that compressible data is still gzipped when sampled."""
+        upload, request, body = self._StreamAdaptiveUpload(
+            self.sample_data, 0.9)
+        self.assertTrue(upload.gzip_encoded)
+        self.assertLess(upload.compression_ratio, 0.9)
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        with gzip.GzipFile(fileobj=six.BytesIO(body)) as f:
+            self.assertEqual(f.read(), self.sample_data)
+
+    def testCompressionNotSampledWithoutThreshold(self):
+        upload = transfer.Upload(
+            stream=self.sample_stream,
+            mime_type='text/plain',
+            total_size=len(self.sample_data),
+            gzip_encoded=True)
+        upload.strategy = transfer.RESUMABLE_UPLOAD
+        with mock.patch.object(http_wrapper, 'MakeRequest') as make_request:
+            make_request.return_value = self.response
+            upload.InitializeUpload(self.request, 'http')
+        self.assertTrue(upload.gzip_encoded)
+        self.assertIsNone(upload.compression_ratio)
+
     def testStreamMediaCompressedFail(self):
         """Test that non-chunked uploads raise an exception.
 
@@ -471,6 +1040,48 @@ class UploadTest(unittest.TestCase):
             original = f.read()
             self.assertTrue(self.sample_data in original)
 
+    def testStrategyPolicyChoosesStrategy(self):
+        upload_config = base_api.ApiUploadInfo(
+            accept=['*/*'],
+            max_size=None,
+            resumable_path=u'/resumable/upload',
+            simple_multipart=True,
+            simple_path=u'/upload',)
+        policy = transfer.ThresholdUploadStrategyPolicy(threshold=100)
+        upload = transfer.Upload(
+            stream=self.sample_stream,
+            mime_type='text/plain',
+            total_size=len(self.sample_data),
+            strategy_policy=policy)
+        upload.ConfigureRequest(upload_config, self.request, self.url_builder)
+        self.assertEqual(transfer.RESUMABLE_UPLOAD, upload.strategy)
+        self.assertEqual(
+            self.url_builder.query_params['uploadType'], 'resumable')
+
+    def testStrategyPolicyRecordsRequests(self):
+        policy = mock.Mock(spec=transfer.UploadStrategyPolicy)
+        upload = transfer.Upload(
+            stream=self.sample_stream,
+            mime_type='text/plain',
+            total_size=len(self.sample_data),
+            strategy_policy=policy)
+        upload.strategy = transfer.RESUMABLE_UPLOAD
+        upload.chunksize = len(self.sample_data)
+
+        def _ConsumeBody(unused_http, request, **unused_kwds):
+            if hasattr(request.body, 'read'):
+                request.body.read()
+            return self.response
+
+        with mock.patch.object(http_wrapper, 'MakeRequest',
+                               side_effect=_ConsumeBody):
+            upload.InitializeUpload(self.request, 'http')
+        self.assertEqual(1, policy.RecordRoundTrip.call_count)
+        self.assertEqual(1, policy.RecordTransfer.call_count)
+        num_bytes, _, succeeded = policy.RecordTransfer.call_args[0]
+        self.assertEqual(len(self.sample_data), num_bytes)
+        self.assertTrue(succeeded)
+
     def testMediaCompressed(self):
         """Test that media uploads are compressed."""
         # Create the media configuration.
@@ -591,6 +1202,124 @@ class UploadTest(unittest.TestCase):
             # Ensure the mock was called the correct number of times.
             self.assertEqual(make_request.call_count, len(responses))
 
+    def testStreamInChunksMemoryMapped(self):
+        """Test that chunks of a memory-mapped file are sent as views."""
+        with tempfile.TemporaryFile() as upload_file:
+            upload_file.write(self.sample_data)
+            upload_file.seek(0)
+            upload = transfer.Upload(
+                stream=upload_file,
+                mime_type='text/plain',
+                total_size=len(self.sample_data),
+                use_mmap=True)
+            upload.strategy = transfer.RESUMABLE_UPLOAD
+            upload.chunksize = 400
+            responses = [
+                http_wrapper.Response(
+                    info={'status': http_wrapper.RESUME_INCOMPLETE,
+                          'range': '0-399'},
+                    content='', request_url='http://www.uploads.com'),
+                self.response,
+            ]
+            bodies = []
+            sent = []
+
+            def SendMediaRequest(request, unused_end):
+                bodies.append(request.body)
+                sent.append(request.body.tobytes())
+                return responses.pop(0)
+
+            with mock.patch.object(transfer.Upload,
+                                   '_Upload__SendMediaRequest',
+                                   side_effect=SendMediaRequest), \
+                    mock.patch.object(http_wrapper,
+                                      'MakeRequest') as make_request:
+                make_request.return_value = self.response
+                upload.InitializeUpload(self.request, 'http')
+        self.assertEqual(2, len(bodies))
+        for body in bodies:
+            self.assertIsInstance(body, memoryview)
+            # The views were released along with the map.
+            self.assertRaises(ValueError, body.tobytes)
+        self.assertEqual(self.sample_data, b''.join(sent))
+
+    def testMemoryMapReleasedOnFailure(self):
+        with tempfile.TemporaryFile() as upload_file:
+            upload_file.write(self.sample_data)
+            upload_file.seek(0)
+            upload = transfer.Upload(
+                stream=upload_file,
+                mime_type='text/plain',
+                total_size=len(self.sample_data),
+                use_mmap=True)
+            upload.strategy = transfer.RESUMABLE_UPLOAD
+            upload.chunksize = 400
+            bodies = []
+
+            def SendMediaRequest(request, unused_end):
+                bodies.append(request.body)
+                raise exceptions.CommunicationError('connection reset')
+
+            with mock.patch.object(transfer.Upload,
+                                   '_Upload__SendMediaRequest',
+                                   side_effect=SendMediaRequest), \
+                    mock.patch.object(http_wrapper,
+                                      'MakeRequest') as make_request:
+                make_request.return_value = self.response
+                with self.assertRaises(exceptions.CommunicationError):
+                    upload.InitializeUpload(self.request, 'http')
+        body, = bodies
+        self.assertRaises(ValueError, body.tobytes)
+
+    def testMediaRequestMemoryMapped(self):
+        """Test that a simple upload body is a view of the mapped file."""
+        upload_config = base_api.ApiUploadInfo(
+            accept=['*/*'], max_size=None, simple_path=u'/upload')
+        with tempfile.TemporaryFile() as upload_file:
+            upload_file.write(self.sample_data)
+            upload_file.seek(0)
+            upload = transfer.Upload(
+                stream=upload_file,
+                mime_type='text/plain',
+                total_size=len(self.sample_data),
+                use_mmap=True)
+            upload.ConfigureRequest(
+                upload_config, self.request, self.url_builder)
+            self.assertIsInstance(self.request.body, memoryview)
+            self.assertEqual(self.sample_data, self.request.body.tobytes())
+            self.assertEqual(str(len(self.sample_data)),
+                             self.request.headers['content-length'])
+            self.assertEqual(len(self.sample_data), upload_file.tell())
+
+    def testStreamInChunksUnknownSizeReusesBuffer(self):
+        """Test that streamed chunks of unknown size share one buffer."""
+        upload = transfer.Upload(
+            stream=self.sample_stream, mime_type='text/plain')
+        upload.strategy = transfer.RESUMABLE_UPLOAD
+        upload.chunksize = 400
+        with mock.patch.object(transfer.Upload,
+                               '_Upload__SendMediaRequest') as send, \
+                mock.patch.object(http_wrapper,
+                                  'MakeRequest') as make_request:
+            sent = []
+            responses = [
+                http_wrapper.Response(
+                    info={'status': http_wrapper.RESUME_INCOMPLETE,
+                          'range': '0-399'},
+                    content='', request_url='http://www.uploads.com'),
+                self.response,
+            ]
+
+            def _Send(request, unused_end):
+                sent.append((request.body.obj, request.body.tobytes()))
+                return responses.pop(0)
+            send.side_effect = _Send
+            make_request.return_value = self.response
+            upload.InitializeUpload(self.request, 'http')
+        self.assertEqual(2, len(sent))
+        self.assertIs(sent[0][0], sent[1][0])
+        self.assertEqual(self.sample_data, sent[0][1] + sent[1][1])
+
     @mock.patch.object(transfer.Upload, 'RefreshResumableUploadState',
                        new=mock.Mock())
     def testFinalizesTransferUrlIfClientPresent(self):
@@ -606,3 +1335,135 @@ class UploadTest(unittest.TestCase):
         transfer.Upload.FromData(self.sample_stream, fake_json_data, mock_http,
                                  client=mock_client)
         mock_client.FinalizeTransferUrl.assert_called_once_with('url')
+
+
+class _FakeTransferService(object):
+
+    """A service whose methods consume transfers without any network."""
+
+    def __init__(self, failures=0, error=None):
+        self.failures = failures
+        self.error = error or exceptions.TransferRetryError('try again')
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.uploaded = {}
+
+    def Insert(self, request, upload=None):
+        with self.lock:
+            self.calls += 1
+            if self.failures:
+                self.failures -= 1
+                raise self.error
+        self.uploaded[request] = upload.stream.read()
+        return request
+
+    def Get(self, request, download=None):
+        with self.lock:
+            self.calls += 1
+        download.stream.write(request.encode('ascii'))
+        setattr(download, '_Download__progress', len(request))
+        return None
+
+
+class TransferManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.client = mock.Mock()
+
+    def _WriteFile(self, name, contents):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def _NewManager(self, **kwds):
+        return transfer.TransferManager(
+            self.client, http_factory=object, **kwds)
+
+    def testUploadsFilesAndStreams(self):
+        service = _FakeTransferService()
+        paths = [self._WriteFile('file%d.txt' % i, b'x' * (i + 1))
+                 for i in range(10)]
+        with self._NewManager(max_workers=3, max_queued_jobs=2) as manager:
+            for path in paths:
+                manager.AddUpload(service, 'Insert', path, path)
+            manager.AddUpload(service, 'Insert', 'stream',
+                              six.BytesIO(b'streamed'),
+                              mime_type='text/plain', total_size=8)
+        self.assertEqual(11, manager.stats.objects_completed)
+        self.assertEqual(0, manager.stats.objects_failed)
+        self.assertEqual(55 + 8, manager.stats.bytes_transferred)
+        self.assertEqual(b'streamed', service.uploaded['stream'])
+        self.assertEqual(b'xxx', service.uploaded[paths[2]])
+
+    def testRetriesRetryableFailures(self):
+        service = _FakeTransferService(failures=2)
+        stream = six.BytesIO(b'data')
+        callback = mock.Mock()
+        with mock.patch.object(time, 'sleep') as mock_sleep:
+            with self._NewManager(max_workers=1) as manager:
+                manager.AddUpload(service, 'Insert', 'request', stream,
+                                  mime_type='text/plain', callback=callback)
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertEqual(3, service.calls)
+        self.assertEqual(b'data', service.uploaded['request'])
+        callback.assert_called_once_with('request', None)
+
+    def testReportsPermanentFailures(self):
+        error = exceptions.HttpError({'status': '403'}, 'denied', 'url')
+        service = _FakeTransferService(failures=1, error=error)
+        with self._NewManager() as manager:
+            manager.AddUpload(service, 'Insert', 'request',
+                              six.BytesIO(b'data'), mime_type='text/plain')
+        self.assertEqual(1, service.calls)
+        self.assertEqual(0, manager.stats.objects_completed)
+        self.assertEqual(1, manager.stats.objects_failed)
+        self.assertIs(error, manager.stats.failures[0][1])
+
+    def testHttpFactoryFailure(self):
+        error = ValueError('no http')
+        service = _FakeTransferService()
+        callback = mock.Mock()
+        manager = transfer.TransferManager(
+            self.client, max_workers=2, http_factory=mock.Mock(
+                side_effect=[error, error, object()]))
+        for i in range(3):
+            manager.AddUpload(service, 'Insert', 'request%d' % i,
+                              six.BytesIO(b'data'), mime_type='text/plain',
+                              callback=callback)
+        stats = manager.Wait()
+        manager.Close()
+        self.assertEqual(1, stats.objects_completed)
+        self.assertEqual(2, stats.objects_failed)
+        self.assertEqual([error, error],
+                         [exc for _, exc in stats.failures])
+        self.assertEqual(3, callback.call_count)
+
+    def testCallbackFailure(self):
+        service = _FakeTransferService()
+        with self._NewManager(max_workers=1) as manager:
+            for i in range(2):
+                manager.AddUpload(service, 'Insert', 'request%d' % i,
+                                  six.BytesIO(b'data'),
+                                  mime_type='text/plain',
+                                  callback=mock.Mock(side_effect=ValueError))
+            manager.Wait()
+        self.assertEqual(2, manager.stats.objects_completed)
+
+    def testDownloads(self):
+        service = _FakeTransferService()
+        path = os.path.join(self.tempdir, 'download.txt')
+        with self._NewManager() as manager:
+            manager.AddDownload(service, 'Get', 'contents', path)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'contents', f.read())
+        self.assertEqual(8, manager.stats.bytes_transferred)
+
+    def testCannotAddAfterClose(self):
+        manager = self._NewManager()
+        manager.Close()
+        with self.assertRaises(exceptions.TransferInvalidError):
+            manager.AddUpload(_FakeTransferService(), 'Insert', 'request',
+                              six.BytesIO(b''), mime_type='text/plain')
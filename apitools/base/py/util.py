@@ -16,8 +16,12 @@
 
 """Assorted utilities shared between parts of apitools."""
 
+import logging
 import os
 import random
+import socket
+import threading
+import time
 
 import six
 from six.moves import http_client
@@ -56,27 +60,82 @@ def DetectGae():
             server_software.startswith('Google App Engine/'))
 
 
+# Seconds to wait for the metadata server when detecting GCE.
+_GCE_DETECTION_TIMEOUT = 3
+
+# Seconds before probing again after the metadata server wasn't found,
+# in case that was a passing network problem.
+_GCE_DETECTION_RETRY_INTERVAL = 60
+
+# The result of DetectGce, once known, and when it expires.
+_gce_detected = None
+_gce_detection_expiry = None
+_gce_detection_lock = threading.Lock()
+
+
 def DetectGce():
     """Determine whether or not we're running on GCE.
 
     This is based on:
       https://cloud.google.com/compute/docs/metadata#runninggce
 
+    The metadata server is probed with a timeout of GCE_METADATA_TIMEOUT
+    seconds from the environment, or 3 seconds. Once it is found, the
+    result is reused for the life of the process; when it isn't, the
+    result is reused for a minute before probing again. Setting
+    NO_GCE_CHECK=true in the environment skips the probe, and treats the
+    process as not running on GCE.
+
     Returns:
       True iff we're running on a GCE instance.
     """
+    global _gce_detected  # pylint: disable=global-statement
+    global _gce_detection_expiry  # pylint: disable=global-statement
+    if os.environ.get('NO_GCE_CHECK', '').lower() == 'true':
+        return False
+    with _gce_detection_lock:
+        if _gce_detected is None or (
+                _gce_detection_expiry is not None and
+                time.time() >= _gce_detection_expiry):
+            _gce_detected = _ProbeGceMetadataServer()
+            _gce_detection_expiry = None
+            if not _gce_detected:
+                _gce_detection_expiry = (
+                    time.time() + _GCE_DETECTION_RETRY_INTERVAL)
+        return _gce_detected
+
+
+def _ProbeGceMetadataServer():
     metadata_url = 'http://{}'.format(
         os.environ.get('GCE_METADATA_ROOT', 'metadata.google.internal'))
+    timeout = _GCE_DETECTION_TIMEOUT
+    if 'GCE_METADATA_TIMEOUT' in os.environ:
+        try:
+            timeout = float(os.environ['GCE_METADATA_TIMEOUT'])
+        except ValueError:
+            logging.warning(
+                'Ignoring invalid GCE_METADATA_TIMEOUT %r; using %s seconds',
+                os.environ['GCE_METADATA_TIMEOUT'], _GCE_DETECTION_TIMEOUT)
     try:
         o = urllib_request.build_opener(urllib_request.ProxyHandler({})).open(
             urllib_request.Request(
-                metadata_url, headers={'Metadata-Flavor': 'Google'}))
-    except urllib_error.URLError:
+                metadata_url, headers={'Metadata-Flavor': 'Google'}),
+            timeout=timeout)
+    except (urllib_error.URLError, socket.error, http_client.HTTPException):
         return False
     return (o.getcode() == http_client.OK and
             o.headers.get('metadata-flavor') == 'Google')
 
 
+def _ResetDetectGceCache():
+    """Forget the result of DetectGce, so the next call probes again."""
+    global _gce_detected  # pylint: disable=global-statement
+    global _gce_detection_expiry  # pylint: disable=global-statement
+    with _gce_detection_lock:
+        _gce_detected = None
+        _gce_detection_expiry = None
+
+
 def NormalizeScopes(scope_spec):
     """Normalize scope_spec to a set of strings."""
     if isinstance(scope_spec, six.string_types):
@@ -14,8 +14,14 @@
 # limitations under the License.
 
 """Tests for util.py."""
+import os
+import socket
+import time
 import unittest
 
+import mock
+import six
+
 from apitools.base.protorpclite import messages
 from apitools.base.py import encoding
 from apitools.base.py import exceptions
@@ -201,3 +207,71 @@ class UtilTest(unittest.TestCase):
         remapped_params = ['str_field', 'enum_field']
         self.assertEqual(remapped_params,
                          util.MapParamNames(params, MessageWithRemappings))
+
+
+class DetectGceTest(unittest.TestCase):
+
+    def setUp(self):
+        util._ResetDetectGceCache()
+        self.addCleanup(util._ResetDetectGceCache)
+        self.opener = mock.MagicMock()
+        response = mock.MagicMock()
+        response.getcode.return_value = 200
+        response.headers = {'metadata-flavor': 'Google'}
+        self.opener.open.return_value = response
+        patcher = mock.patch.object(six.moves.urllib.request, 'build_opener',
+                                    return_value=self.opener)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('NO_GCE_CHECK', None)
+        os.environ.pop('GCE_METADATA_TIMEOUT', None)
+
+    def testProbesOnce(self):
+        self.assertTrue(util.DetectGce())
+        self.assertTrue(util.DetectGce())
+        self.assertEqual(1, self.opener.open.call_count)
+        self.assertEqual(3, self.opener.open.call_args[1]['timeout'])
+
+    def testTimeout(self):
+        os.environ['GCE_METADATA_TIMEOUT'] = '0.5'
+        self.opener.open.side_effect = socket.timeout('timed out')
+        self.assertFalse(util.DetectGce())
+        self.assertFalse(util.DetectGce())
+        self.assertEqual(1, self.opener.open.call_count)
+        self.assertEqual(0.5, self.opener.open.call_args[1]['timeout'])
+
+    def testProbesAgainAfterFailure(self):
+        response = self.opener.open.return_value
+        self.opener.open.side_effect = [socket.timeout('timed out'),
+                                        response]
+        self.assertFalse(util.DetectGce())
+        self.assertFalse(util.DetectGce())
+        self.assertEqual(1, self.opener.open.call_count)
+        later = time.time() + util._GCE_DETECTION_RETRY_INTERVAL
+        with mock.patch.object(util.time, 'time', return_value=later):
+            self.assertTrue(util.DetectGce())
+        self.assertEqual(2, self.opener.open.call_count)
+        # Once found, the metadata server isn't probed again.
+        with mock.patch.object(util.time, 'time',
+                               return_value=later + 3600):
+            self.assertTrue(util.DetectGce())
+        self.assertEqual(2, self.opener.open.call_count)
+
+    def testInvalidTimeout(self):
+        os.environ['GCE_METADATA_TIMEOUT'] = 'soon'
+        with mock.patch.object(util.logging, 'warning') as warning:
+            self.assertTrue(util.DetectGce())
+        self.assertEqual(1, warning.call_count)
+        self.assertEqual(3, self.opener.open.call_args[1]['timeout'])
+
+    def testNotGce(self):
+        self.opener.open.return_value.headers = {}
+        self.assertFalse(util.DetectGce())
+
+    def testNoGceCheck(self):
+        os.environ['NO_GCE_CHECK'] = 'True'
+        self.assertFalse(util.DetectGce())
+        self.assertEqual(0, self.opener.open.call_count)